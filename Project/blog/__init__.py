@@ -1,10 +1,13 @@
 from .views import app
 from .models import graph
+from . import commands
+from .schema import ensure_schema
+import os
 
-# Uncomment the lines below the first time you run this application, then recomment thereafter.
-# Uniqueness constraints can only be made once.
-
-#graph.schema.create_uniqueness_constraint("User", "username")
-#graph.schema.create_uniqueness_constraint("Tag", "name")
-#graph.schema.create_uniqueness_constraint("Question", "id")
-#graph.schema.create_uniqueness_constraint("Answer", "id")
+# Creates any missing uniqueness constraints and indexes. This is a no-op once they
+# exist; set SCHEMA_ON_STARTUP=0 to leave it to 'flask schema' instead.
+if os.environ.get('SCHEMA_ON_STARTUP', '1') == '1':
+    try:
+        ensure_schema(graph)
+    except Exception:
+        app.logger.exception('Could not bring the schema up to date')
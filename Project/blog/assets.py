@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'static')
+# Where the build writes fingerprinted files, their compressed variants and the manifest.
+BUILD_FOLDER = os.path.join(STATIC_FOLDER, 'build')
+MANIFEST = 'manifest.json'
+# Folders under static that are not part of the build: its own output, and the
+# uploads, which images.py names by content already.
+SKIPPED = set(['build', 'uploads'])
+
+# Files worth compressing; images are compressed already.
+COMPRESSIBLE = set(['.css', '.js', '.svg', '.json', '.txt', '.html'])
+IMAGES = set(['.png', '.jpg', '.jpeg', '.gif'])
+# The encodings the build writes, best first, by file suffix.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+FINGERPRINT_LENGTH = 12
+
+# url('/static/...') references inside stylesheets.
+STATIC_URL = re.compile(r'''url\((['"]?)/static/([^'")?#]+)\1\)''')
+
+manifest = None
+
+
+def fingerprinted(name, content):
+    """name with a hash of content before the extension, e.g. style.3f2a9c01d4e5.css."""
+    base, extension = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.sha256(content).hexdigest()[:FINGERPRINT_LENGTH], extension)
+
+
+def optimize_image(content, extension):
+    """content recompressed losslessly (PNG) or at quality 85 (JPEG), or content
+    itself if that is not smaller. Does nothing if Pillow is not installed."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return content
+    image = Image.open(io.BytesIO(content))
+    out = io.BytesIO()
+    if extension == '.png':
+        image.save(out, 'PNG', optimize=True)
+    elif extension in ('.jpg', '.jpeg'):
+        image.save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    else:
+        return content
+    optimized = out.getvalue()
+    return optimized if len(optimized) < len(content) else content
+
+
+def compressed(content):
+    """The encodings of content that are smaller than it, as {suffix: bytes}.
+    Brotli is skipped if the brotli package is not installed."""
+    found = {}
+    found['.gz'] = gzip.compress(content, 9)
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        found['.br'] = brotli.compress(content, quality=11)
+    return dict((suffix, data) for suffix, data in found.items() if len(data) < len(content))
+
+
+def rewrite_urls(content, urls):
+    """Points url('/static/<name>') references in a stylesheet at the fingerprinted files."""
+    def replace(match):
+        hashed = urls.get(match.group(2))
+        if hashed is None:
+            return match.group(0)
+        return 'url(%s%s%s)' % (match.group(1), hashed, match.group(1))
+    return STATIC_URL.sub(replace, content.decode('utf-8')).encode('utf-8')
+
+
+def sources(source):
+    """The files under source to build, relative to it, images first so the
+    stylesheets that refer to them can be rewritten."""
+    names = []
+    for folder, folders, files in os.walk(source):
+        folders[:] = [name for name in folders if not name.startswith('.')
+                      and os.path.relpath(os.path.join(folder, name), source) not in SKIPPED]
+        for name in files:
+            names.append(os.path.relpath(os.path.join(folder, name), source).replace(os.sep, '/'))
+    return sorted(names, key=lambda name: (os.path.splitext(name)[1].lower() not in IMAGES, name))
+
+
+def build(source=STATIC_FOLDER, output=BUILD_FOLDER, url_prefix='/assets/'):
+    """Writes every file under source to output under a name fingerprinted by its
+    content, with images optimized and the compressible files also written
+    gzipped and brotli compressed next to it. Stylesheets are rewritten to refer
+    to the fingerprinted images. Replaces output, and returns the manifest of
+    original to fingerprinted names it writes there."""
+    staging = tempfile.mkdtemp(dir=os.path.dirname(output), prefix='.build-')
+    try:
+        built = {}
+        urls = {}
+        for name in sources(source):
+            with open(os.path.join(source, name), 'rb') as handle:
+                content = handle.read()
+            extension = os.path.splitext(name)[1].lower()
+            if extension in IMAGES:
+                content = optimize_image(content, extension)
+            elif extension == '.css':
+                content = rewrite_urls(content, urls)
+            hashed = fingerprinted(name, content)
+            write(os.path.join(staging, hashed), content)
+            if extension in COMPRESSIBLE:
+                for suffix, data in compressed(content).items():
+                    write(os.path.join(staging, hashed + suffix), data)
+            built[name] = hashed
+            urls[name] = url_prefix + hashed
+        write(os.path.join(staging, MANIFEST), json.dumps(built, indent=2, sort_keys=True).encode('utf-8'))
+        if os.path.exists(output):
+            shutil.rmtree(output)
+        os.rename(staging, output)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    global manifest
+    manifest = None
+    return built
+
+
+def write(path, content):
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(path, 'wb') as out:
+        out.write(content)
+
+
+def fingerprint_of(name):
+    """The fingerprinted name of static file name, or None if the assets have not
+    been built or name is not one of them. The manifest is read once per process."""
+    global manifest
+    if manifest is None:
+        try:
+            with open(os.path.join(BUILD_FOLDER, MANIFEST)) as handle:
+                manifest = json.load(handle)
+        except (IOError, ValueError):
+            manifest = {}
+    return manifest.get(name)
+
+
+def variant(name, accepted):
+    """The file to send for built file name to a client accepting the encodings
+    accepted(encoding) > 0 says it does, as (file name, encoding or None): the
+    best precompressed variant that exists, or the file itself."""
+    for encoding, suffix in ENCODINGS:
+        if accepted(encoding) > 0 and os.path.isfile(os.path.join(BUILD_FOLDER, name + suffix)):
+            return name + suffix, encoding
+    return name, None
+
+
+def mimetype(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
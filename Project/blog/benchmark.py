@@ -0,0 +1,256 @@
+from concurrent.futures import ThreadPoolExecutor
+import bisect
+import json
+import random
+import threading
+import time
+
+from . import queries
+from .models import User, graph, vote_buffer
+from .passwords import passwords
+from .tags import TAGS
+
+BENCHMARK_PASSWORD = 'benchmark'
+
+# Words the generated questions and answers are made of.
+WORDS = '''
+    paint brush colour canvas gym running weights recipe bread spice garden
+    hiking travel habit sleep guitar piano song album forest river mountain
+    memory stress mood friend family partner laptop phone code robot music
+    coffee tea yoga bike camera photo poem novel chess climbing
+'''.split()
+
+
+class Counter:
+    """Counts the statements a backend is asked to run."""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self):
+        with self.lock:
+            self.count += 1
+
+
+class CountingBackend:
+    """Wraps a backend and counts every round trip to the database: autocommit
+    statements, statements in a transaction and commits."""
+
+    def __init__(self, backend, counter):
+        self.backend = backend
+        self.counter = counter
+
+    def autocommit(self, statement, parameters, readonly):
+        self.counter.add()
+        return self.backend.autocommit(statement, parameters, readonly)
+
+    def run_in(self, tx, statement, parameters):
+        self.counter.add()
+        return self.backend.run_in(tx, statement, parameters)
+
+    def commit(self, tx):
+        self.counter.add()
+        return self.backend.commit(tx)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+def skewed(rng, mean):
+    """A heavy tailed count with the given mean: most draws are small, a few are
+    much larger."""
+    return int(mean * (rng.paretovariate(2) - 1))
+
+
+def weighted_sample(rng, items, cumulative, k):
+    """Up to k distinct items, picked with probability proportional to their
+    weight. cumulative holds the running total of the weights."""
+    k = min(k, len(items))
+    picked = set()
+    attempts = 0
+    while len(picked) < k and attempts < k * 20:
+        picked.add(bisect.bisect(cumulative, rng.random() * cumulative[-1]))
+        attempts += 1
+    return [items[min(i, len(items) - 1)] for i in sorted(picked)]
+
+
+def cumulative(weights):
+    total, found = 0, []
+    for weight in weights:
+        total += weight
+        found.append(total)
+    return found
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+
+def generate(users=200, seed=1, mean_follows=8, mean_questions=3, mean_answers=2, mean_votes=2):
+    """Creates a synthetic graph through the models, so feeds, the search index
+    and the counters are kept like they are for real users. Followers, answers
+    and votes go mostly to a few popular users, tags follow a Zipf distribution
+    and the number of follows, questions, answers and votes per user or question
+    is heavy tailed. The same seed gives the same graph. Returns the usernames,
+    question ids and answer ids created."""
+    rng = random.Random(seed)
+    names = ['bench%05d' % i for i in range(users)]
+    hashed = passwords.hash(BENCHMARK_PASSWORD)
+    for name in names:
+        graph.run(queries.CREATE_USER, user=dict(
+            username=name, username_lower=name, password=hashed, bio='Benchmark user',
+            upvote=0, tag_mask=0, url='default0.jpg'))
+    popularity = cumulative(rng.paretovariate(1.5) for _ in names)
+    tag_popularity = cumulative(1.0 / (rank + 1) for rank in range(len(TAGS)))
+    for name in names:
+        User(name).addTags(' '.join(weighted_sample(rng, TAGS, tag_popularity, 1 + skewed(rng, 1))))
+    for name in names:
+        for other in weighted_sample(rng, names, popularity, skewed(rng, mean_follows)):
+            if other != name:
+                User(name).follow_user(other)
+    question_ids, answer_ids = [], []
+    for name in names:
+        for _ in range(skewed(rng, mean_questions)):
+            tags = weighted_sample(rng, TAGS, tag_popularity, rng.randint(1, 3))
+            question_ids.append(User(name).add_question(
+                sentence(rng, rng.randint(3, 8)).capitalize() + '?', ' '.join(tags), sentence(rng, 30)))
+    for question_id in question_ids:
+        for author in weighted_sample(rng, names, popularity, skewed(rng, mean_answers)):
+            answer_id = User(author).add_answer(question_id, sentence(rng, 20))
+            answer_ids.append(answer_id)
+            for voter in weighted_sample(rng, names, popularity, skewed(rng, mean_votes)):
+                User(voter).upvote_answer(answer_id)
+    vote_buffer.flush()
+    return {"users": names, "questions": question_ids, "answers": answer_ids}
+
+
+# Every route the driver calls. Each takes a random generator and the generated
+# data, and returns (method, url, form, session) for one request.
+ROUTES = {
+    'index': lambda rng, data, user: ('GET', '/', None, {}),
+    'profile': lambda rng, data, user: ('GET', '/profile/' + rng.choice(data['users']), None, {"username": user}),
+    'timeline': lambda rng, data, user: ('GET', '/timeline/' + user, None, {"username": user}),
+    'voteline': lambda rng, data, user: ('GET', '/voteline/' + user, None, {"username": user}),
+    'feedline': lambda rng, data, user: ('GET', '/feedline/' + user, None, {"username": user}),
+    'show_question': lambda rng, data, user: (
+        'GET', '/show_question/' + rng.choice(data['questions']), None, {"username": user}),
+    'add_post': lambda rng, data, user: ('POST', '/add_post', dict(
+        [('title', sentence(rng, 5) + '?'), ('text', sentence(rng, 30))] +
+        [(tag, 'on') for tag in rng.sample(TAGS, rng.randint(1, 3))]), {"username": user}),
+    'add_answer': lambda rng, data, user: ('POST', '/add_answer', {"text": sentence(rng, 20)}, {
+        "username": user, "question_id": rng.choice(data['questions'])}),
+    'upvote_answer': lambda rng, data, user: (
+        'GET', '/upvote_answer/' + rng.choice(data['answers']), None, {"username": user}),
+}
+
+
+def call(client, request):
+    method, url, form, values = request
+    if values:
+        with client.session_transaction() as session:
+            session.update(values)
+    started = time.time()
+    response = client.open(url, method=method, data=form, headers={'Referer': '/'})
+    elapsed = time.time() - started
+    if response.status_code >= 400:
+        raise RuntimeError('%s %s returned %d' % (method, url, response.status_code))
+    return elapsed
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def percentile_ms(seconds, fraction):
+    """The percentile of latencies in seconds, in milliseconds. None if the route
+    was not timed, which happens when there are fewer requests than routes."""
+    value = percentile(seconds, fraction)
+    return None if value is None else 1000 * value
+
+
+def drive(app, data, requests=1000, concurrency=8, seed=1, routes=None):
+    """Calls the routes with random generated users and questions. First every
+    route is called samples times in a row to count its database round trips,
+    then requests calls spread evenly over the routes are made from concurrency
+    threads at once. Returns the report saved as the baseline."""
+    routes = sorted(routes or ROUTES)
+    if not data['questions'] or not data['answers']:
+        raise ValueError('The generated graph has no questions or answers to request.')
+    counter = Counter()
+    backend = graph.backend
+    graph.backend = CountingBackend(backend, counter)
+    try:
+        rng = random.Random(seed)
+        client = app.test_client()
+        round_trips = {}
+        samples = 10
+        for route in routes:
+            before = counter.count
+            for _ in range(samples):
+                call(client, ROUTES[route](rng, data, rng.choice(data['users'])))
+            round_trips[route] = (counter.count - before) / float(samples)
+
+        plan = [(route, seed + i) for i, route in enumerate(routes * (requests // len(routes) + 1))][:requests]
+        random.Random(seed).shuffle(plan)
+        local = threading.local()
+
+        def timed(item):
+            route, request_seed = item
+            if not hasattr(local, 'client'):
+                local.client = app.test_client()
+            request_rng = random.Random(request_seed)
+            return route, call(local.client, ROUTES[route](request_rng, data, request_rng.choice(data['users'])))
+
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            timings = list(pool.map(timed, plan))
+        seconds = time.time() - started
+    finally:
+        graph.backend = backend
+
+    report = {"settings": {"requests": requests, "concurrency": concurrency, "seed": seed,
+                           "users": len(data['users']), "questions": len(data['questions']),
+                           "answers": len(data['answers'])},
+              "total": {"requests": len(timings), "seconds": seconds,
+                        "throughput": len(timings) / seconds if seconds else None},
+              "routes": {}}
+    for route in routes:
+        latencies = [elapsed for name, elapsed in timings if name == route]
+        report["routes"][route] = {
+            "requests": len(latencies),
+            "p50_ms": percentile_ms(latencies, 0.50),
+            "p95_ms": percentile_ms(latencies, 0.95),
+            "p99_ms": percentile_ms(latencies, 0.99),
+            "round_trips": round_trips[route],
+        }
+    return report
+
+
+def compare(baseline, report, tolerance=0.2):
+    """Lists what got worse since baseline: a route whose p95 latency grew by more
+    than tolerance, or that makes more database round trips. Latencies are only
+    compared for routes that were timed in both reports."""
+    regressions = []
+    for route, now in sorted(report["routes"].items()):
+        before = baseline["routes"].get(route)
+        if before is None:
+            continue
+        if None not in (now["p95_ms"], before["p95_ms"]) and now["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append('%s: p95 %.1f ms, was %.1f ms' % (route, now["p95_ms"], before["p95_ms"]))
+        if now["round_trips"] > before["round_trips"]:
+            regressions.append('%s: %.1f round trips, was %.1f' % (route, now["round_trips"], before["round_trips"]))
+    return regressions
+
+
+def save(report, path):
+    with open(path, 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as source:
+        return json.load(source)
@@ -0,0 +1,300 @@
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import json
+import os
+
+from . import queries
+from .models import graph, timestamp, date
+from .tags import mask_of
+
+# Records written per transaction.
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+# Nodes read per page when exporting.
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 1000))
+
+# The fields of every record type, which are also the columns of its CSV file.
+# Upvote totals and username_lower are not among them: they are worked out from
+# the other records when importing.
+FIELDS = {
+    'user': ['username', 'password', 'bio', 'url', 'tags'],
+    'follow': ['username', 'follows'],
+    'question': ['id', 'username', 'title', 'text', 'tags', 'date', 'timestamp',
+                 'update_date', 'update_timestamp', 'created_ms'],
+    'answer': ['id', 'question_id', 'username', 'text', 'date', 'timestamp', 'created_ms'],
+    'upvote': ['username', 'answer_id', 'timestamp'],
+    'bookmark': ['username', 'question_id', 'timestamp'],
+}
+
+# Fields every record of a type must have.
+REQUIRED = {
+    'user': ['username'],
+    'follow': ['username', 'follows'],
+    'question': ['id', 'username', 'title'],
+    'answer': ['id', 'question_id', 'username'],
+    'upvote': ['username', 'answer_id'],
+    'bookmark': ['username', 'question_id'],
+}
+
+# How CSV cells are turned into values. Tags are separated by spaces.
+NUMBERS = {'timestamp': float, 'update_timestamp': float, 'created_ms': int}
+LISTS = set(['tags'])
+
+# The record types in the order they can be written: each stage only refers to
+# nodes written by the stages before it. The types in one stage are written in
+# parallel, each by its own writer.
+STAGES = [('user',), ('follow', 'question'), ('answer', 'bookmark'), ('upvote',)]
+
+
+class Checkpoint:
+    """How far an import got: the stage it is in and, for every type in that
+    stage, how many of its records have been written. Saved to path after every
+    batch, so an import that stops can carry on from there."""
+
+    def __init__(self, path, files):
+        self.path = path
+        self.files = files
+        self.stage = 0
+        self.done = {}
+        if path and os.path.exists(path):
+            with open(path) as handle:
+                saved = json.load(handle)
+            if saved['files'] != files:
+                raise ValueError('%s was written for %s, not these files.' % (path, ', '.join(saved['files'])))
+            self.stage = saved['stage']
+            self.done = saved['done']
+
+    def save(self):
+        if not self.path:
+            return
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as out:
+            json.dump({"files": self.files, "stage": self.stage, "done": self.done}, out)
+        os.replace(temporary, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def record_type(path):
+    """The record type of a CSV file without a type column, from its name:
+    users.csv holds user records."""
+    name = os.path.splitext(os.path.basename(path))[0].lower()
+    name = name[:-1] if name.endswith('s') else name
+    return name if name in FIELDS else None
+
+
+def from_csv(row, default_type):
+    record = {"type": row.pop('type', None) or default_type}
+    for key, value in row.items():
+        if value is None or value == '':
+            continue
+        if key in NUMBERS:
+            value = NUMBERS[key](value)
+        elif key in LISTS:
+            value = value.split()
+        record[key] = value
+    return record
+
+
+def read_records(path):
+    """Yields the records in a JSONL or CSV file one at a time, with the line
+    they are on. Every JSONL line, and every CSV row, needs a type field unless
+    the CSV file is named after its type, like users.csv."""
+    with open(path, newline='') as handle:
+        if path.lower().endswith('.csv'):
+            default_type = record_type(path)
+            for number, row in enumerate(csv.DictReader(handle), 2):
+                yield number, from_csv(row, default_type)
+        else:
+            for number, line in enumerate(handle, 1):
+                if line.strip():
+                    yield number, json.loads(line)
+
+
+def properties(record, fields):
+    return dict((key, record[key]) for key in fields if record.get(key) is not None)
+
+
+def node_properties(record, fields):
+    """The properties of a question or answer node, with the times a record
+    leaves out filled in the way add_question and add_answer would."""
+    found = properties(record, fields)
+    found.setdefault('timestamp', timestamp())
+    found.setdefault('date', date())
+    found.setdefault('created_ms', int(found['timestamp'] * 1000))
+    return found
+
+
+def question_properties(record):
+    found = node_properties(record, ['id', 'title', 'text', 'date', 'timestamp', 'update_date',
+                                     'update_timestamp', 'created_ms'])
+    found.setdefault('update_timestamp', found['timestamp'])
+    return found
+
+
+# For every type: the statement that writes a batch, and how one record becomes
+# one of its rows.
+WRITERS = {
+    'user': (queries.IMPORT_USERS, lambda r: {
+        "user": properties(r, ['username', 'password', 'bio', 'url']), "tags": r.get('tags') or [],
+        "mask": mask_of(r.get('tags') or [])}),
+    'follow': (queries.IMPORT_FOLLOWS, lambda r: {"username": r['username'], "follows": r['follows']}),
+    'question': (queries.IMPORT_QUESTIONS, lambda r: {
+        "username": r['username'], "tags": r.get('tags') or [], "mask": mask_of(r.get('tags') or []),
+        "question": question_properties(r)}),
+    'answer': (queries.IMPORT_ANSWERS, lambda r: {
+        "username": r['username'], "question_id": r['question_id'],
+        "answer": node_properties(r, ['id', 'text', 'date', 'timestamp', 'created_ms'])}),
+    'upvote': (queries.IMPORT_UPVOTES, lambda r: {
+        "username": r['username'], "answer_id": r['answer_id'], "timestamp": r.get('timestamp') or timestamp()}),
+    'bookmark': (queries.IMPORT_BOOKMARKS, lambda r: {
+        "username": r['username'], "question_id": r['question_id'],
+        "timestamp": r.get('timestamp') or timestamp()}),
+}
+
+
+def to_row(path, number, record):
+    kind = record.get('type')
+    if kind not in WRITERS:
+        raise ValueError('%s:%d: unknown record type %r' % (path, number, kind))
+    missing = [key for key in REQUIRED[kind] if record.get(key) in (None, '')]
+    if missing:
+        raise ValueError('%s:%d: %s record without %s' % (path, number, kind, ', '.join(missing)))
+    return WRITERS[kind][1](record)
+
+
+def write_batch(kind, rows):
+    graph.run(WRITERS[kind][0], rows=rows)
+    return len(rows)
+
+
+def import_files(files, batch_size=IMPORT_BATCH_SIZE, checkpoint=None, progress=None):
+    """Writes the records in files to the graph in batches of batch_size, one
+    transaction each. The files are read once per stage and never held in
+    memory; within a stage every type has its own writer, which gets its next
+    batch while the reader builds the one after. With a checkpoint path, an
+    import that stopped resumes after the last batch it wrote. progress, when
+    given, is called with the type and its count after every batch. Returns
+    the number of records written of each type."""
+    checkpoint = Checkpoint(checkpoint, [os.path.abspath(path) for path in files])
+    totals = {}
+    for stage in range(checkpoint.stage, len(STAGES)):
+        kinds = STAGES[stage]
+        if stage != checkpoint.stage:
+            checkpoint.stage, checkpoint.done = stage, {}
+            checkpoint.save()
+        with ThreadPoolExecutor(max_workers=len(kinds)) as writers:
+            pending = {}
+            batches = dict((kind, []) for kind in kinds)
+            seen = dict((kind, 0) for kind in kinds)
+
+            def finish(kind):
+                # Waits for the type's batch in flight, which raises if it failed.
+                future = pending.pop(kind, None)
+                if future is None:
+                    return
+                written = future.result()
+                checkpoint.done[kind] = checkpoint.done.get(kind, 0) + written
+                totals[kind] = totals.get(kind, 0) + written
+                checkpoint.save()
+                if progress is not None:
+                    progress(kind, checkpoint.done[kind])
+
+            def submit(kind):
+                finish(kind)
+                pending[kind] = writers.submit(write_batch, kind, batches[kind])
+                batches[kind] = []
+
+            for path in files:
+                for number, record in read_records(path):
+                    kind = record.get('type')
+                    if kind not in batches:
+                        if stage == 0:
+                            # Finds bad records before anything is written.
+                            to_row(path, number, record)
+                        continue
+                    seen[kind] += 1
+                    if seen[kind] <= checkpoint.done.get(kind, 0):
+                        continue
+                    batches[kind].append(to_row(path, number, record))
+                    if len(batches[kind]) >= batch_size:
+                        submit(kind)
+            for kind in kinds:
+                if batches[kind]:
+                    submit(kind)
+                finish(kind)
+    checkpoint.remove()
+    return totals
+
+
+def pages(query, page_size):
+    """Yields the rows of an EXPORT_ statement, one page at a time."""
+    after = ''
+    while True:
+        rows = graph.read(query, after=after, limit=page_size).data()
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        after = rows[-1]['key']
+
+
+def exported(kind, values):
+    record = {"type": kind}
+    record.update((key, values[key]) for key in FIELDS[kind] if values.get(key) is not None)
+    return record
+
+
+def export_records(page_size=EXPORT_PAGE_SIZE):
+    """Yields every user, follow, bookmark, question, answer and upvote as a
+    record that import_files reads back, paging through the graph page_size
+    nodes at a time."""
+    for row in pages(queries.EXPORT_USERS, page_size):
+        yield exported('user', dict(row['user'], tags=row['tags']))
+        for other in row['follows']:
+            yield exported('follow', {"username": row['key'], "follows": other})
+        for bookmark in row['bookmarks']:
+            if bookmark['question_id'] is not None:
+                yield exported('bookmark', dict(bookmark, username=row['key']))
+    for row in pages(queries.EXPORT_QUESTIONS, page_size):
+        yield exported('question', dict(row['question'], username=row['username'], tags=row['tags']))
+    for row in pages(queries.EXPORT_ANSWERS, page_size):
+        yield exported('answer', dict(row['answer'], username=row['username'], question_id=row['question_id']))
+        for vote in row['votes']:
+            if vote['username'] is not None:
+                yield exported('upvote', dict(vote, answer_id=row['key']))
+
+
+def write_jsonl(records, out):
+    """Writes records to the open file out, one JSON object per line. Returns
+    how many were written."""
+    count = 0
+    for record in records:
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(records, folder):
+    """Writes records to one CSV file per type in folder, e.g. users.csv.
+    Returns how many were written."""
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    files, writers = {}, {}
+    count = 0
+    try:
+        for record in records:
+            kind = record.pop('type')
+            if kind not in writers:
+                files[kind] = open(os.path.join(folder, kind + 's.csv'), 'w', newline='')
+                writers[kind] = csv.DictWriter(files[kind], FIELDS[kind])
+                writers[kind].writeheader()
+            if 'tags' in record:
+                record['tags'] = ' '.join(record['tags'])
+            writers[kind].writerow(record)
+            count += 1
+    finally:
+        for handle in files.values():
+            handle.close()
+    return count
@@ -0,0 +1,241 @@
+from collections import Counter, OrderedDict
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class Cache:
+    """A size-bounded, in-process LRU cache whose entries expire after a TTL and
+    can be dropped early by tag. Model functions that read data which is written
+    far less often than it is read are memoized through it, and the functions that
+    write that data invalidate the tags of what they changed.
+
+    Every invalidation counts as a new generation, and each tag remembers the
+    generation it was last invalidated in while loads are running. A load
+    started in an earlier generation than one of its tags was invalidated in
+    may have read the data from before that write, so it is not stored."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.tagged = {}
+        self.generation = 0
+        self.invalidated = {}
+        self.cleared = 0
+        self.loading = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.log = None
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        """Returns (True, value) if key is cached and fresh, else (False, None)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key, value, tags=(), ttl=None, since=None):
+        """Caches value under key, evicting the least recently used entries once
+        the cache is full. since is the generation begin_load returned before
+        value was read; if any of tags was invalidated after it, value is not
+        stored."""
+        with self.lock:
+            if since is not None and (self.cleared > since or
+                                      any(self.invalidated.get(tag, -1) > since for tag in tags)):
+                return
+            if key in self.entries:
+                self._drop(key)
+            expires = time.time() + (self.ttl if ttl is None else ttl)
+            self.entries[key] = (expires, value, tuple(tags))
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate(self, *tags):
+        """Drops every entry carrying any of the given tags, in this process and,
+        once they have synced, in the other processes sharing the log."""
+        self.drop_tags(tags)
+        if self.log is not None and tags:
+            self.log.record(tags)
+
+    def drop_tags(self, tags):
+        """Drops every entry carrying any of tags, in this process only."""
+        with self.lock:
+            self.generation += 1
+            for tag in tags:
+                if self.loading:
+                    self.invalidated[tag] = self.generation
+                for key in list(self.tagged.get(tag, ())):
+                    self._drop(key)
+
+    def begin_load(self):
+        """Marks the start of reading a value to cache, and returns the generation
+        to pass to set."""
+        with self.lock:
+            self.loading[self.generation] += 1
+            return self.generation
+
+    def end_load(self, since):
+        """Marks the end of a load begun in generation since. Invalidations older
+        than every running load are forgotten."""
+        with self.lock:
+            self.loading[since] -= 1
+            if not self.loading[since]:
+                del self.loading[since]
+            oldest = min(self.loading) if self.loading else self.generation
+            for tag in [tag for tag, generation in self.invalidated.items() if generation <= oldest]:
+                del self.invalidated[tag]
+
+    def share(self, log):
+        """Shares invalidations with the other processes serving the app through
+        log, an InvalidationLog."""
+        self.log = log
+
+    def sync(self):
+        """Drops what other processes invalidated since the last sync. Called at
+        the start of every request, so a write made through one process is never
+        read back stale through another. When the log cannot tell, because it is
+        unreachable or was pruned past the last sync, everything is dropped."""
+        if self.log is None:
+            return
+        tags = self.log.changes()
+        if tags is None:
+            self.clear()
+        else:
+            self.drop_tags(tags)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.cleared = self.generation
+            self.entries.clear()
+            self.tagged.clear()
+
+    def stats(self):
+        """Returns the hit and miss counters and the current size."""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+    def memoize(self, tags, ttl=None):
+        """Decorates a function so its results are cached per arguments. The
+        arguments are bound to the function's parameters, defaults included, so a
+        call is cached the same way whether an argument is passed by position, by
+        keyword or left to its default. tags is called with the result followed by
+        the arguments, and returns the tags the entry is invalidated by. Arguments
+        must be hashable. A result is not cached if one of its tags was invalidated
+        while it was being read."""
+        def decorator(function):
+            signature = inspect.signature(function)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = (function.__qualname__,) + tuple(bound.arguments.items())
+                found, value = self.get(key)
+                if found:
+                    return value
+                since = self.begin_load()
+                try:
+                    value = function(*bound.args, **bound.kwargs)
+                    self.set(key, value, tags(value, *bound.args, **bound.kwargs), ttl, since)
+                finally:
+                    self.end_load(since)
+                return value
+            return wrapper
+        return decorator
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tagged.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tagged[tag]
+
+
+class InvalidationLog:
+    """The invalidations of every process, kept in the database they all use.
+    write(id, tags) stores the tags of one invalidation, read(since) returns
+    (now, [(id, tags)]) for those stored at or after since, by the database's
+    clock in milliseconds, and prune(before) deletes older ones. Every read looks
+    back lookback seconds for invalidations whose transaction was still open at
+    the one before, and skips those it has already applied. Entries are kept
+    for keep seconds, and a process that has not read for longer than that
+    cannot know what it missed."""
+
+    def __init__(self, write, read, prune, lookback=2.0, keep=3600.0, prune_interval=60.0):
+        self.write = write
+        self.read = read
+        self.prune = prune
+        self.lookback = lookback
+        self.keep = keep
+        self.prune_interval = prune_interval
+        self.since = None
+        self.applied = {}
+        self.pruned_at = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, tags):
+        id = str(uuid.uuid4())
+        with self.lock:
+            self.applied[id] = time.time()
+        self.write(id, sorted(tags))
+
+    def changes(self):
+        """The tags invalidated by other processes since the last call, or None
+        if that cannot be known."""
+        with self.lock:
+            since = self.since
+        try:
+            # A new process has nothing cached yet, so it only needs the clock.
+            now, found = self.read(since - self.lookback * 1000 if since is not None else 2 ** 53)
+        except Exception:
+            logger.exception('Could not read the cache invalidation log')
+            return None
+        tags = set()
+        with self.lock:
+            if since is not None and now - since > self.keep * 1000:
+                tags = None
+            for id, invalidated in found:
+                if id not in self.applied:
+                    self.applied[id] = time.time()
+                    if tags is not None:
+                        tags.update(invalidated)
+            self.since = max(now, self.since or now)
+            forgotten = time.time() - 2 * self.lookback
+            for id in [id for id, at in self.applied.items() if at < forgotten]:
+                del self.applied[id]
+            prune = time.time() - self.pruned_at > self.prune_interval
+            if prune:
+                self.pruned_at = time.time()
+        if prune:
+            try:
+                self.prune(now - self.keep * 1000)
+            except Exception:
+                logger.exception('Could not prune the cache invalidation log')
+        return tags
+
+
+cache = Cache(
+    maxsize=int(os.environ.get('CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('CACHE_TTL', 300))
+)
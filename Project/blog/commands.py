@@ -0,0 +1,167 @@
+import click
+
+import os
+
+from .views import app, PROJECT_HOME
+from .models import rebuild_feeds, get_pic_urls, rebuild_search_index, backfill_created_ms, check_tag_masks, \
+    repair_question_summaries
+from . import images
+from .models import graph
+from .schema import ensure_schema, check_queries
+from .memory import check_parity
+from . import benchmark
+from . import assets
+from . import bulk
+
+
+@app.cli.command('rebuild-feeds')
+def rebuild_feeds_command():
+    """Backfills the FEED relationships of every existing user."""
+    count = rebuild_feeds()
+    click.echo('Rebuilt feeds for %d users.' % count)
+
+
+@app.cli.command('clean-images')
+def clean_images_command():
+    """Removes uploaded profile pictures that no user refers to any more."""
+    folder = os.path.join(PROJECT_HOME, app.config['UPLOAD_FOLDER'])
+    removed = images.clean_orphans(folder, get_pic_urls())
+    click.echo('Removed %d orphaned images.' % len(removed))
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprints, optimizes and precompresses the files under static."""
+    built = assets.build()
+    for name, hashed in sorted(built.items()):
+        click.echo('%s -> %s' % (name, hashed))
+
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Rebuilds the question search index and the username prefix index."""
+    count = rebuild_search_index()
+    click.echo('Indexed %d questions.' % count)
+
+
+@app.cli.command('backfill-created-ms')
+def backfill_created_ms_command():
+    """Gives questions and answers made before created_ms existed their creation
+    time in epoch milliseconds, from their timestamp."""
+    count = backfill_created_ms()
+    click.echo('Updated %d questions and answers.' % count)
+
+
+@app.cli.command('repair-question-summaries')
+@click.option('--batch-size', default=500, help='Questions repaired per transaction.')
+def repair_question_summaries_command(batch_size):
+    """Recomputes the answer, vote and bookmark counts, last answerer and last
+    activity of every question from its answers, upvotes and bookmarks."""
+    count = repair_question_summaries(batch_size)
+    click.echo('Repaired %d questions.' % count)
+
+
+@app.cli.command('check-tag-masks')
+@click.option('--repair', is_flag=True, help='Correct the masks that disagree with the Tag relationships.')
+def check_tag_masks_command(repair):
+    """Checks the tag_mask of every user and question against its Tag relationships."""
+    wrong = check_tag_masks(repair)
+    for label, count in sorted(wrong.items()):
+        click.echo('%s: %d %s' % (label, count, 'repaired' if repair else 'wrong'))
+    if any(wrong.values()) and not repair:
+        raise SystemExit(1)
+
+
+@app.cli.command('import-graph')
+@click.argument('files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=bulk.IMPORT_BATCH_SIZE, help='Records written per transaction.')
+@click.option('--checkpoint', default='import.checkpoint',
+              help='Where progress is saved, so a stopped import can be run again to resume it.')
+@click.option('--rebuild/--no-rebuild', default=True, help='Rebuild feeds, question summaries and the search index afterwards.')
+def import_graph_command(files, batch_size, checkpoint, rebuild):
+    """Loads users, follows, questions, answers, upvotes and bookmarks from JSONL
+    or CSV files, as written by export-graph."""
+    totals = bulk.import_files(list(files), batch_size, checkpoint,
+                               progress=lambda kind, count: click.echo('%s: %d' % (kind, count)))
+    for kind, count in sorted(totals.items()):
+        click.echo('Imported %d %s records.' % (count, kind))
+    if rebuild:
+        click.echo('Rebuilt feeds for %d users.' % rebuild_feeds())
+        click.echo('Repaired %d question summaries.' % repair_question_summaries())
+        click.echo('Indexed %d questions.' % rebuild_search_index())
+
+
+@app.cli.command('export-graph')
+@click.option('--output', default='-', help='The JSONL file to write, or the folder for CSV files.')
+@click.option('--format', 'format', type=click.Choice(['jsonl', 'csv']), default='jsonl')
+@click.option('--page-size', default=bulk.EXPORT_PAGE_SIZE, help='Nodes read per statement.')
+def export_graph_command(output, format, page_size):
+    """Writes the whole graph as records import-graph can load, a page at a time."""
+    records = bulk.export_records(page_size)
+    if format == 'csv':
+        count = bulk.write_csv(records, output)
+    else:
+        with click.open_file(output, 'w') as out:
+            count = bulk.write_jsonl(records, out)
+    click.echo('Exported %d records.' % count, err=True)
+
+
+@app.cli.command('schema')
+@click.option('--check', is_flag=True, help='Also fail if any query plans a full label scan.')
+def schema_command(check):
+    """Creates missing constraints and indexes, and optionally checks query plans."""
+    for statement in ensure_schema(graph):
+        click.echo(statement)
+    if check:
+        failures = check_queries(graph)
+        for name, operators in sorted(failures.items()):
+            click.echo('%s: %s' % (name, ', '.join(operators)), err=True)
+        if failures:
+            raise SystemExit(1)
+        click.echo('Every query is served by an index.')
+
+
+@app.cli.command('graph-parity')
+@click.option('--samples', default=20, help='How many users to compare the reads of.')
+def graph_parity_command(samples):
+    """Checks that the memory backend answers every read like the configured database."""
+    failures = check_parity(graph, samples)
+    for name, parameters in failures:
+        click.echo('%s differs for %r' % (name, parameters), err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo('The memory backend agrees with the database.')
+
+
+@app.cli.command('benchmark')
+@click.option('--users', default=200, help='How many users to generate.')
+@click.option('--seed', default=1, help='Seed of the generated graph and requests.')
+@click.option('--requests', default=1000, help='How many requests to time.')
+@click.option('--concurrency', default=8, help='How many requests run at once.')
+@click.option('--output', default='benchmark.json', help='Where to save the report.')
+@click.option('--baseline', type=click.Path(exists=True), help='A saved report to compare with.')
+@click.option('--tolerance', default=0.2, help='How much slower p95 may get before it counts as a regression.')
+def benchmark_command(users, seed, requests, concurrency, output, baseline, tolerance):
+    """Generates a synthetic graph and times every route against it. Writes to the
+    configured database, so use GRAPH_BACKEND=memory or an empty database."""
+    app.secret_key = app.secret_key or os.urandom(24)
+    data = benchmark.generate(users=users, seed=seed)
+    click.echo('Generated %d users, %d questions and %d answers.' % (
+        len(data['users']), len(data['questions']), len(data['answers'])))
+    report = benchmark.drive(app, data, requests=requests, concurrency=concurrency, seed=seed)
+    for route, timing in sorted(report['routes'].items()):
+        if timing['requests']:
+            click.echo('%-14s p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms  %5.1f round trips' % (
+                route, timing['p50_ms'], timing['p95_ms'], timing['p99_ms'], timing['round_trips']))
+        else:
+            click.echo('%-14s %-46s  %5.1f round trips' % (
+                route, 'not timed, raise --requests', timing['round_trips']))
+    if report['total']['throughput'] is not None:
+        click.echo('%.1f requests per second' % report['total']['throughput'])
+    benchmark.save(report, output)
+    if baseline:
+        regressions = benchmark.compare(benchmark.load(baseline), report, tolerance)
+        for regression in regressions:
+            click.echo(regression, err=True)
+        if regressions:
+            raise SystemExit(1)
@@ -0,0 +1,341 @@
+import os
+import random
+import threading
+import time
+
+from . import queries
+from . import metrics
+
+
+class Result:
+    """The records returned by a statement, read in full, as plain dicts. Node
+    values are turned into dicts of their properties, so every backend returns
+    the same shapes."""
+
+    def __init__(self, records):
+        self.records = records
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def data(self):
+        return self.records
+
+    def evaluate(self):
+        """Returns the first value of the first record, or None."""
+        if not self.records:
+            return None
+        return next(iter(self.records[0].values()), None)
+
+
+def to_value(value):
+    """Turns nodes and relationships into dicts of their properties, recursively."""
+    if hasattr(value, 'labels') or hasattr(value, 'type'):
+        return dict(value.items())
+    if isinstance(value, list):
+        return [to_value(v) for v in value]
+    if isinstance(value, dict):
+        return dict((k, to_value(v)) for k, v in value.items())
+    return value
+
+
+def to_record(keys, values):
+    return dict((key, to_value(value)) for key, value in zip(keys, values))
+
+
+def to_plan(plan):
+    """Turns a query plan from either driver into {"operator": ..., "children": [...]}."""
+    if plan is None:
+        return None
+    if isinstance(plan, dict):
+        operator = plan.get('operatorType') or plan.get('operator_type')
+        children = plan.get('children', [])
+    else:
+        operator = plan.operator_type
+        children = plan.children
+    found = {"operator": operator, "children": [to_plan(child) for child in children]}
+    rows, db_hits = profile_counts(plan)
+    if rows is not None:
+        found["rows"] = rows
+    if db_hits is not None:
+        found["db_hits"] = db_hits
+    return found
+
+
+def profile_counts(plan):
+    """The rows and database hits of a PROFILE plan, or None for an EXPLAIN plan."""
+    if isinstance(plan, dict):
+        args = plan.get('args', {})
+        return plan.get('rows', args.get('Rows')), plan.get('dbHits', args.get('DbHits'))
+    return getattr(plan, 'rows', None), getattr(plan, 'db_hits', None)
+
+
+def timed(statement, parameters, execute, profile=None):
+    """Runs execute, which sends statement to the database, and records how long
+    it took and how many rows came back with metrics.observe_query."""
+    started = time.time()
+    try:
+        records = execute()
+    except Exception:
+        metrics.observe_query(statement, parameters, time.time() - started, 0, failed=True)
+        raise
+    metrics.observe_query(statement, parameters, time.time() - started, len(records), profile=profile)
+    return records
+
+
+class Transaction:
+    """An explicit transaction. Used as a context manager it commits when the block
+    ends normally and rolls back when it raises."""
+
+    def __init__(self, backend, readonly):
+        self.backend = backend
+        self.readonly = readonly
+        self.tx = backend.open_transaction(readonly)
+        self.finished = False
+
+    def run(self, statement, parameters=None, **kwparameters):
+        parameters = dict(parameters or {}, **kwparameters)
+        return Result(timed(statement, parameters,
+                            lambda: self.backend.run_in(self.tx, statement, parameters)))
+
+    def commit(self):
+        self.finished = True
+        self.backend.commit(self.tx)
+
+    def rollback(self):
+        self.finished = True
+        self.backend.rollback(self.tx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.finished:
+            return False
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+class Database:
+    """The one way the models talk to the graph. Statements are plain Cypher with
+    parameters; the backend decides how they reach the database."""
+
+    def __init__(self, backend, factory=None):
+        self.backend = backend
+        self.factory = factory
+
+    def reopen(self):
+        """Replaces the backend with a new one made by factory. Used in processes
+        forked after the backend was created, which must not share its pooled
+        connections with their parent. The old backend is dropped, not closed,
+        as closing it would close the parent's connections too."""
+        if self.factory is not None:
+            self.backend = self.factory()
+
+    def run(self, statement, parameters=None, **kwparameters):
+        """Runs one statement in its own write transaction."""
+        parameters = dict(parameters or {}, **kwparameters)
+        return Result(timed(statement, parameters,
+                            lambda: self.backend.autocommit(statement, parameters, False)))
+
+    def read(self, statement, parameters=None, **kwparameters):
+        """Runs one statement in its own read transaction. Slow reads can be
+        profiled, as running them again changes nothing."""
+        parameters = dict(parameters or {}, **kwparameters)
+        return Result(timed(statement, parameters,
+                            lambda: self.backend.autocommit(statement, parameters, True),
+                            profile=lambda: self.profile(statement, parameters)))
+
+    def begin(self, readonly=False):
+        """Opens an explicit read or write transaction."""
+        return Transaction(self.backend, readonly)
+
+    def find_one(self, label, key, value):
+        """Returns the properties of the first node with label and key=value, or None."""
+        return self.read(queries.find_one(label, key), value=value).evaluate()
+
+    def explain(self, statement, parameters=None):
+        """Returns the plan Neo4j would use for statement, without running it."""
+        return to_plan(self.backend.explain('EXPLAIN ' + statement, parameters or {}))
+
+    def profile(self, statement, parameters=None):
+        """Runs statement with PROFILE and returns its plan with the rows and
+        database hits of every operator."""
+        return to_plan(self.backend.explain('PROFILE ' + statement, parameters or {}))
+
+    def ping(self):
+        """Returns True if the database answers a trivial statement."""
+        try:
+            return self.read('RETURN 1').evaluate() == 1
+        except Exception:
+            return False
+
+    def close(self):
+        self.backend.close()
+
+
+class HttpBackend:
+    """Talks to the REST endpoint under /db/data/ through py2neo, one HTTP request
+    per statement."""
+
+    def __init__(self, url, username, password):
+        from py2neo import Graph
+        self.graph = Graph(url + '/db/data/', username=username, password=password)
+
+    def autocommit(self, statement, parameters, readonly):
+        cursor = self.graph.run(statement, parameters)
+        return [to_record(record.keys(), record.values()) for record in cursor]
+
+    def explain(self, statement, parameters):
+        return self.graph.run(statement, parameters).plan()
+
+    def open_transaction(self, readonly):
+        return self.graph.begin()
+
+    def run_in(self, tx, statement, parameters):
+        cursor = tx.run(statement, parameters)
+        return [to_record(record.keys(), record.values()) for record in cursor]
+
+    def commit(self, tx):
+        tx.commit()
+
+    def rollback(self, tx):
+        tx.rollback()
+
+    def close(self):
+        pass
+
+
+class BoltBackend:
+    """Talks to the binary Bolt protocol through a pool of connections held by the
+    neo4j driver. The pool is bounded, waits at most acquire_timeout seconds for a
+    free connection and retires connections after max_lifetime seconds. When the
+    pool has sat idle for longer than liveness_check seconds, the connection is
+    pinged before use, and failed connects back off with jitter, so a database
+    restart does not cause every worker thread to reconnect at the same moment."""
+
+    def __init__(self, url, username, password, pool_size, acquire_timeout,
+                 max_lifetime, liveness_check, retries=3):
+        from neo4j import GraphDatabase, READ_ACCESS, WRITE_ACCESS
+        self.access_modes = {True: READ_ACCESS, False: WRITE_ACCESS}
+        auth = (username, password) if username else None
+        self.driver = GraphDatabase.driver(
+            url,
+            auth=auth,
+            max_connection_pool_size=pool_size,
+            connection_acquisition_timeout=acquire_timeout,
+            max_connection_lifetime=max_lifetime
+        )
+        self.liveness_check = liveness_check
+        self.retries = retries
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def autocommit(self, statement, parameters, readonly):
+        session = self.session(readonly)
+        try:
+            result = session.run(statement, parameters)
+            return [to_record(record.keys(), record.values()) for record in result]
+        finally:
+            session.close()
+
+    def explain(self, statement, parameters):
+        session = self.session(True)
+        try:
+            summary = session.run(statement, parameters).summary()
+            return summary.profile or summary.plan
+        finally:
+            session.close()
+
+    def open_transaction(self, readonly):
+        session = self.session(readonly)
+        try:
+            return session, session.begin_transaction()
+        except Exception:
+            session.close()
+            raise
+
+    def session(self, readonly):
+        """Opens a session on a live pooled connection, retrying with jittered
+        exponential backoff while the database is unavailable."""
+        from neo4j.exceptions import ServiceUnavailable
+        for attempt in range(self.retries):
+            session = self.driver.session(access_mode=self.access_modes[readonly])
+            try:
+                if self.needs_liveness_check():
+                    session.run('RETURN 1').consume()
+                return session
+            except ServiceUnavailable:
+                session.close()
+                if attempt == self.retries - 1:
+                    raise
+                time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+    def needs_liveness_check(self):
+        with self.lock:
+            idle = time.time() - self.last_used
+            self.last_used = time.time()
+        return idle > self.liveness_check
+
+    def run_in(self, tx, statement, parameters):
+        result = tx[1].run(statement, parameters)
+        return [to_record(record.keys(), record.values()) for record in result]
+
+    def commit(self, tx):
+        session, transaction = tx
+        try:
+            transaction.commit()
+        finally:
+            session.close()
+
+    def rollback(self, tx):
+        session, transaction = tx
+        try:
+            transaction.rollback()
+        finally:
+            session.close()
+
+    def close(self):
+        self.driver.close()
+
+
+def connect():
+    """Creates the Database described by the environment. GRAPH_BACKEND picks
+    'http' (the default, REST over GRAPHENEDB_URL), 'bolt' (GRAPHENEDB_BOLT_URL)
+    or 'memory' (a graph in this process, kept in GRAPH_MEMORY_FILE if set), and
+    the GRAPH_POOL_* variables size the Bolt connection pool."""
+    backend = os.environ.get('GRAPH_BACKEND', 'http')
+    if backend == 'memory':
+        from .memory import MemoryBackend
+        # The graph lives in the process itself, so there is nothing to reopen.
+        return Database(MemoryBackend(os.environ.get('GRAPH_MEMORY_FILE')))
+    return Database(open_backend(backend), factory=lambda: open_backend(backend))
+
+
+def open_backend(backend):
+    """Creates a network backend of the kind GRAPH_BACKEND names."""
+    username = os.environ.get('NEO4J_USERNAME')
+    password = os.environ.get('NEO4J_PASSWORD')
+    if backend == 'bolt':
+        return BoltBackend(
+            os.environ.get('GRAPHENEDB_BOLT_URL', 'bolt://localhost:7687'),
+            username,
+            password,
+            pool_size=int(os.environ.get('GRAPH_POOL_SIZE', 50)),
+            acquire_timeout=float(os.environ.get('GRAPH_POOL_ACQUIRE_TIMEOUT', 10)),
+            max_lifetime=float(os.environ.get('GRAPH_POOL_MAX_LIFETIME', 3600)),
+            liveness_check=float(os.environ.get('GRAPH_POOL_LIVENESS_CHECK', 60))
+        )
+    if backend == 'http':
+        return HttpBackend(
+            os.environ.get('GRAPHENEDB_URL', 'http://localhost:7474'),
+            username,
+            password
+        )
+    raise ValueError('Unknown GRAPH_BACKEND: %s' % backend)
@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import time
+
+from . import identity, metrics
+
+logger = logging.getLogger(__name__)
+
+QUERY_WORKERS = int(os.environ.get('QUERY_WORKERS', 8))
+QUERY_TIMEOUT = float(os.environ.get('QUERY_TIMEOUT', 5))
+
+executor = ThreadPoolExecutor(max_workers=QUERY_WORKERS)
+
+
+def run_concurrently(queries, timeout=QUERY_TIMEOUT):
+    """Runs independent model queries on the shared thread pool and waits for all
+    of them. queries maps a name to a (function, fallback) pair; the function is
+    called without arguments and must return fully read results, not a cursor.
+    A query that raises or is not done within timeout seconds of being started
+    gives its fallback instead. The queries share the identity map of the
+    request that runs them. Returns a dict of name to result."""
+    started = time.time()
+    futures = dict((name, executor.submit(
+                       metrics.attributed(identity.attached(function))))
+                   for name, (function, fallback) in queries.items())
+    results = {}
+    for name, future in futures.items():
+        remaining = max(0, started + timeout - time.time())
+        try:
+            results[name] = future.result(remaining)
+        except Exception:
+            logger.exception('Query %s failed or timed out, using fallback', name)
+            future.cancel()
+            results[name] = queries[name][1]
+    return results
+
+
+def cooperative():
+    """Whether sockets are gevent's, so a waiting stream costs a greenlet and not a thread."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def native_thread_pool(max_workers):
+    """A pool of operating system threads for CPU-bound work such as bcrypt and
+    resizing images. Under gevent a ThreadPoolExecutor's threads are greenlets, so
+    its work would run on the event loop and stall every other request until it
+    finished; gevent's own thread pool runs it on real threads instead."""
+    if cooperative():
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers)
@@ -0,0 +1,41 @@
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+import os
+
+from .cache import Cache
+from . import metrics
+
+# Rendered cards kept per process, and how long one is kept in seconds. Keys change
+# whenever what a card shows changes, so the TTL only bounds how long stale cards
+# take up room.
+FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 4096))
+FRAGMENT_CACHE_TTL = float(os.environ.get('FRAGMENT_CACHE_TTL', 3600))
+# Where compiled templates are kept between starts. Defaults to a directory in
+# the system's temporary directory.
+TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR') or None
+
+fragments = Cache(maxsize=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL)
+
+
+def fragment(name, *key, caller=None):
+    """Renders the body of a {% call fragment(name, key...) %} block once per key
+    and serves it from fragments after that. The key must identify everything
+    the body shows, e.g. a question's id and update_timestamp, so a change makes
+    a new key instead of needing an invalidation. A body with a missing key part
+    is rendered every time."""
+    if any(part is None for part in key):
+        return caller()
+    found, html = fragments.get((name,) + key)
+    metrics.FRAGMENT_LOOKUPS.inc(1, name, 'hit' if found else 'miss')
+    if not found:
+        html = str(caller())
+        fragments.set((name,) + key, html)
+    return Markup(html)
+
+
+def bytecode_cache():
+    """A Jinja bytecode cache on disk, so a new worker loads compiled templates
+    instead of compiling them again."""
+    if TEMPLATE_CACHE_DIR is not None and not os.path.isdir(TEMPLATE_CACHE_DIR):
+        os.makedirs(TEMPLATE_CACHE_DIR)
+    return FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
@@ -0,0 +1,72 @@
+from flask import g, has_app_context
+import threading
+
+# The identity map lent to a thread that runs part of a request; see attached.
+local = threading.local()
+
+
+class IdentityMap:
+    """Holds every node loaded during one request, keyed by label and unique
+    property, so the same User, Question or Answer is fetched at most once per
+    request no matter how many model calls ask for it. Users are held as their
+    nodes, questions and answers as the rows get_question and get_answers read
+    them in, with their author and tags."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.loads = 0
+        self.avoided = 0
+        self.lock = threading.Lock()
+
+    def get(self, label, key, value, loader):
+        """Returns the node with label and key=value, calling loader to fetch it
+        the first time it is asked for. Missing nodes are not remembered. The map
+        may be shared by the threads of one request; the loader runs without the
+        lock, so two of them can both load a node neither had yet."""
+        identity = (label, key, value)
+        with self.lock:
+            if identity in self.nodes:
+                self.avoided += 1
+                return self.nodes[identity]
+            self.loads += 1
+        node = loader()
+        if node is not None:
+            with self.lock:
+                self.nodes[identity] = node
+        return node
+
+    def forget(self, label, key, value):
+        """Drops a node whose properties were just written, so the next lookup
+        reads it again."""
+        with self.lock:
+            self.nodes.pop((label, key, value), None)
+
+
+def current_identity_map():
+    """Returns the identity map of the current request, creating it on first use.
+    Outside of a request there is no map and None is returned, except on a thread
+    running a function wrapped by attached."""
+    identity_map = getattr(local, 'identity_map', None)
+    if identity_map is not None:
+        return identity_map
+    if not has_app_context():
+        return None
+    identity_map = getattr(g, 'identity_map', None)
+    if identity_map is None:
+        identity_map = g.identity_map = IdentityMap()
+    return identity_map
+
+
+def attached(function):
+    """Wraps function so it uses the identity map of the request that wrapped it,
+    even when it is called on another thread, where there is no request."""
+    identity_map = current_identity_map()
+
+    def run():
+        previous = getattr(local, 'identity_map', None)
+        local.identity_map = identity_map
+        try:
+            return function()
+        finally:
+            local.identity_map = previous
+    return run
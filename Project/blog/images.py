@@ -0,0 +1,136 @@
+import hashlib
+import logging
+import os
+import tempfile
+import time
+
+from .executor import native_thread_pool
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = set(['jpg', 'jpeg', 'png', 'gif'])
+MAX_IMAGE_BYTES = int(os.environ.get('MAX_IMAGE_BYTES', 5 * 1024 * 1024))
+CHUNK_SIZE = 64 * 1024
+
+# Sizes the pictures are displayed at, as (width, height). profile.html shows
+# profile pictures at 90x100.
+DISPLAY_SIZES = {
+    'profile': (90, 100),
+}
+
+# Files with these prefixes ship with the app and are never cleaned up.
+BUILTIN_PREFIXES = ('default',)
+
+# Resizing holds the CPU, so it runs on real threads even under gevent.
+resizer = native_thread_pool(int(os.environ.get('IMAGE_WORKERS', 2)))
+
+
+class ImageTooLarge(Exception):
+    """Raised when an upload is bigger than MAX_IMAGE_BYTES."""
+
+
+def store_upload(stream, extension, folder):
+    """Streams an upload to folder in chunks, stopping once it passes
+    MAX_IMAGE_BYTES, and stores it as <sha256>.<extension>. The name changes
+    whenever the content does, so it can be cached forever. The display sizes
+    are made in the background. Returns the stored file name."""
+    digest = hashlib.sha256()
+    size = 0
+    handle, temporary = tempfile.mkstemp(dir=folder, suffix='.upload')
+    try:
+        with os.fdopen(handle, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise ImageTooLarge()
+                digest.update(chunk)
+                out.write(chunk)
+        name = digest.hexdigest() + '.' + extension
+        os.replace(temporary, os.path.join(folder, name))
+    except Exception:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    resizer.submit(make_derivatives, folder, name)
+    return name
+
+
+def derivative_name(name, size):
+    """The file name of name resized to size, e.g. <sha256>-90x100.jpg."""
+    return '%s-%dx%d.jpg' % (name.rsplit('.', 1)[0], size[0], size[1])
+
+
+def make_derivatives(folder, name):
+    """Writes every DISPLAY_SIZES version of the image that does not exist yet.
+    Does nothing if Pillow is not installed; the original is shown instead."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return
+    try:
+        image = Image.open(os.path.join(folder, name))
+        for size in DISPLAY_SIZES.values():
+            path = os.path.join(folder, derivative_name(name, size))
+            if os.path.exists(path):
+                continue
+            resized = ImageOps.fit(image.convert('RGB'), size, Image.ANTIALIAS)
+            handle, temporary = tempfile.mkstemp(dir=folder, suffix='.upload')
+            with os.fdopen(handle, 'wb') as out:
+                resized.save(out, 'JPEG', quality=85, optimize=True)
+            os.replace(temporary, path)
+    except Exception:
+        logger.exception('Could not resize %s', name)
+
+
+def display_name(folder, name, display):
+    """The file to show for image name at one of DISPLAY_SIZES: the resized version
+    once it exists, the original until then."""
+    if is_builtin(name):
+        return name
+    resized = derivative_name(name, DISPLAY_SIZES[display])
+    if os.path.exists(os.path.join(folder, resized)):
+        return resized
+    return name
+
+
+def is_builtin(name):
+    return name.startswith(BUILTIN_PREFIXES)
+
+
+def is_content_addressed(name):
+    """True for names made by store_upload or derivative_name, whose content
+    never changes."""
+    digest = name.split('.', 1)[0].split('-', 1)[0]
+    return len(digest) == 64 and all(c in '0123456789abcdef' for c in digest)
+
+
+def is_removable(name):
+    """True for the files store_upload and make_derivatives write: content
+    addressed images and their temporary files. Anything else in the folder,
+    such as the pictures that ship with the app, is never cleaned up."""
+    return is_content_addressed(name) or name.endswith('.upload')
+
+
+def clean_orphans(folder, referenced, grace=3600):
+    """Removes uploaded images and their resized versions that no user refers to
+    any more, and temporary files left by failed uploads. Files younger than grace
+    seconds are kept, so uploads that are being stored right now are not removed.
+    Returns the removed file names."""
+    keep = set()
+    for name in referenced:
+        keep.add(name)
+        keep.update(derivative_name(name, size) for size in DISPLAY_SIZES.values())
+    removed = []
+    now = time.time()
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name in keep or not is_removable(name):
+            continue
+        if now - os.path.getmtime(path) < grace:
+            continue
+        os.remove(path)
+        removed.append(name)
+    return removed
@@ -0,0 +1,185 @@
+from collections import deque
+import json
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+from .executor import cooperative
+
+logger = logging.getLogger(__name__)
+
+# Open streams one process serves before turning more away. Under gevent every
+# stream is a greenlet and the default is GEVENT_MAX_STREAMS, which leaves some of
+# gunicorn's WEB_CONNECTIONS for other requests; otherwise each stream holds a
+# server thread, so by default none are served.
+LIVE_MAX_STREAMS = int(os.environ.get('LIVE_MAX_STREAMS', 0)) or None
+GEVENT_MAX_STREAMS = 4000
+# Events a stream holds for a client that is not reading. One that falls further
+# behind is told to reload the page instead.
+LIVE_QUEUE_SIZE = int(os.environ.get('LIVE_QUEUE_SIZE', 100))
+# Seconds between keep-alive comments, which also find closed connections.
+LIVE_HEARTBEAT = float(os.environ.get('LIVE_HEARTBEAT', 15))
+# Seconds a stream stays open. The browser reconnects and carries on from the last
+# event it got, so streams do not hold up restarts.
+LIVE_STREAM_SECONDS = float(os.environ.get('LIVE_STREAM_SECONDS', 300))
+# Seconds between looking for changes made by other processes.
+LIVE_POLL_INTERVAL = float(os.environ.get('LIVE_POLL_INTERVAL', 2))
+
+
+class Subscription:
+    """The events for one open stream, in a queue of at most size. Changes from
+    before since, which the client has seen already, are left out, and so is
+    data the stream was already given for the same event and key."""
+
+    def __init__(self, topic, size, since=None):
+        self.topic = topic
+        self.events = deque()
+        self.size = size
+        self.since = since
+        self.sent = {}
+        self.overflowed = False
+        self.ready = threading.Event()
+
+    def put(self, event, key, data, at):
+        if self.since is not None and at <= self.since:
+            return
+        if self.sent.get((event, key)) == data:
+            return
+        self.sent[(event, key)] = data
+        if len(self.events) >= self.size:
+            self.overflowed = True
+        else:
+            self.events.append((event, data, at))
+        self.ready.set()
+
+    def take(self, timeout):
+        """Waits up to timeout seconds for events and returns them, oldest first.
+        Returns None if events were dropped because the client fell behind."""
+        self.ready.wait(timeout)
+        self.ready.clear()
+        if self.overflowed:
+            return None
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
+
+
+class LiveHub:
+    """An in-process publish/subscribe hub for changes to questions. Writers
+    publish (event, key, data) on a question's topic and every subscription to it
+    gets a copy. Changes made through other processes are found by changes(topics, since),
+    which a poller calls every poll_interval seconds for the topics with
+    subscribers. It returns (topic, event, key, data, time) tuples, with times
+    as given by clock."""
+
+    def __init__(self, changes, clock=time.time, max_streams=None, queue_size=100, poll_interval=2.0):
+        self.changes = changes
+        self.clock = clock
+        self.max_streams = max_streams
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.topics = {}
+        self.streams = 0
+        self.lock = threading.Lock()
+        self.poller = None
+
+    def subscribe(self, topic, since=None):
+        """Opens a subscription to topic, or returns None if the process already
+        serves max_streams. With since, changes made after that time are queued
+        for it straight away."""
+        limit = self.max_streams
+        if limit is None:
+            limit = GEVENT_MAX_STREAMS if cooperative() else 0
+        with self.lock:
+            if self.streams >= limit:
+                metrics.LIVE_STREAMS.inc(1, 'rejected')
+                return None
+            self.streams += 1
+            subscription = Subscription(topic, self.queue_size, since)
+            self.topics.setdefault(topic, set()).add(subscription)
+            self._start_poller()
+        metrics.LIVE_STREAMS.inc(1, 'opened')
+        if since is not None:
+            try:
+                for _, event, key, data, at in self.changes([topic], since):
+                    subscription.put(event, key, data, at)
+            except Exception:
+                self.unsubscribe(subscription)
+                raise
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.topics.get(subscription.topic)
+            if subscribers is None or subscription not in subscribers:
+                return
+            self.streams -= 1
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.topics[subscription.topic]
+
+    def publish(self, topic, event, key, data, at=None):
+        """Hands data to every subscription to topic. Costs nothing if no one is
+        subscribed."""
+        with self.lock:
+            subscribers = list(self.topics.get(topic, ()))
+        if not subscribers:
+            return
+        metrics.LIVE_EVENTS.inc(1, event)
+        at = at if at is not None else self.clock()
+        for subscription in subscribers:
+            subscription.put(event, key, data, at)
+
+    def poll(self, since):
+        """Publishes the changes made since then to the topics with subscribers."""
+        with self.lock:
+            topics = list(self.topics)
+        if not topics:
+            return
+        for topic, event, key, data, at in self.changes(topics, since):
+            self.publish(topic, event, key, data, at)
+
+    def _start_poller(self):
+        """Starts the poller on the first subscription. Call with the lock held."""
+        if self.poller is not None:
+            return
+        self.poller = threading.Thread(target=self._run_poller, name='live-poller')
+        self.poller.daemon = True
+        self.poller.start()
+
+    def _run_poller(self):
+        since = self.clock()
+        while True:
+            time.sleep(self.poll_interval)
+            started = self.clock()
+            try:
+                # Looks back one more interval for transactions that were still
+                # open last time; the subscriptions skip what they already have.
+                self.poll(since - self.poll_interval)
+                since = started
+            except Exception:
+                logger.exception('Polling for live updates failed')
+
+
+def server_sent_events(hub, subscription, heartbeat=LIVE_HEARTBEAT, seconds=LIVE_STREAM_SECONDS):
+    """Yields a subscription's events in the text/event-stream format, each with
+    its time as the id the browser sends back as Last-Event-ID when it
+    reconnects. Ends after seconds, or with a reload event if the client fell
+    behind."""
+    ends = time.time() + seconds
+    try:
+        yield 'retry: 2000\n\n'
+        while time.time() < ends:
+            events = subscription.take(min(heartbeat, max(0, ends - time.time())))
+            if events is None:
+                yield 'event: reload\ndata: {}\n\n'
+                return
+            if not events:
+                yield ': keep-alive\n\n'
+            for event, data, at in events:
+                yield 'id: %r\nevent: %s\ndata: %s\n\n' % (at, event, json.dumps(data))
+    finally:
+        hub.unsubscribe(subscription)
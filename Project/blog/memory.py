@@ -0,0 +1,1191 @@
+import atexit
+import bisect
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+from . import queries
+from .schema import CONSTRAINTS, INDEXES
+from .tags import names_of
+
+FIND_ONE = re.compile(r'^MATCH \(n:(\w+)\) WHERE n\.(\w+) = \{value\} RETURN n LIMIT 1$')
+
+# Schema statements are accepted and ignored: the indexes of a MemoryGraph are
+# fixed by CONSTRAINTS and INDEXES.
+IGNORED = ('CREATE INDEX', 'CREATE CONSTRAINT', 'DROP INDEX', 'DROP CONSTRAINT')
+
+MISSING = object()
+
+
+class ConstraintViolation(Exception):
+    """Raised when a write would give two nodes the same value of a unique key."""
+
+
+class UnsupportedStatement(Exception):
+    """Raised for a statement the memory backend has no handler for."""
+
+
+class Node:
+    __slots__ = ('id', 'labels', 'props')
+
+    def __init__(self, id, labels, props):
+        self.id = id
+        self.labels = set(labels)
+        self.props = props
+
+    def __getitem__(self, key):
+        return self.props.get(key)
+
+
+class Index:
+    """The nodes of one label by the value of one property, with the values also
+    kept sorted for prefix and range scans."""
+
+    def __init__(self, unique):
+        self.unique = unique
+        self.entries = {}
+        self.keys = []
+
+    def check(self, value, id):
+        if self.unique and value is not None and self.entries.get(value, set()) - set([id]):
+            raise ConstraintViolation(value)
+
+    def add(self, value, id):
+        if value is None:
+            return
+        self.check(value, id)
+        ids = self.entries.get(value)
+        if ids is None:
+            ids = self.entries[value] = set()
+            bisect.insort(self.keys, value)
+        ids.add(id)
+
+    def remove(self, value, id):
+        ids = self.entries.get(value)
+        if ids is None:
+            return
+        ids.discard(id)
+        if not ids:
+            del self.entries[value]
+            del self.keys[bisect.bisect_left(self.keys, value)]
+
+    def get(self, value):
+        return self.entries.get(value, ())
+
+    def starting_with(self, prefix):
+        """The values starting with prefix, in order."""
+        for value in self.keys[bisect.bisect_left(self.keys, prefix):]:
+            if not value.startswith(prefix):
+                break
+            yield value
+
+    def after(self, value):
+        """The values greater than value, in order."""
+        return self.keys[bisect.bisect_right(self.keys, value):]
+
+
+class MemoryGraph:
+    """Nodes with labels and properties, and relationships kept as adjacency maps
+    in both directions: outgoing[node][type][other] and incoming[other][type][node]
+    hold the same property dict. There is at most one relationship of a type
+    between two nodes, which is all the statements in queries.py ever create.
+    While a transaction is open every change records how to undo it."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.next_id = 0
+        self.by_label = defaultdict(dict)
+        self.outgoing = defaultdict(lambda: defaultdict(dict))
+        self.incoming = defaultdict(lambda: defaultdict(dict))
+        self.indexes = {}
+        for label, key in CONSTRAINTS:
+            self.indexes[(label, key)] = Index(unique=True)
+        for label, key in INDEXES:
+            self.indexes[(label, key)] = Index(unique=False)
+        self.journal = None
+
+    def _record(self, undo):
+        if self.journal is not None:
+            self.journal.append(undo)
+
+    def begin(self):
+        self.journal = []
+
+    def commit(self):
+        self.journal = None
+
+    def rollback(self):
+        journal, self.journal = self.journal or [], None
+        for undo in reversed(journal):
+            undo()
+
+    # Nodes
+
+    def create(self, label, props, id=None):
+        if id is None:
+            id = self.next_id
+        self.next_id = max(self.next_id, id + 1)
+        labels = [label] if isinstance(label, str) else label
+        props = dict((k, v) for k, v in props.items() if v is not None)
+        for name in labels:
+            for key, value in props.items():
+                if (name, key) in self.indexes:
+                    self.indexes[(name, key)].check(value, id)
+        node = Node(id, labels, props)
+        self._insert(node)
+        return node
+
+    def _insert(self, node):
+        self.nodes[node.id] = node
+        for name in node.labels:
+            self.by_label[name][node.id] = node
+            for key, value in node.props.items():
+                if (name, key) in self.indexes:
+                    self.indexes[(name, key)].add(value, node.id)
+        self._record(lambda: self.delete(node))
+
+    def delete(self, node):
+        """Deletes a node and all of its relationships."""
+        for type, others in list(self.outgoing[node.id].items()):
+            for other in list(others):
+                self.unrelate(node, type, self.nodes[other])
+        for type, others in list(self.incoming[node.id].items()):
+            for other in list(others):
+                self.unrelate(self.nodes[other], type, node)
+        for name in node.labels:
+            del self.by_label[name][node.id]
+            for key, value in node.props.items():
+                if (name, key) in self.indexes:
+                    self.indexes[(name, key)].remove(value, node.id)
+        del self.nodes[node.id]
+        self.outgoing.pop(node.id, None)
+        self.incoming.pop(node.id, None)
+        self._record(lambda: self._insert(node))
+
+    def set(self, node, key, value):
+        """Sets one property. Setting None removes it, as in Cypher."""
+        old = node.props.get(key)
+        if old == value:
+            return
+        for name in node.labels:
+            if (name, key) in self.indexes:
+                self.indexes[(name, key)].check(value, node.id)
+        for name in node.labels:
+            if (name, key) in self.indexes:
+                self.indexes[(name, key)].remove(old, node.id)
+                self.indexes[(name, key)].add(value, node.id)
+        if value is None:
+            node.props.pop(key, None)
+        else:
+            node.props[key] = value
+        self._record(lambda: self.set(node, key, old))
+
+    def find(self, label, key, value):
+        """The first node with label and key=value, or None."""
+        for node in self.lookup(label, key, value):
+            return node
+        return None
+
+    def lookup(self, label, key, value):
+        """The nodes with label and key=value, through an index when there is one."""
+        index = self.indexes.get((label, key))
+        if index is not None:
+            return [self.nodes[id] for id in sorted(index.get(value))]
+        return [node for node in self.by_label[label].values() if node.props.get(key) == value]
+
+    def merge(self, label, key, value):
+        """Returns the node with label and key=value and whether it was created."""
+        node = self.find(label, key, value)
+        if node is not None:
+            return node, False
+        return self.create(label, {key: value}), True
+
+    def label(self, label):
+        return list(self.by_label[label].values())
+
+    # Relationships
+
+    def relationship(self, start, type, end):
+        """The properties of the relationship, or None if there is none."""
+        return self.outgoing[start.id][type].get(end.id)
+
+    def relate(self, start, type, end, props=None):
+        """MERGEs a relationship. Returns its properties and whether it was created."""
+        existing = self.relationship(start, type, end)
+        if existing is not None:
+            return existing, False
+        props = dict(props or {})
+        self.outgoing[start.id][type][end.id] = props
+        self.incoming[end.id][type][start.id] = props
+        self._record(lambda: self.unrelate(start, type, end))
+        return props, True
+
+    def unrelate(self, start, type, end):
+        props = self.outgoing[start.id][type].pop(end.id, None)
+        if props is None:
+            return
+        del self.incoming[end.id][type][start.id]
+        self._record(lambda: self.relate(start, type, end, props))
+
+    def set_relationship(self, props, key, value):
+        old = props.get(key, MISSING)
+        props[key] = value
+        self._record(lambda: props.pop(key) if old is MISSING else props.__setitem__(key, old))
+
+    def out(self, node, type, label=None):
+        """The nodes node has a relationship of type to, optionally with label."""
+        return self._neighbours(self.outgoing[node.id][type], label)
+
+    def into(self, node, type, label=None):
+        """The nodes that have a relationship of type to node, optionally with label."""
+        return self._neighbours(self.incoming[node.id][type], label)
+
+    def _neighbours(self, ids, label):
+        nodes = [self.nodes[id] for id in ids]
+        if label is None:
+            return nodes
+        return [node for node in nodes if label in node.labels]
+
+    # Snapshots
+
+    def save(self, path):
+        """Writes every node and relationship to path as JSON lines."""
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as out:
+            for node in self.nodes.values():
+                out.write(json.dumps({"id": node.id, "labels": sorted(node.labels), "properties": node.props}) + '\n')
+            for start, types in self.outgoing.items():
+                for type, ends in types.items():
+                    for end, props in ends.items():
+                        out.write(json.dumps({"start": start, "type": type, "end": end, "properties": props}) + '\n')
+        os.replace(temporary, path)
+
+    def load(self, rows):
+        """Adds nodes ({"id", "labels", "properties"}) and then relationships
+        ({"start", "type", "end", "properties"}) from rows, as written by save or
+        read from Neo4j with ALL_NODES and ALL_RELATIONSHIPS."""
+        ids = {}
+        relationships = []
+        for row in rows:
+            if 'labels' in row:
+                ids[row['id']] = self.create(row['labels'], row['properties'])
+            else:
+                relationships.append(row)
+        for row in relationships:
+            self.relate(ids[row['start']], row['type'], ids[row['end']], row['properties'])
+
+
+# Handlers, by the name of the statement in queries.py. Each takes the graph and
+# the parameters and returns the records the statement would return.
+HANDLERS = {}
+
+
+def handles(name):
+    def register(function):
+        HANDLERS[name] = function
+        return function
+    return register
+
+
+def user(graph, username):
+    return graph.find('User', 'username', username)
+
+
+def question_row(graph, question):
+    """The {"username", "question", "tags"} row of a question, or None if it has
+    no publisher, which the MATCH in every such query requires. Tags are
+    OPTIONAL MATCHed, so a question without any has an empty list."""
+    tags = [tag['name'] for tag in graph.into(question, 'TAGGED', 'Tag')]
+    publishers = graph.into(question, 'PUBLISHED', 'User')
+    if not publishers:
+        return None
+    return {"username": publishers[0]['username'], "question": dict(question.props), "tags": tags}
+
+
+def question_rows(graph, questions):
+    rows = [question_row(graph, question) for question in questions]
+    return [row for row in rows if row is not None]
+
+
+def descending(value):
+    """A sort key putting values in Cypher's DESC order, where null comes first."""
+    return (1, 0) if value is None else (0, value)
+
+
+@handles('CREATE_USER')
+def create_user(graph, p):
+    graph.create('User', p['user'])
+    return []
+
+
+def set_user_property(key, parameter):
+    def handler(graph, p):
+        node, _ = graph.merge('User', 'username', p['username'])
+        graph.set(node, key, p[parameter])
+        return []
+    return handler
+
+
+HANDLERS['SET_USER_PIC_URL'] = set_user_property('url', 'picurl')
+HANDLERS['SET_USER_BIO'] = set_user_property('bio', 'bio')
+HANDLERS['SET_USER_PASSWORD'] = set_user_property('password', 'password')
+
+
+def sharing_tags(graph, label, mask):
+    """The nodes with label whose tag_mask shares a tag with mask, through the
+    tag_mask index."""
+    index = graph.indexes[(label, 'tag_mask')]
+    return [graph.nodes[id] for value in index.keys if value & (mask or 0) for id in sorted(index.get(value))]
+
+
+@handles('ADD_USER_TAGS')
+def add_user_tags(graph, p):
+    node = user(graph, p['username'])
+    if node is not None:
+        graph.set(node, 'tag_mask', (node['tag_mask'] or 0) | p['mask'])
+        for name in p['tags']:
+            tag, _ = graph.merge('Tag', 'name', name)
+            graph.relate(tag, 'TAGGED', node)
+    return []
+
+
+@handles('REMOVE_USER_TAGS')
+def remove_user_tags(graph, p):
+    node = user(graph, p['username'])
+    if node is not None:
+        graph.set(node, 'tag_mask', 0)
+        for tag in graph.into(node, 'TAGGED', 'Tag'):
+            graph.unrelate(tag, 'TAGGED', node)
+        for tag in graph.out(node, 'TAGGED', 'Tag'):
+            graph.unrelate(node, 'TAGGED', tag)
+    return []
+
+
+@handles('CREATE_QUESTION')
+def create_question(graph, p):
+    node = user(graph, p['username'])
+    if node is not None:
+        question = graph.create('Question', p['question'])
+        graph.relate(node, 'PUBLISHED', question)
+        for name in p['tags']:
+            tag, _ = graph.merge('Tag', 'name', name)
+            graph.relate(tag, 'TAGGED', question)
+    return []
+
+
+@handles('CREATE_ANSWER')
+def create_answer(graph, p):
+    node = user(graph, p['username'])
+    question = graph.find('Question', 'id', p['question_id'])
+    if node is not None and question is not None:
+        answer = graph.create('Answer', p['answer'])
+        graph.relate(node, 'PUBLISHED', answer)
+        graph.relate(answer, 'ANSWERED', question)
+        graph.set(question, 'answer_count', (question['answer_count'] or 0) + 1)
+        graph.set(question, 'last_answerer', node['username'])
+        graph.set(question, 'last_activity', answer['timestamp'])
+        graph.set(question, 'update_timestamp', answer['timestamp'])
+        graph.set(question, 'update_date', answer['date'])
+    return []
+
+
+@handles('FOLLOW_USER')
+def follow_user(graph, p):
+    me, him = user(graph, p['me']), user(graph, p['him'])
+    if me is not None and him is not None:
+        graph.relate(me, 'FOLLOW', him)
+    return []
+
+
+@handles('BOOKMARK_QUESTION')
+def bookmark_question(graph, p):
+    node = user(graph, p['username'])
+    question = graph.find('Question', 'id', p['question_id'])
+    if node is not None and question is not None:
+        bookmark, created = graph.relate(node, 'BOOKMARK', question)
+        if created:
+            graph.set_relationship(bookmark, 'timestamp', p['timestamp'])
+            graph.set(question, 'bookmark_count', (question['bookmark_count'] or 0) + 1)
+            graph.set(question, 'last_activity', p['timestamp'])
+    return []
+
+
+@handles('UPVOTE_ANSWER')
+def upvote_answer(graph, p):
+    node = user(graph, p['username'])
+    answer = graph.find('Answer', 'id', p['answer_id'])
+    if node is None or answer is None:
+        return []
+    rows = []
+    for author in graph.into(answer, 'PUBLISHED', 'User'):
+        for question in graph.out(answer, 'ANSWERED', 'Question'):
+            vote, created = graph.relate(node, 'UPVOTE', answer)
+            if created:
+                graph.set_relationship(vote, 'timestamp', p['timestamp'])
+                graph.set(answer, 'upvote', (answer['upvote'] or 0) + 1)
+                graph.set(answer, 'last_vote', p['timestamp'])
+            rows.append({"question_id": question['id'], "username": author['username'],
+                         "upvote": answer['upvote'], "created": vote.get('timestamp') == p['timestamp']})
+    return rows
+
+
+@handles('COUNT_QUESTION_VOTES')
+def count_question_votes(graph, p):
+    for id in p['ids']:
+        for question in graph.lookup('Question', 'id', id):
+            answers = graph.into(question, 'ANSWERED', 'Answer')
+            graph.set(question, 'upvote', sum(answer['upvote'] or 0 for answer in answers))
+            graph.set(question, 'last_activity', latest(
+                [question['last_activity'] if question['last_activity'] is not None else question['timestamp']] +
+                [answer['last_vote'] for answer in answers]))
+    return []
+
+
+@handles('COUNT_USER_VOTES')
+def count_user_votes(graph, p):
+    for id in p['ids']:
+        for node in graph.lookup('User', 'username', id):
+            graph.set(node, 'upvote', sum(answer['upvote'] or 0 for answer in graph.out(node, 'PUBLISHED', 'Answer')))
+    return []
+
+
+@handles('USER_RECENT_QUESTIONS')
+def user_recent_questions(graph, p):
+    node = user(graph, p['username'])
+    if node is None:
+        return []
+    rows = question_rows(graph, graph.out(node, 'PUBLISHED', 'Question'))
+    rows.sort(key=lambda row: (descending(row['question'].get('date')),
+                               descending(row['question'].get('timestamp'))), reverse=True)
+    return rows[:5]
+
+
+@handles('TEST_FOLLOW')
+def test_follow(graph, p):
+    me, him = user(graph, p['me']), user(graph, p['him'])
+    follows = me is not None and him is not None and graph.relationship(me, 'FOLLOW', him) is not None
+    return [{"follows": follows}]
+
+
+def published_mask(graph, node):
+    mask = 0
+    for question in graph.out(node, 'PUBLISHED', 'Question'):
+        mask |= question['tag_mask'] or 0
+    return mask
+
+
+@handles('COMMONALITY_OF_USERS')
+def commonality_of_users(graph, p):
+    they, you = user(graph, p['they']), user(graph, p['you'])
+    if they is None or you is None:
+        return []
+    likes = sum(1 for question in graph.out(they, 'LIKED', 'Question')
+                if you in graph.into(question, 'PUBLISHED', 'User'))
+    return [{"likes": likes, "tags": names_of(published_mask(graph, they) & published_mask(graph, you))}]
+
+
+@handles('PUSH_TO_FEEDS')
+def push_to_feeds(graph, p):
+    question = graph.find('Question', 'id', p['question_id'])
+    if question is None:
+        return []
+    for author in graph.into(question, 'PUBLISHED', 'User'):
+        readers = dict((reader.id, reader) for reader in graph.into(author, 'FOLLOW', 'User'))
+        readers.update((reader.id, reader) for tag in graph.into(question, 'TAGGED', 'Tag')
+                       for reader in graph.out(tag, 'TAGGED', 'User'))
+        readers.pop(author.id, None)
+        for reader in readers.values():
+            graph.relate(reader, 'FEED', question)
+        for reader in readers.values():
+            feed = graph.out(reader, 'FEED', 'Question')
+            if len(feed) > p['feed_size'] + p['feed_slack']:
+                feed.sort(key=newest_first, reverse=True)
+                for old in feed[p['feed_size']:]:
+                    graph.unrelate(reader, 'FEED', old)
+    return []
+
+
+def newest_first(question):
+    updated = question['update_timestamp']
+    return descending(updated if updated is not None else question['timestamp'])
+
+
+@handles('ALL_PIC_URLS')
+def all_pic_urls(graph, p):
+    urls = []
+    for node in graph.label('User'):
+        if node['url'] not in urls:
+            urls.append(node['url'])
+    return [{"url": url} for url in urls]
+
+
+@handles('ALL_USERNAMES')
+def all_usernames(graph, p):
+    return [{"username": node['username']} for node in graph.label('User')]
+
+
+@handles('RECENT_QUESTIONS')
+def recent_questions(graph, p):
+    index = graph.indexes[('Question', 'created_ms')]
+    questions = []
+    for value in reversed(index.keys[bisect.bisect_left(index.keys, p['since']):]):
+        if len(questions) >= p['limit']:
+            break
+        questions.extend(graph.nodes[id] for id in sorted(index.get(value)))
+    return question_rows(graph, questions[:p['limit']])
+
+
+def backfill_created_ms(label):
+    def handler(graph, p):
+        nodes = [node for node in graph.label(label) if node['created_ms'] is None][:p['limit']]
+        for node in nodes:
+            graph.set(node, 'created_ms', int((node['timestamp'] or 0) * 1000))
+        return [{"updated": len(nodes)}]
+    return handler
+
+
+HANDLERS['BACKFILL_QUESTION_CREATED_MS'] = backfill_created_ms('Question')
+HANDLERS['BACKFILL_ANSWER_CREATED_MS'] = backfill_created_ms('Answer')
+
+
+def database_clock():
+    """What Cypher's timestamp() returns: milliseconds since the epoch."""
+    return int(time.time() * 1000)
+
+
+@handles('RECORD_INVALIDATION')
+def record_invalidation(graph, p):
+    graph.create('Invalidation', {"id": p['id'], "tags": list(p['tags']), "at": database_clock()})
+    return []
+
+
+@handles('INVALIDATIONS')
+def invalidations(graph, p):
+    index = graph.indexes[('Invalidation', 'at')]
+    found = [graph.nodes[id] for value in index.keys[bisect.bisect_left(index.keys, p['since']):]
+             for id in sorted(index.get(value))]
+    return [{"now": database_clock(), "ids": [node['id'] for node in found],
+             "tags": [node['tags'] for node in found]}]
+
+
+@handles('PRUNE_INVALIDATIONS')
+def prune_invalidations(graph, p):
+    index = graph.indexes[('Invalidation', 'at')]
+    old = [graph.nodes[id] for value in index.keys[:bisect.bisect_left(index.keys, p['before'])]
+           for id in sorted(index.get(value))][:p['limit']]
+    for node in old:
+        graph.delete(node)
+    return []
+
+
+@handles('QUESTION')
+def question(graph, p):
+    return question_rows(graph, graph.lookup('Question', 'id', p['question_id']))
+
+
+@handles('INDEX_FOR_SEARCH')
+def index_for_search(graph, p):
+    question = graph.find('Question', 'id', p['question_id'])
+    if question is None:
+        return []
+    for term in p['terms']:
+        node, created = graph.merge('Term', 'word', term['word'])
+        if created:
+            graph.set(node, 'df', 0)
+        relationship, created = graph.relate(node, 'INDEXES', question)
+        if created:
+            graph.set_relationship(relationship, 'tf', 0)
+            graph.set(node, 'df', node['df'] + 1)
+        graph.set_relationship(relationship, 'tf', relationship['tf'] + term['tf'])
+    return []
+
+
+@handles('SEARCH_QUESTIONS')
+def search_questions(graph, p):
+    found = {}
+    for word in p['words']:
+        for term in graph.lookup('Term', 'word', word):
+            for question_id, relationship in graph.outgoing[term.id]['INDEXES'].items():
+                question = graph.nodes[question_id]
+                if 'Question' not in question.labels:
+                    continue
+                matched, score = found.get(question_id, (0, 0.0))
+                found[question_id] = (matched + 1, score + relationship['tf'] / math.log(2.0 + term['df']))
+    ranked = sorted(found.items(), key=lambda item: (-item[1][0], -item[1][1], graph.nodes[item[0]]['id']))
+    rows = []
+    for question_id, (matched, score) in ranked[p['skip']:p['skip'] + p['limit']]:
+        row = question_row(graph, graph.nodes[question_id])
+        if row is not None:
+            row.update(matched=matched, score=score)
+            rows.append(row)
+    return rows
+
+
+@handles('SEARCH_USERS')
+def search_users(graph, p):
+    index = graph.indexes[('User', 'username_lower')]
+    rows = []
+    for value in index.starting_with(p['prefix']):
+        rows.extend({"username": graph.nodes[id]['username']} for id in sorted(index.get(value)))
+    return rows[p['skip']:p['skip'] + p['limit']]
+
+
+@handles('FILL_USERNAME_LOWER')
+def fill_username_lower(graph, p):
+    for node in graph.label('User'):
+        if node['username'] is not None:
+            graph.set(node, 'username_lower', node['username'].lower())
+    return []
+
+
+@handles('DELETE_SEARCH_TERMS')
+def delete_search_terms(graph, p):
+    terms = graph.label('Term')[:p['limit']]
+    for term in terms:
+        graph.delete(term)
+    return [{"deleted": len(terms)}]
+
+
+@handles('QUESTIONS_TO_INDEX')
+def questions_to_index(graph, p):
+    index = graph.indexes[('Question', 'id')]
+    rows = []
+    for value in index.after(p['after'])[:p['limit']]:
+        for id in index.get(value):
+            question = graph.nodes[id]
+            rows.append({"id": question['id'], "title": question['title'], "text": question['text'],
+                         "answers": [answer['text'] for answer in graph.into(question, 'ANSWERED', 'Answer')
+                                     if answer['text'] is not None]})
+    return rows
+
+
+def recommender_row(graph, node):
+    return {
+        "username": node['username'],
+        "upvote": node['upvote'],
+        "tags": node['tag_mask'] or 0,
+        "activity": [question['tag_mask'] for question in graph.out(node, 'PUBLISHED', 'Question')
+                     if question['tag_mask'] is not None],
+    }
+
+
+@handles('RECOMMENDER_USERS')
+def recommender_users(graph, p):
+    return [recommender_row(graph, node) for node in graph.label('User')]
+
+
+@handles('RECOMMENDER_USER')
+def recommender_user(graph, p):
+    return [recommender_row(graph, node) for node in graph.lookup('User', 'username', p['username'])]
+
+
+def follow_rows(graph, nodes):
+    return [{"username": node['username'], "follows": other['username']}
+            for node in nodes for other in graph.out(node, 'FOLLOW', 'User')]
+
+
+@handles('RECOMMENDER_FOLLOWS')
+def recommender_follows(graph, p):
+    return follow_rows(graph, graph.label('User'))
+
+
+@handles('RECOMMENDER_USER_FOLLOWS')
+def recommender_user_follows(graph, p):
+    return follow_rows(graph, graph.lookup('User', 'username', p['username']))
+
+
+@handles('ALL_NODES')
+def all_nodes(graph, p):
+    return [{"id": node.id, "labels": sorted(node.labels), "properties": dict(node.props)}
+            for node in graph.nodes.values()]
+
+
+@handles('ALL_RELATIONSHIPS')
+def all_relationships(graph, p):
+    return [{"start": start, "type": type, "end": end, "properties": dict(props)}
+            for start, types in graph.outgoing.items()
+            for type, ends in types.items()
+            for end, props in ends.items()]
+
+
+def merge_node(graph, label, key, props):
+    """MERGEs the node with label and props[key], setting upvote to 0 when it is
+    created, then sets props on it, as the IMPORT_ statements do."""
+    node, created = graph.merge(label, key, props[key])
+    if created:
+        graph.set(node, 'upvote', 0)
+    for name, value in props.items():
+        graph.set(node, name, value)
+    return node
+
+
+def tag_all(graph, names, node):
+    for name in names:
+        tag, _ = graph.merge('Tag', 'name', name)
+        graph.relate(tag, 'TAGGED', node)
+
+
+@handles('IMPORT_USERS')
+def import_users(graph, p):
+    for row in p['rows']:
+        node = merge_node(graph, 'User', 'username', row['user'])
+        graph.set(node, 'username_lower', node['username'].lower())
+        graph.set(node, 'tag_mask', (node['tag_mask'] or 0) | row['mask'])
+        tag_all(graph, row['tags'], node)
+    return []
+
+
+@handles('IMPORT_FOLLOWS')
+def import_follows(graph, p):
+    for row in p['rows']:
+        follow_user(graph, {"me": row['username'], "him": row['follows']})
+    return []
+
+
+@handles('IMPORT_QUESTIONS')
+def import_questions(graph, p):
+    for row in p['rows']:
+        node = user(graph, row['username'])
+        if node is not None:
+            question = merge_node(graph, 'Question', 'id', row['question'])
+            graph.set(question, 'tag_mask', (question['tag_mask'] or 0) | row['mask'])
+            graph.relate(node, 'PUBLISHED', question)
+            tag_all(graph, row['tags'], question)
+    return []
+
+
+@handles('IMPORT_ANSWERS')
+def import_answers(graph, p):
+    for row in p['rows']:
+        node = user(graph, row['username'])
+        question = graph.find('Question', 'id', row['question_id'])
+        if node is not None and question is not None:
+            answer = merge_node(graph, 'Answer', 'id', row['answer'])
+            graph.relate(node, 'PUBLISHED', answer)
+            graph.relate(answer, 'ANSWERED', question)
+    return []
+
+
+@handles('IMPORT_UPVOTES')
+def import_upvotes(graph, p):
+    for row in p['rows']:
+        node = user(graph, row['username'])
+        answer = graph.find('Answer', 'id', row['answer_id'])
+        if node is None or answer is None:
+            continue
+        for author in graph.into(answer, 'PUBLISHED', 'User'):
+            for question in graph.out(answer, 'ANSWERED', 'Question'):
+                vote, created = graph.relate(node, 'UPVOTE', answer)
+                if created:
+                    graph.set_relationship(vote, 'timestamp', row['timestamp'])
+                    for counted in (answer, question, author):
+                        graph.set(counted, 'upvote', (counted['upvote'] or 0) + 1)
+                    graph.set(answer, 'last_vote', latest([answer['last_vote'], row['timestamp']]))
+    return []
+
+
+@handles('IMPORT_BOOKMARKS')
+def import_bookmarks(graph, p):
+    for row in p['rows']:
+        bookmark_question(graph, row)
+    return []
+
+
+def live_questions(graph, p):
+    for question_id in p['question_ids']:
+        for question in graph.lookup('Question', 'id', question_id):
+            yield question
+
+
+@handles('LIVE_ANSWERS')
+def live_answers(graph, p):
+    return [{"question_id": question['id'], "answer": dict(answer.props), "username": author['username']}
+            for question in live_questions(graph, p)
+            for answer in graph.into(question, 'ANSWERED', 'Answer')
+            if answer['timestamp'] is not None and answer['timestamp'] > p['since']
+            for author in graph.into(answer, 'PUBLISHED', 'User')]
+
+
+@handles('LIVE_VOTES')
+def live_votes(graph, p):
+    rows = []
+    for question in live_questions(graph, p):
+        for answer in graph.into(question, 'ANSWERED', 'Answer'):
+            times = [graph.relationship(voter, 'UPVOTE', answer).get('timestamp')
+                     for voter in graph.into(answer, 'UPVOTE', 'User')]
+            times = [time for time in times if time is not None and time > p['since']]
+            if times:
+                rows.append({"question_id": question['id'], "answer_id": answer['id'],
+                             "upvote": answer['upvote'], "timestamp": max(times)})
+    return rows
+
+
+def latest(times):
+    times = [time for time in times if time is not None]
+    return max(times) if times else None
+
+
+@handles('REPAIR_QUESTION_SUMMARIES')
+def repair_question_summaries(graph, p):
+    questions = export_page(graph, 'Question', 'id', p)
+    for question in questions:
+        answers = [(answer, author) for answer in graph.into(question, 'ANSWERED', 'Answer')
+                   for author in graph.into(answer, 'PUBLISHED', 'User')]
+        answers.sort(key=lambda pair: descending(pair[0]['timestamp']), reverse=True)
+        for answer in graph.into(question, 'ANSWERED', 'Answer'):
+            graph.set(answer, 'last_vote', latest(graph.relationship(voter, 'UPVOTE', answer).get('timestamp')
+                                                  for voter in graph.into(answer, 'UPVOTE', 'User')))
+        answered = graph.into(question, 'ANSWERED', 'Answer')
+        bookmarks = [graph.relationship(reader, 'BOOKMARK', question).get('timestamp')
+                     for reader in graph.into(question, 'BOOKMARK', 'User')]
+        graph.set(question, 'answer_count', len(answers))
+        graph.set(question, 'last_answerer', answers[0][1]['username'] if answers else None)
+        graph.set(question, 'upvote', sum(answer['upvote'] or 0 for answer in answered))
+        graph.set(question, 'bookmark_count', len(bookmarks))
+        graph.set(question, 'last_activity', latest(
+            [question['timestamp'], latest(answer['timestamp'] for answer, _ in answers),
+             latest(answer['last_vote'] for answer in answered), latest(bookmarks)]))
+    return [{"id": question['id']} for question in questions]
+
+
+def tag_masks(label, key):
+    def handler(graph, p):
+        return [{"key": node[key], "mask": node['tag_mask'] or 0,
+                 "tags": [tag['name'] for tag in graph.into(node, 'TAGGED', 'Tag')]}
+                for node in export_page(graph, label, key, p)]
+    return handler
+
+
+def set_tag_masks(label, key):
+    def handler(graph, p):
+        for row in p['masks']:
+            for node in graph.lookup(label, key, row['key']):
+                graph.set(node, 'tag_mask', row['mask'])
+        return []
+    return handler
+
+
+HANDLERS['USER_TAG_MASKS'] = tag_masks('User', 'username')
+HANDLERS['QUESTION_TAG_MASKS'] = tag_masks('Question', 'id')
+HANDLERS['SET_USER_TAG_MASKS'] = set_tag_masks('User', 'username')
+HANDLERS['SET_QUESTION_TAG_MASKS'] = set_tag_masks('Question', 'id')
+
+
+def export_page(graph, label, key, p):
+    index = graph.indexes[(label, key)]
+    return [graph.nodes[id] for value in index.after(p['after'])[:p['limit']] for id in index.get(value)]
+
+
+@handles('EXPORT_USERS')
+def export_users(graph, p):
+    rows = []
+    for node in export_page(graph, 'User', 'username', p):
+        bookmarks = [{"question_id": question['id'],
+                      "timestamp": graph.relationship(node, 'BOOKMARK', question).get('timestamp')}
+                     for question in graph.out(node, 'BOOKMARK', 'Question')]
+        rows.append({"key": node['username'], "user": dict(node.props),
+                     "tags": [tag['name'] for tag in graph.into(node, 'TAGGED', 'Tag')],
+                     "follows": [other['username'] for other in graph.out(node, 'FOLLOW', 'User')],
+                     "bookmarks": bookmarks or [{"question_id": None, "timestamp": None}]})
+    return rows
+
+
+@handles('EXPORT_QUESTIONS')
+def export_questions(graph, p):
+    return [{"key": question['id'], "username": author['username'], "question": dict(question.props),
+             "tags": [tag['name'] for tag in graph.into(question, 'TAGGED', 'Tag')]}
+            for question in export_page(graph, 'Question', 'id', p)
+            for author in graph.into(question, 'PUBLISHED', 'User')]
+
+
+@handles('EXPORT_ANSWERS')
+def export_answers(graph, p):
+    rows = []
+    for answer in export_page(graph, 'Answer', 'id', p):
+        votes = [{"username": voter['username'],
+                  "timestamp": graph.relationship(voter, 'UPVOTE', answer).get('timestamp')}
+                 for voter in graph.into(answer, 'UPVOTE', 'User')]
+        for author in graph.into(answer, 'PUBLISHED', 'User'):
+            for question in graph.out(answer, 'ANSWERED', 'Question'):
+                rows.append({"key": answer['id'], "username": author['username'], "question_id": question['id'],
+                             "answer": dict(answer.props),
+                             "votes": votes or [{"username": None, "timestamp": None}]})
+    return rows
+
+
+# The questions each feed source finds for reader u, as in queries.FEED_SOURCES.
+
+def published_by(graph, users, u):
+    return [question for author in users if author is not u
+            for question in graph.out(author, 'PUBLISHED', 'Question')]
+
+
+def sharing_tags_with(graph, mask, u):
+    return [question for question in sharing_tags(graph, 'Question', mask)
+            if any(author is not u for author in graph.into(question, 'PUBLISHED', 'User'))]
+
+
+def union_mask(nodes):
+    mask = 0
+    for node in nodes:
+        mask |= node['tag_mask'] or 0
+    return mask
+
+
+FEED_SOURCES = {
+    'feed': lambda graph, u: graph.out(u, 'FEED', 'Question'),
+    'following': lambda graph, u: published_by(graph, graph.out(u, 'FOLLOW', 'User'), u),
+    'tags': lambda graph, u: sharing_tags_with(graph, u['tag_mask'], u),
+    'following_of_following': lambda graph, u: published_by(
+        graph, [other for followed in graph.out(u, 'FOLLOW', 'User')
+                for other in graph.out(followed, 'FOLLOW', 'User')], u),
+    'tags_of_following': lambda graph, u: sharing_tags_with(graph, union_mask(graph.out(u, 'FOLLOW', 'User')), u),
+}
+
+
+def feed_candidates(graph, u, sources):
+    candidates = {}
+    for source in sources:
+        for question in FEED_SOURCES[source](graph, u):
+            candidates[question.id] = question
+    return list(candidates.values())
+
+
+def keyset(items, after, p):
+    """One page of (key, id, item) triples, as cut and ordered by the queries
+    built for keyset pagination in queries.py."""
+    if after:
+        items = [(key, id, item) for key, id, item in items if key is not None and
+                 (key < p['after_key'] or (key == p['after_key'] and id < p['after_id']))]
+    items = sorted(items, key=lambda triple: (descending(triple[0]), descending(triple[1])), reverse=True)
+    return items[:p['limit']]
+
+
+def feed_handler(sources, sort, after):
+    key = queries.FEED_SORTS[sort]
+
+    def handler(graph, p):
+        u = user(graph, p['username'])
+        if u is None:
+            return []
+        questions = [(q[key], q['id'], q) for q in feed_candidates(graph, u, sources)]
+        return question_rows(graph, [q for _, _, q in keyset(questions, after, p)])
+    return handler
+
+
+def answers_handler(sort, after):
+    def handler(graph, p):
+        found = []
+        for question in graph.lookup('Question', 'id', p['question_id']):
+            for answer in graph.into(question, 'ANSWERED', 'Answer'):
+                key = (answer['upvote'] or 0) if sort == 'votes' else answer['timestamp']
+                for author in graph.into(answer, 'PUBLISHED', 'User'):
+                    found.append((key, answer['id'], (author, answer)))
+        return [{"username": author['username'], "answer": dict(answer.props), "key": key}
+                for key, _, (author, answer) in keyset(found, after, p)]
+    return handler
+
+
+def bookmarks_handler(after):
+    def handler(graph, p):
+        node = user(graph, p['username'])
+        if node is None:
+            return []
+        found = [(graph.relationship(node, 'BOOKMARK', question).get('timestamp', 0), question['id'], question)
+                 for question in graph.out(node, 'BOOKMARK', 'Question')]
+        rows = []
+        for key, _, question in keyset(found, after, p):
+            row = question_row(graph, question)
+            if row is not None:
+                row["key"] = key
+                rows.append(row)
+        return rows
+    return handler
+
+
+@handles('REBUILD_FEED')
+def rebuild_feed(graph, p):
+    u = user(graph, p['username'])
+    if u is None:
+        return []
+    for question in graph.out(u, 'FEED'):
+        graph.unrelate(u, 'FEED', question)
+    questions = list(feed_candidates(graph, u, ('following', 'tags')))
+    questions.sort(key=newest_first, reverse=True)
+    for question in questions[:p['feed_size']]:
+        graph.relate(u, 'FEED', question)
+    return []
+
+
+def statement_handlers():
+    """Maps the text of every statement in queries.py, and of every query built
+    for a feed, a page of answers or a page of bookmarks, to its handler."""
+    from .models import FEEDS
+    found = {}
+    for name, handler in HANDLERS.items():
+        found[normalize(getattr(queries, name))] = handler
+    for sources, sort in FEEDS.values():
+        for after in (False, True):
+            found[normalize(queries.feed_query(sources, sort, after))] = feed_handler(sources, sort, after)
+    for after in (False, True):
+        for sort in queries.ANSWER_SORTS:
+            found[normalize(queries.answers_query(sort, after))] = answers_handler(sort, after)
+        found[normalize(queries.bookmarks_query(after))] = bookmarks_handler(after)
+    return found
+
+
+def normalize(statement):
+    return ' '.join(statement.split())
+
+
+class MemoryBackend:
+    """Runs the statements in queries.py against a MemoryGraph in this process,
+    instead of sending them to Neo4j. Each statement is answered by a Python
+    handler written for it; anything else raises UnsupportedStatement. One lock
+    serializes transactions, and a failed transaction is undone. The graph lives
+    as long as the process; when path is given it is loaded from there at start
+    and saved there at exit. Every process has its own graph, so run a single
+    worker process with it."""
+
+    def __init__(self, path=None):
+        self.graph = MemoryGraph()
+        self.lock = threading.RLock()
+        self.handlers = None
+        self.path = path
+        if path and os.path.exists(path):
+            with open(path) as rows:
+                self.graph.load(json.loads(line) for line in rows if line.strip())
+        if path:
+            atexit.register(self.save)
+
+    def save(self):
+        with self.lock:
+            self.graph.save(self.path)
+
+    def execute(self, statement, parameters):
+        text = normalize(statement)
+        if text.upper().startswith(IGNORED) or text == 'CALL db.indexes()':
+            return []
+        if text == 'RETURN 1':
+            return [{"1": 1}]
+        lookup = FIND_ONE.match(text)
+        if lookup:
+            node = self.graph.find(lookup.group(1), lookup.group(2), parameters['value'])
+            return [{"n": dict(node.props)}] if node is not None else []
+        if self.handlers is None:
+            self.handlers = statement_handlers()
+        handler = self.handlers.get(text)
+        if handler is None:
+            raise UnsupportedStatement(text)
+        return handler(self.graph, parameters)
+
+    def autocommit(self, statement, parameters, readonly):
+        tx = self.open_transaction(readonly)
+        try:
+            records = self.run_in(tx, statement, parameters)
+        except Exception:
+            self.rollback(tx)
+            raise
+        self.commit(tx)
+        return records
+
+    def explain(self, statement, parameters):
+        return None
+
+    def open_transaction(self, readonly):
+        self.lock.acquire()
+        if self.graph.journal is not None:
+            # Nested in another transaction of this thread: that one owns the journal.
+            return False
+        self.graph.begin()
+        return True
+
+    def run_in(self, tx, statement, parameters):
+        return self.execute(statement, parameters)
+
+    def commit(self, tx):
+        if tx:
+            self.graph.commit()
+        self.lock.release()
+
+    def rollback(self, tx):
+        if tx:
+            self.graph.rollback()
+        self.lock.release()
+
+    def close(self):
+        pass
+
+
+# Read statements compared by check_parity, with the parameters to run them
+# with, made from a sample user, another user and a question.
+PARITY_READS = [
+    ('USER_RECENT_QUESTIONS', lambda s: {"username": s['user']}),
+    ('TEST_FOLLOW', lambda s: {"me": s['user'], "him": s['other']}),
+    ('COMMONALITY_OF_USERS', lambda s: {"they": s['other'], "you": s['user']}),
+    ('RECENT_QUESTIONS', lambda s: {"since": s['created_ms'], "limit": 10}),
+    ('QUESTION', lambda s: {"question_id": s['question']}),
+    ('SEARCH_QUESTIONS', lambda s: {"words": s['words'], "skip": 0, "limit": 10}),
+    ('SEARCH_USERS', lambda s: {"prefix": s['user'][:2].lower(), "skip": 0, "limit": 10}),
+    ('RECOMMENDER_USER', lambda s: {"username": s['user']}),
+    ('RECOMMENDER_USER_FOLLOWS', lambda s: {"username": s['user']}),
+    ('LIVE_ANSWERS', lambda s: {"question_ids": [s['question']], "since": 0}),
+    ('LIVE_VOTES', lambda s: {"question_ids": [s['question']], "since": 0}),
+]
+
+
+def canonical(records):
+    """Records in a form that can be compared across backends: lists that are
+    collected in no particular order are sorted, and so are the records."""
+    def value(v):
+        if isinstance(v, dict):
+            return dict((k, value(x)) for k, x in v.items())
+        if isinstance(v, list):
+            return sorted((value(x) for x in v), key=lambda x: json.dumps(x, sort_keys=True))
+        if isinstance(v, float):
+            return round(v, 6)
+        return v
+    return sorted((json.dumps(value(record), sort_keys=True) for record in records))
+
+
+def check_parity(database, samples=20):
+    """Copies the graph behind database into a MemoryBackend and runs every read
+    statement, and every feed, on both for up to samples users. Only reads are
+    compared, so the database is not changed. Returns a list of (name,
+    parameters) whose results differ."""
+    from .db import Database
+    from .models import FEEDS
+    memory = Database(MemoryBackend())
+    memory.backend.graph.load(database.read(queries.ALL_NODES).data() +
+                              database.read(queries.ALL_RELATIONSHIPS).data())
+    graph = memory.backend.graph
+    users = [node['username'] for node in graph.label('User')][:samples]
+    questions = [node for node in graph.label('Question')][:samples]
+    reads = [(name, getattr(queries, name), make) for name, make in PARITY_READS]
+    for feed, (sources, sort) in FEEDS.items():
+        reads.append(('FEED_%s' % feed.upper(), queries.feed_query(sources, sort),
+                      lambda s: {"username": s['user'], "limit": 10}))
+    for sort in queries.ANSWER_SORTS:
+        reads.append(('ANSWERS_%s' % sort.upper(), queries.answers_query(sort),
+                      lambda s: {"question_id": s['question'], "limit": 10}))
+    reads.append(('USER_BOOKMARKS', queries.bookmarks_query(), lambda s: {"username": s['user'], "limit": 10}))
+    failures = []
+    for i, username in enumerate(users):
+        question = questions[i % len(questions)] if questions else Node(-1, [], {})
+        sample = {
+            "user": username,
+            "other": users[(i + 1) % len(users)],
+            "question": question['id'] or '',
+            "created_ms": question['created_ms'] or 0,
+            "words": sorted(set((question['title'] or '').lower().split()))[:3],
+        }
+        for name, statement, make in reads:
+            parameters = make(sample)
+            expected = canonical(database.read(statement, parameters).data())
+            if canonical(memory.read(statement, parameters).data()) != expected:
+                failures.append((name, parameters))
+    return failures
@@ -0,0 +1,260 @@
+import bisect
+import json
+import logging
+import os
+import sys
+import threading
+
+# Statements taking at least this many milliseconds are written to the slow query log.
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+# Whether slow reads are run again with PROFILE and their plan logged too.
+SLOW_QUERY_PROFILE = os.environ.get('SLOW_QUERY_PROFILE', '0') == '1'
+
+# Upper bounds of the histogram buckets: seconds, and statements per request.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# Parameters that are never written to the slow query log.
+REDACTED = set(['password'])
+MAX_LOGGED_VALUE = 200
+
+# Frames from these files are skipped when finding the model function that ran a statement.
+INTERNAL_FILES = ('db.py', 'metrics.py', 'identity.py')
+
+slow_log = logging.getLogger('blog.slow_queries')
+
+
+def label_text(names, values):
+    if not names:
+        return ''
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """A Prometheus counter with labels."""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, label_text(self.labels, labels), value))
+        return lines
+
+
+class Histogram:
+    """A Prometheus histogram with labels and fixed buckets."""
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        names = self.labels + ('le',)
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                total = 0
+                for bound, count in zip(self.buckets, series["counts"]):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (self.name, label_text(names, labels + (bound,)), total))
+                lines.append('%s_bucket%s %d' % (self.name, label_text(names, labels + ('+Inf',)), series["count"]))
+                lines.append('%s_sum%s %s' % (self.name, label_text(self.labels, labels), series["sum"]))
+                lines.append('%s_count%s %d' % (self.name, label_text(self.labels, labels), series["count"]))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+QUERY_SECONDS = registry.add(Histogram(
+    'blog_db_query_seconds', 'Time taken by each statement.', ('query', 'function')))
+QUERY_ROWS = registry.add(Counter(
+    'blog_db_query_rows_total', 'Rows returned by each statement.', ('query', 'function')))
+QUERY_ERRORS = registry.add(Counter(
+    'blog_db_query_errors_total', 'Statements that raised.', ('query', 'function')))
+REQUEST_SECONDS = registry.add(Histogram(
+    'blog_http_request_seconds', 'Time taken by each request.', ('route', 'method', 'status')))
+REQUEST_DB_SECONDS = registry.add(Histogram(
+    'blog_http_request_db_seconds', 'Time spent running statements during each request.', ('route',)))
+REQUEST_QUERIES = registry.add(Histogram(
+    'blog_http_request_queries', 'Statements run during each request.', ('route',), COUNT_BUCKETS))
+FRAGMENT_LOOKUPS = registry.add(Counter(
+    'blog_fragment_cache_lookups_total', 'Rendered fragment lookups, by fragment and hit or miss.',
+    ('fragment', 'result')))
+LIVE_STREAMS = registry.add(Counter(
+    'blog_live_streams_total', 'Live update streams, by whether they were opened or turned away.', ('result',)))
+LIVE_EVENTS = registry.add(Counter(
+    'blog_live_events_total', 'Changes handed to live update streams, by event.', ('event',)))
+
+
+class RequestStats:
+    """The statements run on behalf of one request, from any thread."""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.queries += 1
+            self.seconds += seconds
+
+
+local = threading.local()
+
+
+def start_request():
+    local.stats = RequestStats()
+    return local.stats
+
+
+def end_request():
+    stats = getattr(local, 'stats', None)
+    local.stats = None
+    return stats
+
+
+def attributed(function):
+    """Wraps function so the statements it runs count towards the request that
+    wrapped it, even when it is called on another thread."""
+    stats = getattr(local, 'stats', None)
+
+    def run():
+        previous = getattr(local, 'stats', None)
+        local.stats = stats
+        try:
+            return function()
+        finally:
+            local.stats = previous
+    return run
+
+
+names = None
+
+
+def query_name(statement):
+    """The name of a statement in queries.py, or 'other'."""
+    global names
+    if names is None:
+        try:
+            from .schema import statements
+            found = dict((' '.join(text.split()), name) for name, text in statements().items())
+        except ImportError:
+            # The models are still being imported; try again on the next statement.
+            return 'other'
+        names = found
+    text = ' '.join(statement.split())
+    if text.startswith(('EXPLAIN ', 'PROFILE ')):
+        return 'plan'
+    if text.startswith('MATCH (n:') and text.endswith('RETURN n LIMIT 1'):
+        return 'FIND_ONE_' + text[len('MATCH (n:'):text.index(')')].upper()
+    return names.get(text, 'other')
+
+
+def calling_function():
+    """The name of the innermost function outside the database layer that is
+    running a statement, e.g. add_question."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        if not code.co_filename.endswith(INTERNAL_FILES) and not code.co_name.startswith('<'):
+            return code.co_name
+        frame = frame.f_back
+    return 'unknown'
+
+
+def loggable(parameters):
+    """Parameters as the slow query log writes them. REDACTED keys are hidden
+    however deep they are, also in the dicts of a list such as the users of a bulk
+    import, and long values are cut short."""
+    return dict((key, loggable_value(key, value)) for key, value in parameters.items())
+
+
+def loggable_value(key, value):
+    if key in REDACTED:
+        return '[redacted]'
+    if isinstance(value, dict):
+        return loggable(value)
+    if isinstance(value, (list, tuple)):
+        value = [loggable_value(None, item) for item in value]
+    if len(repr(value)) > MAX_LOGGED_VALUE:
+        return repr(value)[:MAX_LOGGED_VALUE] + '...'
+    return value
+
+
+def observe_query(statement, parameters, seconds, rows, failed=False, profile=None):
+    """Records one statement: its latency and rows by name and calling function,
+    towards the current request, and in the slow query log when it took at least
+    SLOW_QUERY_MS. profile, when given, returns the statement's PROFILE plan and
+    is only called for slow statements when SLOW_QUERY_PROFILE is set."""
+    name = query_name(statement)
+    function = calling_function()
+    QUERY_SECONDS.observe(seconds, name, function)
+    if failed:
+        QUERY_ERRORS.inc(1, name, function)
+    else:
+        QUERY_ROWS.inc(rows, name, function)
+    stats = getattr(local, 'stats', None)
+    if stats is not None:
+        stats.add(seconds)
+    if seconds * 1000 < SLOW_QUERY_MS:
+        return
+    entry = {"query": name, "function": function, "ms": round(seconds * 1000, 1), "rows": rows,
+             "parameters": loggable(parameters)}
+    if SLOW_QUERY_PROFILE and profile is not None:
+        try:
+            entry["plan"] = profile()
+        except Exception as error:
+            entry["plan"] = 'Could not profile: %s' % error
+    slow_log.warning(json.dumps(entry, sort_keys=True, default=str))
+
+
+def observe_request(route, method, status, seconds, stats):
+    REQUEST_SECONDS.observe(seconds, route, method, status)
+    if stats is not None:
+        REQUEST_DB_SECONDS.observe(stats.seconds, route)
+        REQUEST_QUERIES.observe(stats.queries, route)
@@ -1,80 +1,110 @@
-from py2neo import Graph, Node, Relationship
-from passlib.hash import bcrypt
 from datetime import datetime
 import os, random
 import uuid
-
-url = os.environ.get('GRAPHENEDB_URL', 'http://localhost:7474')
-username = os.environ.get('NEO4J_USERNAME')
-password = os.environ.get('NEO4J_PASSWORD')
-
-graph = Graph(url + '/db/data/', username=username, password=password)
+import base64, json
+from .cache import cache, InvalidationLog
+from .votes import VoteBuffer
+from .identity import current_identity_map
+from .db import connect
+from . import queries
+from .passwords import passwords
+from .search import term_weights, query_words, TITLE_WEIGHT, TEXT_WEIGHT, SEARCH_PAGE_SIZE
+from .recommend import Recommender
+from .recent import RecentQuestions, now_ms
+from .tags import mask_of
+from . import live
+
+# All access to Neo4j goes through this; see db.connect for the settings.
+graph = connect()
+
+def read_invalidations(since):
+    row = graph.read(queries.INVALIDATIONS, since=since).data()[0]
+    return row["now"], list(zip(row["ids"], row["tags"]))
+
+# Every process keeps its own cache, so with more than one they share what they
+# invalidate through the database. The memory backend serves a single process.
+if os.environ.get('CACHE_SHARED', '0' if os.environ.get('GRAPH_BACKEND') == 'memory' else '1') == '1':
+    cache.share(InvalidationLog(
+        write=lambda id, tags: graph.run(queries.RECORD_INVALIDATION, id=id, tags=tags),
+        read=read_invalidations,
+        prune=lambda before: graph.run(queries.PRUNE_INVALIDATIONS, before=before, limit=10000),
+        keep=float(os.environ.get('CACHE_SHARED_KEEP', 3600))
+    ))
+
+BOOKMARK_PAGE_SIZE = 10
+
+# Similar users and follow suggestions, kept in memory.
+recommender = Recommender(graph)
 
 class User:
     def __init__(self, username):
         self.username = username
 
+    def __eq__(self, other):
+        return isinstance(other, User) and other.username == self.username
+
+    def __hash__(self):
+        return hash(self.username)
+
     def find(self):
         """Finds the current User"""
-        user = graph.find_one('User', 'username', self.username)
-        return user
+        return find_node('User', 'username', self.username)
 
     def register(self, password):
         """Checks if the user already exists. If user exists, return False.
         If user does not exist, create user and return true."""
         if not self.find():
-            user = Node('User', username=self.username, password=bcrypt.encrypt(password), bio="Cool person!", upvote=0, url="default" + str(random.randint(0, 10)) + ".jpg")
-            graph.create(user)
+            user = dict(username=self.username, username_lower=self.username.lower(), password=passwords.hash(password), bio="Cool person!", upvote=0, tag_mask=0, url="default" + str(random.randint(0, 10)) + ".jpg")
+            graph.run(queries.CREATE_USER, user=user)
+            forget_node('User', 'username', self.username)
             return True
         else:
             return False
 
     def change_pic_url(self, saved_path):
         """Change the URL link to the user's profile picture."""
-        user = self.find()
-        graph.run("MERGE (n:User {username: {username}}) SET n.url = {picurl}",
+        graph.run(queries.SET_USER_PIC_URL,
         {"username": self.username, "picurl": saved_path})
+        forget_node('User', 'username', self.username)
+        cache.invalidate('pic:' + self.username)
 
+    @cache.memoize(lambda url, self: ['pic:' + self.username], ttl=600)
     def get_pic_url(self):
         """Gets the URL link to the user's profile picture."""
-        user = self.find()
-        query = '''
-	       MATCH (u:User)
-	       WHERE u.username = {username}
-	       RETURN u.url
-	    '''
-        pp_url = graph.run(query, username=self.username).data()
-        return pp_url[0]["u.url"]
+        return self.find()['url']
 
+    @cache.memoize(lambda bio, self: ['bio:' + self.username], ttl=600)
     def get_bio(self):
         """Gets the user's bio."""
-        user = self.find()
-        query = '''
-            MATCH (u:User)
-            WHERE u.username = {username}
-            RETURN u.bio
-        '''
-        user_bio = graph.run(query, username=self.username).data()
-        return user_bio[0]["u.bio"]
+        return self.find()['bio']
 
     def change_bio(self, new_bio):
         """Changes the user's bio."""
-        user = self.find()
-        graph.run("MERGE (n:User {username: {username}}) SET n.bio = {bio}",
+        graph.run(queries.SET_USER_BIO,
         {"username": self.username, "bio": new_bio})
+        forget_node('User', 'username', self.username)
+        cache.invalidate('bio:' + self.username)
 
     def change_password(self, password):
         """Changes the user's password, encrypting the password with bcrypt."""
-        user = self.find()
-        graph.run("MERGE (n:User {username: {username}}) SET n.password = {password}",
-        {"username": self.username, "password": bcrypt.encrypt(password)})
+        self.set_password_hash(passwords.hash(password))
 
+    def set_password_hash(self, hashed):
+        """Stores an already encrypted password."""
+        graph.run(queries.SET_USER_PASSWORD,
+        {"username": self.username, "password": hashed})
+        forget_node('User', 'username', self.username)
 
     def verify_password(self, password):
-        """Uses bcrypt to verify if the given String matches the user's password."""
+        """Uses bcrypt to verify if the given String matches the user's password.
+        If the password was encrypted with a different cost than the one now
+        configured, it is encrypted again and stored."""
         user = self.find()
         if user:
-            return bcrypt.verify(password, user['password'])
+            verified, new_hash = passwords.verify(password, user['password'])
+            if new_hash:
+                self.set_password_hash(new_hash)
+            return verified
         else:
             return False
 
@@ -82,33 +112,30 @@ class User:
 
     def addTags(self, tags):
         """Creates a relationship between the user and the given tags.
-        Tags are sent as a String, seperated with a " ", example "Tag1 Tag2"."""
-        user = self.find()
-        tags = [x.strip() for x in tags.lower().split(' ')]
-        for name in set(tags):
-            tag = Node('Tag', name=name)
-            graph.merge(tag)
-            rel = Relationship(tag, 'TAGGED', user)
-            graph.create(rel)
+        Tags are sent as a String, seperated with a " ", example "Tag1 Tag2".
+        All tags are merged and linked in one statement, in the same transaction
+        as the rebuild of the user's feed. The user's tag_mask gets their bits."""
+        names = split_tags(tags)
+        with graph.begin() as tx:
+            tx.run(queries.ADD_USER_TAGS, username=self.username, tags=names, mask=mask_of(names))
+            self.rebuild_feed(tx)
+        recommender.user_changed(self.username)
 
     def removeTags(self, tags):
-        """Removes all relationships the user has with any tags."""
-        user = self.find()
-        query = '''
-        MATCH (:Tag)-[r:TAGGED]-(user:User)
-        WHERE user.username = {username}
-        DELETE r
-        '''
-        graph.run(query, username=self.username)
+        """Removes all relationships the user has with any tags, and clears
+        their tag_mask."""
+        graph.run(queries.REMOVE_USER_TAGS, username=self.username)
+        self.rebuild_feed()
+        recommender.user_changed(self.username)
 
 
     def add_question(self, title, tags, text):
         """Creates a question, and then creates a relationship between the user
         and the question, where User - PUBLISHED -> Question. Then all the tags
-        are linked to the question as well."""
-        user = self.find()
-        question = Node(
-            'Question',
+        are linked to the question as well. The question, its tags and its feed
+        entries are written in a single transaction. Returns the question's id."""
+        names = split_tags(tags)
+        question = dict(
             id=str(uuid.uuid4()),
             title=title,
             text=text,
@@ -116,290 +143,428 @@ class User:
             date=date(),
             update_timestamp=timestamp(),
             update_date=date(),
-            upvote=0
+            created_ms=now_ms(),
+            upvote=0,
+            tag_mask=mask_of(names),
+            answer_count=0,
+            bookmark_count=0
         )
-        rel = Relationship(user, 'PUBLISHED', question)
-        graph.create(rel)
-        tags = [x.strip() for x in tags.lower().split(' ')]
-        for name in set(tags):
-            tag = Node('Tag', name=name)
-            graph.merge(tag)
-            rel = Relationship(tag, 'TAGGED', question)
-            graph.create(rel)
-
-    def update_question(self, question_id):
-        """Updates a timestamp inside the question with id=question_id. Used to
-        determine when last a question was modified."""
-        user = self.find()
-        graph.run("MERGE (n:Question {id: {question_id}}) SET n.update_timestamp = {timestamp}, n.update_date = {date}",
-        {"question_id": question_id, "timestamp": timestamp(), "date": date()})
+        question['last_activity'] = question['timestamp']
+        with graph.begin() as tx:
+            tx.run(queries.CREATE_QUESTION, username=self.username, question=question, tags=names)
+            push_to_feeds(question['id'], tx)
+            index_for_search(question['id'], [(title, TITLE_WEIGHT), (text, TEXT_WEIGHT)], tx)
+        recent_questions.add({"username": self.username, "question": dict(question), "tags": names})
+        recommender.user_changed(self.username)
+        return question['id']
 
     def add_answer(self, question_id, text):
         """Creates an Answer node, and relates it to the user. Then relates it to
-        the question with id=question_id."""
-        user = self.find()
-        answer = Node(
-            'Answer',
+        the question with id=question_id. The question's answer_count,
+        last_answerer, last_activity and update_timestamp are updated by the same
+        statement. Returns the answer's id."""
+        answer = dict(
             id=str(uuid.uuid4()),
             text=text,
             timestamp=timestamp(),
-            date=date()
+            date=date(),
+            created_ms=now_ms(),
+            upvote=0
         )
-        rel = Relationship(user, 'PUBLISHED', answer)
-        graph.create(rel)
-        question = graph.find_one('Question', 'id', question_id)
-        rel = Relationship(answer, 'ANSWERED', question)
-        graph.create(rel)
-        self.update_question(question_id)
+        with graph.begin() as tx:
+            tx.run(queries.CREATE_ANSWER, username=self.username, question_id=question_id, answer=answer)
+            push_to_feeds(question_id, tx)
+            index_for_search(question_id, [(text, TEXT_WEIGHT)], tx)
+        cache.invalidate('answers:' + question_id, 'question:' + question_id)
+        forget_node('Question', 'id', question_id)
+        live_updates.publish(question_id, 'answer', answer['id'], answer_event(self.username, answer),
+                             answer['timestamp'])
+        return answer['id']
 
     def follow_user(self, username_him):
         """Creates a one-way follow relationship between this user and another,
         with relation self - FOLLOW -> other."""
-        user_me=self.find()
-        user_him=do_search(username_him)
-        rel = Relationship(user_me, 'FOLLOW', user_him)
-        graph.create(rel)
+        with graph.begin() as tx:
+            tx.run(queries.FOLLOW_USER, me=self.username, him=username_him)
+            self.rebuild_feed(tx)
+        recommender.follows_changed(self.username)
 
     def suggest_follow(self):
-        """Finds all users which are followed by the users this users follow, if
-        this user does not follow them. Users are ranked via total amount of upvotes."""
-        query = '''
-            MATCH (user:User)-[:FOLLOW]->(:User)-[:FOLLOW]->(n:User)
-            WHERE user.username = {username} AND NOT (user:User)-[:FOLLOW]->(n:User) AND NOT user=n
-            RETURN n.username AS username
-            ORDER BY n.upvote DESC
-        '''
-        return graph.run(query, username=self.username)
-
-    def bookmark_question(self, question_id):
-        """Creats a bookmark relationship between this user and question with
-        id=question_id."""
-        user = self.find()
-        question = graph.find_one('Question', 'id', question_id)
-        graph.merge(Relationship(user, 'BOOKMARK', question))
+        """Finds users which are followed by the users this users follow, if
+        this user does not follow them. Users are ranked by how many of those follow
+        them, then by how alike their tags are, then by total amount of upvotes.
+        Served from the recommender, at most RECOMMEND_TOP_K of them."""
+        return recommender.suggestions(self.username)
 
     def upvote_answer(self, answer_id):
-        """If an answer is upvoted, the question the answer is directed at is found
-        and its total upvotes is incremented. Then the user who published the answer
-        is found and its total upvotes is incremented. This is done to mark ranking via
-        upvote easier. Then finally a relationship is created between this user
-        and the answer: self - UPVOTE -> answer."""
-        user = self.find()
-        answer = graph.find_one('Answer', 'id', answer_id)
-        query = '''
-	       MATCH (a:Answer)-[:ANSWERED]-(q:Question)
-	       WHERE a.id = {answer_id}
-	       RETURN q.id
-	    '''
-        question = graph.run(query, answer_id=answer_id).data()
-        graph.run("MERGE (n:Question {id: {question_id}}) SET n.upvote=n.upvote+1",
-        {"question_id": question[0]["q.id"]})
-        query = '''
-	       MATCH (a:Answer)-[:PUBLISHED]-(u:User)
-	       WHERE a.id = {answer_id}
-	       RETURN u.username
-	    '''
-        use_id = graph.run(query, answer_id=answer_id).data()
-        graph.run("MERGE (n:User {username: {username}}) SET n.upvote=n.upvote+1",
-        {"username": use_id[0]["u.username"]})
-        graph.merge(Relationship(user, 'UPVOTE', answer))
+        """If an answer is upvoted, a relationship is created between this user
+        and the answer: self - UPVOTE -> answer. This is done in one statement and
+        only once per user and answer, and the first time also counts the vote on
+        the answer itself. The total upvotes of the question the answer is directed
+        at and of the user who published the answer are incremented through
+        vote_buffer, which writes them in batches. This is done to mark ranking via
+        upvote easier. The answer's new total goes out to live update streams."""
+        now = timestamp()
+        votes = graph.run(queries.UPVOTE_ANSWER, username=self.username, answer_id=answer_id, timestamp=now).data()
+        if votes and votes[0]["created"]:
+            vote_buffer.record(votes[0]["question_id"], votes[0]["username"])
+            cache.invalidate('answers:' + votes[0]["question_id"])
+            forget_node('Answer', 'id', answer_id)
+            live_updates.publish(votes[0]["question_id"], 'votes', answer_id,
+                                 {"id": answer_id, "upvote": votes[0]["upvote"]}, now)
 
     def bookmark_question(self, question_id):
-        """Creates a bookmark relationship between a user and a question."""
-        user = self.find()
-        question = graph.find_one('Question', 'id', question_id)
-        graph.merge(Relationship(user, 'BOOKMARK', question))
+        """Creates a bookmark relationship between a user and a question, timed
+        so bookmarks can be listed newest first. The first bookmark by a user also
+        counts towards the question's bookmark_count and last_activity."""
+        graph.run(queries.BOOKMARK_QUESTION, username=self.username, question_id=question_id, timestamp=timestamp())
+        cache.invalidate('question:' + question_id)
+        forget_node('Question', 'id', question_id)
 
 
 
     def get_recent_questions(self):
         """Finds all questions this user has published, ranks them according
         to time, and delivers the latest 5."""
-        query = '''
-            MATCH (user:User)-[:PUBLISHED]->(question:Question)<-[:TAGGED]-(tag:Tag)
-            WHERE user.username = {username}
-            RETURN user.username AS username, question, COLLECT(tag.name) AS tags
-            ORDER BY question.date DESC, question.timestamp DESC LIMIT 5
-        '''
-        return graph.run(query, username=self.username)
-
-    def get_bookmarks(self):
-        """Gets all the questions this user has bookmarked, and their tags. Then
-        gets the users who published those questions."""
-        query = '''
-            MATCH (user:User)-[:BOOKMARK]-(question:Question)<-[:TAGGED]-(tag:Tag)
-            MATCH (question:Question) -[:PUBLISHED] - (u:User)
-            WHERE user.username = {username}
-            RETURN u.username AS username, question, COLLECT(tag.name) AS tags
-            ORDER BY question.timestamp DESC
-        '''
-        return graph.run(query, username=self.username)
-
-
-
-    def get_timeline(self):
-        """Step 1: Find all questions posted by those this user is following.
-        Step 2: Store the user, question and tag data in a list for use in the next query.
-        Step 3: Find all questions posted that are linked to this user via a tag.
-        Step 4: Store the user, question and tag data in a list, and add it to previous lists.
-        Step 5: Unwind all lists back into records.
-        Step 6: Remove duplicates by ensuring only records where a user published that question
-                gets selected.
-        Step 7: Return data, ordered as most recently modified, either via being asked or answered,
-                as highest.
-        """
-        query = '''
-            MATCH (u:User) -[:FOLLOW] -> (user:User) - [:PUBLISHED] -(question:Question)
-            MATCH (question:Question) - [:TAGGED] - (tag:Tag)
-            WHERE u.username={username} AND NOT u=user
-            WITH  COLLECT(user) AS use, COLLECT(question) AS quest, COLLECT(tag) AS t
-            MATCH (u:User) -[:TAGGED] - (:Tag) -[:TAGGED] - (question:Question) - [:PUBLISHED] - (user:User)
-            MATCH (question:Question) - [:TAGGED] - (tag:Tag)
-            WHERE u.username={username} AND NOT u=user
-            WITH use + COLLECT(user) AS use, quest +  COLLECT(question) AS quest2, t+COLLECT(tag) as t2
-            UNWIND quest2 AS question
-            UNWIND use AS user
-            UNWIND t2 AS tag
-            WITH DISTINCT user, question, tag
-            WHERE (user:User) - [:PUBLISHED] -(question:Question)
-            RETURN distinct user.username AS username, question, COLLECT(tag.name) AS tags
-            ORDER BY question.update_date, question.update_timestamp DESC LIMIT 10
-        '''
-
-        return graph.run(query, username=self.username)
-
-    def get_voteline(self):
-        """Step 1: Find all questions posted by those this user is following.
-        Step 2: Store the user, question and tag data in a list for use in the next query.
-        Step 3: Find all questions posted that are linked to this user via a tag.
-        Step 4: Store the user, question and tag data in a list, and add it to previous lists.
-        Step 5: Unwind all lists back into records.
-        Step 6: Remove duplicates by ensuring only records where a user published that question
-                gets selected.
-        Step 7: Return data, ordered as question with most upvotes being highest.
-        """
-        query = '''
-            MATCH (u:User) -[:FOLLOW] -> (user:User) - [:PUBLISHED] -(question:Question)
-            MATCH (question:Question) - [:TAGGED] - (tag:Tag)
-            WHERE u.username={username} AND NOT u=user
-            WITH  COLLECT(user) AS use, COLLECT(question) AS quest, COLLECT(tag) AS t
-            MATCH (u:User) -[:TAGGED] - (:Tag) -[:TAGGED] - (question:Question) - [:PUBLISHED] - (user:User)
-            MATCH (question:Question) - [:TAGGED] - (tag:Tag)
-            WHERE u.username={username} AND NOT u=user
-            WITH use + COLLECT(user) AS use, quest +  COLLECT(question) AS quest2, t+COLLECT(tag) as t2
-            UNWIND quest2 AS question
-            UNWIND use AS user
-            UNWIND t2 AS tag
-            WITH DISTINCT user, question, tag
-            WHERE (user:User) - [:PUBLISHED] -(question:Question)
-            RETURN distinct user.username AS username, question, COLLECT(tag.name) AS tags
-            ORDER BY question.upvote DESC LIMIT 10
-        '''
-        return graph.run(query, username=self.username)
-
-    def get_following_feed(self):
-        """Step 1: Find all questions posted by those this user is following.
-        Step 2: Store the user, question and tag data in a list for use in the next query.
-        Step 3: Find all questions posted that are linked to this user via a tag.
-        Step 4: Store the user, question and tag data in a list, and add it to previous lists.
-        Step 5: Unwind all lists back into records.
-        Step 6: Remove duplicates by ensuring only records where a user published that question
-                gets selected.
-        Step 7: Return data, ordered as question with most upvotes being highest.
-        """
-        query = '''
-            MATCH (u:User) -[:FOLLOW] -> (:User) -[:FOLLOW] -> (user:User) - [:PUBLISHED] -(question:Question)
-            MATCH (question:Question) - [:TAGGED] - (tag:Tag)
-            WHERE u.username={username} AND NOT u=user
-            WITH  COLLECT(user) AS use, COLLECT(question) AS quest, COLLECT(tag) AS t
-            MATCH (u:User) -[:FOLLOW] -> (:User) -[:TAGGED] - (:Tag) -[:TAGGED] - (question:Question) - [:PUBLISHED] - (user:User)
-            MATCH (question:Question) - [:TAGGED] - (tag:Tag)
-            WHERE u.username={username} AND NOT u=user
-            WITH use + COLLECT(user) AS use, quest +  COLLECT(question) AS quest2, t+COLLECT(tag) as t2
-            UNWIND quest2 AS question
-            UNWIND use AS user
-            UNWIND t2 AS tag
-            WITH DISTINCT user, question, tag
-            WHERE (user:User) - [:PUBLISHED] -(question:Question)
-            RETURN distinct user.username AS username, question, COLLECT(tag.name) AS tags
-            ORDER BY question.upvote DESC LIMIT 10
-        '''
-        return graph.run(query, username=self.username)
+        return graph.read(queries.USER_RECENT_QUESTIONS, username=self.username)
+
+    def get_bookmarks(self, after=None, limit=BOOKMARK_PAGE_SIZE):
+        """Gets one page of the questions this user has bookmarked, most recently
+        bookmarked first, with their tags and the users who published them.
+        Returns the rows and the cursor of the next page."""
+        return keyset_page(queries.bookmarks_query, {"username": self.username}, after, limit,
+                           lambda row: (row["key"], row["question"]["id"]))
+
+
+
+    def get_timeline(self, after=None):
+        """Gets one page of this user's feed, ordered as most recently modified,
+        either via being asked or answered, as highest. Returns the rows and the
+        cursor of the next page."""
+        return feed_page(self.username, FEEDS['timeline'], after)
+
+    def get_voteline(self, after=None):
+        """Gets one page of this user's feed, ordered as question with most
+        upvotes being highest. Returns the rows and the cursor of the next page."""
+        return feed_page(self.username, FEEDS['voteline'], after)
+
+    def get_following_feed(self, after=None):
+        """Gets one page of the questions seen by those this user is following,
+        ordered as question with most upvotes being highest. Returns the rows and
+        the cursor of the next page."""
+        return feed_page(self.username, FEEDS['following'], after)
+
+    def rebuild_feed(self, tx=None):
+        """Recomputes this user's feed from scratch. A question belongs in the feed
+        if it was published by someone this user follows, or if it shares a tag
+        with this user, as long as this user did not publish it. Only the newest
+        FEED_SIZE are kept. Runs inside tx
+        when one is given."""
+        (tx or graph).run(queries.REBUILD_FEED, username=self.username, feed_size=FEED_SIZE)
 
     def test_follow(self, user_him):
         """Tests to see if this user is following another user."""
-        user_me = self.find()
-        user_him = graph.find_one('User', 'username', user_him)
-        Find = graph.match_one(start_node=user_me, rel_type='FOLLOW', end_node=user_him)
-        if (type(Find) == Relationship):
-            return True
-        else:
-            return False
+        return graph.read(queries.TEST_FOLLOW, me=self.username, him=user_him).evaluate()
 
     def get_similar_users(self):
         """Find three users who are most similar to the logged-in user
-        based on tags they've both blogged about. Came from tutorial."""
-        query = '''
-            MATCH (you:User)-[:PUBLISHED]->(:Question)<-[:TAGGED]-(tag:Tag),
-                (they:User)-[:PUBLISHED]->(:Question)<-[:TAGGED]-(tag)
-            WHERE you.username = {username} AND you <> they
-            WITH they, COLLECT(DISTINCT tag.name) AS tags
-            ORDER BY SIZE(tags) DESC LIMIT 3
-            RETURN they.username AS similar_user, tags
-        '''
-        return graph.run(query, username=self.username)
+        based on tags they've both followed or blogged about. Served from the
+        recommender."""
+        return recommender.similar_users(self.username, 3)
 
     def get_commonality_of_user(self, other):
         """Find how many of the logged-in user's posts the other user
         has liked and which tags they've both blogged about. Came from tutorial."""
-        query = '''
-        MATCH (they:User {username: {they} })
-        MATCH (you:User {username: {you} })
-        OPTIONAL MATCH (they)-[:PUBLISHED]->(:Question)<-[:TAGGED]-(tag:Tag),
-                       (you)-[:PUBLISHED]->(:Question)<-[:TAGGED]-(tag)
-        RETURN SIZE((they)-[:LIKED]->(:Question)<-[:PUBLISHED]-(you)) AS likes,
-               COLLECT(DISTINCT tag.name) AS tags
-        '''
-        return graph.run(query, they=other.username, you=self.username).next
-
-
-
-
-def get_todays_recent_questions():
-    """Gets the most recent questions published, regardless of who posted them."""
-    query = '''
-        MATCH (user:User)-[:PUBLISHED]->(question:Question)<-[:TAGGED]-(tag:Tag)
-        WHERE question.date = {today}
-        RETURN user.username AS username, question, COLLECT(tag.name) AS tags
-        ORDER BY question.timestamp DESC LIMIT 5
-    '''
-    return graph.run(query, today=date())
+        return graph.read(queries.COMMONALITY_OF_USERS, they=other.username, you=self.username).data()
+
+
+
+
+# The feeds shown on the site, as (sources, sort).
+FEEDS = {
+    'timeline': (('feed',), 'recent'),
+    'voteline': (('following', 'tags'), 'votes'),
+    'following': (('following_of_following', 'tags_of_following'), 'votes'),
+}
+
+FEED_PAGE_SIZE = 10
+# Questions kept in each user's feed, newest first, so that reading a timeline
+# costs the same however long the history is. Older questions fall out once a
+# feed holds FEED_SLACK more than this.
+FEED_SIZE = int(os.environ.get('FEED_SIZE', 500))
+FEED_SLACK = int(os.environ.get('FEED_SLACK', 50))
+ANSWER_PAGE_SIZE = 10
+
+def feed_page(username, feed, after=None, limit=FEED_PAGE_SIZE):
+    """Gets one page of a feed for the given user. feed is a (sources, sort) pair
+    from FEEDS and after is the opaque cursor returned with the previous page.
+    Returns the rows of the page and the cursor of the next page, or None on the
+    last page."""
+    sources, sort = feed
+    key = queries.FEED_SORTS[sort]
+    return keyset_page(lambda after: queries.feed_query(sources, sort, after), {"username": username},
+                       after, limit, lambda row: (row["question"][key], row["question"]["id"]))
+
+def keyset_page(query, parameters, after, limit, position):
+    """Reads one page of rows ordered on a (key, id) pair. query(after) builds
+    the statement, with a keyset condition on {after_key} and {after_id} when
+    after is True, and position(row) gives the (key, id) of a row. Returns the
+    rows and the cursor of the next page, or None on the last page."""
+    parameters = dict(parameters, limit=limit)
+    start = decode_cursor(after)
+    if start:
+        parameters["after_key"], parameters["after_id"] = start
+    rows = graph.read(query(bool(start)), parameters).data()
+    next_after = None
+    if len(rows) == limit:
+        next_after = encode_cursor(*position(rows[-1]))
+    return rows, next_after
+
+def encode_cursor(*position):
+    """Turns a keyset position into an opaque, URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Turns a cursor made by encode_cursor back into a keyset position. Missing
+    or malformed cursors give None, which starts at the first page."""
+    if not cursor:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(position, list) or len(position) != 2:
+        return None
+    return position
+
+def push_to_feeds(question_id, tx=None):
+    """Fans a question out to the feeds of everyone who would see it on their
+    timeline: the author's followers and the users following one of its tags.
+    Feeds are FEED relationships, so reading a timeline only touches the reader's
+    own feed instead of recomputing it from the whole graph. Each feed is cut to
+    its newest FEED_SIZE questions, so that read does not grow with the history.
+    A new answer makes the question newest again, so it is pushed once more and
+    comes back into feeds it had been cut from. Runs inside tx when one is
+    given."""
+    (tx or graph).run(queries.PUSH_TO_FEEDS, question_id=question_id, feed_size=FEED_SIZE, feed_slack=FEED_SLACK)
+
+def get_pic_urls():
+    """Gets the profile picture file name of every user."""
+    return [row["url"] for row in graph.read(queries.ALL_PIC_URLS).data() if row["url"]]
+
+def rebuild_feeds():
+    """Rebuilds the feed of every user. Used to backfill feeds for data created
+    before feeds existed. Returns the number of users rebuilt."""
+    usernames = [row["username"] for row in graph.read(queries.ALL_USERNAMES).data()]
+    for name in usernames:
+        User(name).rebuild_feed()
+    return len(usernames)
+
+def write_votes(questions, users):
+    """Writes the upvote totals of the questions and users vote_buffer collected
+    votes for, in one transaction. The totals are summed from their answers rather
+    than added from the deltas, so writing them again changes nothing. A question's
+    last_activity becomes its latest vote if that is newer."""
+    with graph.begin() as tx:
+        tx.run(queries.COUNT_QUESTION_VOTES, ids=list(questions))
+        tx.run(queries.COUNT_USER_VOTES, ids=list(users))
+    cache.invalidate(*['question:' + id for id in questions])
+    for id in questions:
+        forget_node('Question', 'id', id)
+
+vote_buffer = VoteBuffer(write_votes, interval=float(os.environ.get('VOTE_FLUSH_INTERVAL', 2)))
+
+def answer_event(username, answer):
+    """What a live update stream is sent about a new answer. Its upvotes are
+    sent as votes events."""
+    return {"id": answer['id'], "username": username, "text": answer['text'], "date": answer['date']}
+
+def live_changes(question_ids, since):
+    """The answers given to and upvotes of answers to the questions since a
+    timestamp, as the (question_id, event, key, data, timestamp) changes that
+    live_updates publishes, oldest first. Finds what other processes wrote."""
+    changes = []
+    for row in graph.read(queries.LIVE_ANSWERS, question_ids=question_ids, since=since).data():
+        changes.append((row["question_id"], 'answer', row["answer"]['id'],
+                        answer_event(row["username"], row["answer"]), row["answer"]['timestamp']))
+    for row in graph.read(queries.LIVE_VOTES, question_ids=question_ids, since=since).data():
+        changes.append((row["question_id"], 'votes', row["answer_id"],
+                        {"id": row["answer_id"], "upvote": row["upvote"]}, row["timestamp"]))
+    return sorted(changes, key=lambda change: change[4])
+
+# Pushes new answers and upvote totals to the show_question pages left open.
+live_updates = live.LiveHub(live_changes, clock=lambda: timestamp(), max_streams=live.LIVE_MAX_STREAMS,
+                            queue_size=live.LIVE_QUEUE_SIZE, poll_interval=live.LIVE_POLL_INTERVAL)
+
+FRONT_PAGE_SIZE = 5
+
+def load_recent_questions(since, limit):
+    """Gets up to limit questions published since the epoch milliseconds since,
+    newest first, regardless of who posted them."""
+    return graph.read(queries.RECENT_QUESTIONS, since=since, limit=limit).data()
+
+# The newest questions, kept in memory for the front page.
+recent_questions = RecentQuestions(load_recent_questions)
+
+def get_latest_questions(limit=FRONT_PAGE_SIZE):
+    """Gets the most recent questions published in the last 24 hours, regardless
+    of who posted them. The buffer only picks the questions and their order; each
+    one is read through get_question, whose cache entry every write to it drops,
+    so answers, upvotes and bookmarks show up without waiting for a reload."""
+    rows = []
+    for row in recent_questions.page(limit):
+        current = get_question(row["question"]["id"])
+        if current:
+            rows.append(current[0])
+    return rows
+
+def backfill_created_ms(batch_size=500):
+    """Gives every question and answer made before created_ms existed one, from
+    its timestamp. Returns the number of nodes updated."""
+    count = 0
+    for statement in (queries.BACKFILL_QUESTION_CREATED_MS, queries.BACKFILL_ANSWER_CREATED_MS):
+        while True:
+            updated = graph.run(statement, limit=batch_size).evaluate()
+            if not updated:
+                break
+            count += updated
+    return count
 
 def get_question(question_id):
     """Gets data about the question with id=question_id, including data outside
-    the question node, such as who posted it and the tagged tags."""
-    query = '''
-        MATCH (user:User)-[:PUBLISHED]->(question:Question)<-[:TAGGED]-(tag:Tag)
-        WHERE question.id = {question_id}
-        RETURN user.username AS username, question, COLLECT(tag.name) AS tags
-        ORDER BY question.timestamp DESC LIMIT 5
-    '''
-    return graph.run(query, question_id=question_id)
-
-def get_answers(question_id):
-    """Gets all the answers to a question with id=question_id, including the posting user."""
-    query = '''
-        MATCH (user:User)-[:PUBLISHED]-(question:Question)-[:ANSWERED]-(answer:Answer) - [:PUBLISHED] - (u:User)
-        WHERE question.id = {question_id}
-        RETURN u.username AS username, answer
-        ORDER BY question.up, question.timestamp DESC
-    '''
-    return graph.run(query, question_id=question_id)
-
-def do_search(username):
-    """Searches for and returns a user with username=username."""
-    user = graph.find_one('User', 'username', username)
-    return user
+    the question node, such as who posted it and the tagged tags. Inside a
+    request the rows are read once and then reused from the identity map."""
+    return load_node('Question', 'id', question_id, lambda: read_question(question_id))
+
+@cache.memoize(lambda rows, question_id: ['question:' + question_id])
+def read_question(question_id):
+    return graph.read(queries.QUESTION, question_id=question_id).data()
+
+def get_answers(question_id, sort='votes', after=None, limit=ANSWER_PAGE_SIZE):
+    """Gets one page of the answers to a question with id=question_id, including
+    the posting user, sorted by queries.ANSWER_SORTS[sort]. Returns the rows and
+    the cursor of the next page. Inside a request an answer is read once, and the
+    rows of every page it shows up on reuse it from the identity map."""
+    rows, after = read_answers(question_id, sort, after, limit)
+    return [load_node('Answer', 'id', row["answer"]["id"], lambda row=row: row) for row in rows], after
+
+@cache.memoize(lambda page, question_id, *args: ['answers:' + question_id])
+def read_answers(question_id, sort, after, limit):
+    return keyset_page(lambda after: queries.answers_query(sort, after), {"question_id": question_id},
+                       after, limit, lambda row: (row["key"], row["answer"]["id"]))
+
+def index_for_search(question_id, weighted_texts, tx=None):
+    """Adds the words of (text, weight) pairs to the search index of a question.
+    The index is made of Term nodes, one per word, with an INDEXES relationship
+    to every question whose title, text or answers use it; tf on the relationship
+    is the weighted number of uses and df on the Term the number of questions.
+    Answers are indexed under their question, so searches find questions."""
+    (tx or graph).run(queries.INDEX_FOR_SEARCH, question_id=question_id, terms=term_weights(*weighted_texts))
+
+def search_questions(text, page=0, limit=SEARCH_PAGE_SIZE):
+    """Finds the questions matching the words of text, best first: questions
+    matching more of the words come first, then those with the highest tf-idf
+    score. Returns one page of rows like get_question's."""
+    words = query_words(text)
+    if not words:
+        return []
+    return graph.read(queries.SEARCH_QUESTIONS, words=words, skip=page * limit, limit=limit).data()
+
+def search_users(prefix, page=0, limit=SEARCH_PAGE_SIZE):
+    """Finds the usernames starting with prefix, ignoring case, in alphabetical
+    order. Uses the index on User.username_lower rather than scanning users."""
+    if not prefix:
+        return []
+    return graph.read(queries.SEARCH_USERS, prefix=prefix.lower(), skip=page * limit, limit=limit).data()
+
+def rebuild_search_index(batch_size=100):
+    """Drops the search index and indexes every question and answer again, one
+    batch of questions at a time. Also fills in User.username_lower. Returns the
+    number of questions indexed."""
+    graph.run(queries.FILL_USERNAME_LOWER)
+    while graph.run(queries.DELETE_SEARCH_TERMS, limit=batch_size * 10).evaluate():
+        pass
+    after = ''
+    count = 0
+    while True:
+        rows = graph.read(queries.QUESTIONS_TO_INDEX, after=after, limit=batch_size).data()
+        if not rows:
+            return count
+        with graph.begin() as tx:
+            for row in rows:
+                texts = [(row["title"], TITLE_WEIGHT), (row["text"], TEXT_WEIGHT)]
+                texts += [(answer, TEXT_WEIGHT) for answer in row["answers"]]
+                index_for_search(row["id"], texts, tx)
+        after = rows[-1]["id"]
+        count += len(rows)
+
+def repair_question_summaries(batch_size=500):
+    """Recomputes answer_count, last_answerer, bookmark_count, upvote and
+    last_activity of every question from its answers, upvotes and bookmarks, one
+    batch at a time. Upvote totals are summed the way write_votes sums them, so
+    votes any process still holds come out the same when they are written.
+    Returns the number of questions."""
+    after = ''
+    count = 0
+    while True:
+        ids = [row["id"] for row in graph.run(queries.REPAIR_QUESTION_SUMMARIES, after=after, limit=batch_size).data()]
+        count += len(ids)
+        cache.invalidate(*['question:' + id for id in ids])
+        if len(ids) < batch_size:
+            return count
+        after = ids[-1]
+
+def check_tag_masks(repair=False, batch_size=500):
+    """Compares the tag_mask of every user and question with the tags it is
+    TAGGED with, which are the source of truth, one page at a time. With repair
+    the wrong masks are corrected, which also fills them in for nodes made before
+    masks existed. Returns the number of users and of questions that were wrong."""
+    wrong = {}
+    for label, read, write in (('User', queries.USER_TAG_MASKS, queries.SET_USER_TAG_MASKS),
+                               ('Question', queries.QUESTION_TAG_MASKS, queries.SET_QUESTION_TAG_MASKS)):
+        wrong[label] = 0
+        after = ''
+        while True:
+            rows = graph.read(read, after=after, limit=batch_size).data()
+            fixes = [{"key": row["key"], "mask": mask_of(row["tags"])} for row in rows
+                     if row["mask"] != mask_of(row["tags"])]
+            wrong[label] += len(fixes)
+            if repair and fixes:
+                graph.run(write, masks=fixes)
+            if len(rows) < batch_size:
+                break
+            after = rows[-1]["key"]
+    return wrong
+
+def warm_up():
+    """Builds what a new process would otherwise build on its first requests:
+    the front page buffer and the recommender table."""
+    recent_questions.reload()
+    recommender.load()
+
+def split_tags(tags):
+    """Splits a String of tags seperated with a " " into a list of distinct,
+    lower case tag names."""
+    return sorted(set(x.strip() for x in tags.lower().split(' ') if x.strip()))
+
+def find_node(label, key, value):
+    """Finds the node with label and a unique key=value. Inside a request each
+    node is only fetched once and then reused from the request's identity map."""
+    return load_node(label, key, value, lambda: graph.find_one(label, key, value))
+
+def load_node(label, key, value, loader):
+    """Returns what loader reads for the node with label and key=value, calling
+    it only the first time the node is asked for inside a request."""
+    identity_map = current_identity_map()
+    if identity_map is None:
+        return loader()
+    return identity_map.get(label, key, value, loader)
+
+def forget_node(label, key, value):
+    """Drops a node from the request's identity map after its properties changed."""
+    identity_map = current_identity_map()
+    if identity_map is not None:
+        identity_map.forget(label, key, value)
 
 def timestamp():
     """Generic timestamp"""
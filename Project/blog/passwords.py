@@ -0,0 +1,104 @@
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from passlib.hash import bcrypt
+import os
+import threading
+
+from .executor import cooperative, native_thread_pool
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+PASSWORD_QUEUE = int(os.environ.get('PASSWORD_QUEUE', PASSWORD_WORKERS * 4))
+PASSWORD_TIMEOUT = float(os.environ.get('PASSWORD_TIMEOUT', 10))
+
+
+class PasswordServiceBusy(Exception):
+    """Raised instead of queueing when too many hashes are already waiting, and
+    when a hash takes longer than PASSWORD_TIMEOUT."""
+
+
+def encrypt(password, rounds):
+    return bcrypt.encrypt(password, rounds=rounds)
+
+
+def verify(password, hashed):
+    return bcrypt.verify(password, hashed)
+
+
+def rounds_of(hashed):
+    """Reads the cost out of a hash like $2b$12$..."""
+    return int(hashed.split('$')[2])
+
+
+class PasswordService:
+    """Runs bcrypt in a pool of worker processes so that hashing never holds up a
+    request thread or the GIL. Under gevent it runs on a pool of real threads
+    instead, since a process pool's helper threads and pipes would be patched
+    into greenlets that older gevent releases do not schedule reliably; bcrypt
+    lets go of the GIL while it hashes, so those threads still hash in parallel.
+    At most max_pending hashes can be queued or running; beyond that callers get
+    PasswordServiceBusy straight away rather than waiting behind everyone else.
+    The pool is started on first use, so it is created in each server worker
+    after it has forked."""
+
+    def __init__(self, rounds, workers, max_pending, timeout):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def hash(self, password):
+        """Hashes password with the configured cost."""
+        return self.call(encrypt, password, self.rounds)
+
+    def verify(self, password, hashed):
+        """Checks password against hashed. Returns (matches, new_hash), where
+        new_hash is a rehash at the configured cost if hashed used another cost,
+        and None otherwise."""
+        if not self.call(verify, password, hashed):
+            return False, None
+        if rounds_of(hashed) != self.rounds:
+            return True, self.hash(password)
+        return True, None
+
+    def call(self, function, *args):
+        """Runs function in the pool and waits up to timeout seconds for it. The
+        slot is held until the job is done, not until the caller gives up on it, so
+        hashes that time out still count against max_pending while they run."""
+        if not self.slots.acquire(blocking=False):
+            raise PasswordServiceBusy()
+        try:
+            future = self.executor().submit(function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            raise PasswordServiceBusy()
+
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                if cooperative():
+                    self.pool = native_thread_pool(self.workers)
+                else:
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+
+passwords = PasswordService(
+    rounds=BCRYPT_ROUNDS,
+    workers=PASSWORD_WORKERS,
+    max_pending=PASSWORD_QUEUE,
+    timeout=PASSWORD_TIMEOUT
+)
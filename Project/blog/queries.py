@@ -0,0 +1,700 @@
+# Every Cypher statement the models run, by name. Keeping them here lets the
+# schema manager EXPLAIN all of them (see schema.check_queries).
+
+from .tags import TAGS, ALL_TAGS_MASK
+
+
+# Tag masks (see tags.py) in Cypher. Neo4j 3 has no bitwise operators, so a bit is
+# tested with integer division: (mask / bit) % 2 = 1. There are only len(TAGS)
+# bits, so each of these is a small constant amount of work.
+
+def tag_bits():
+    return '[%s]' % ', '.join(str(1 << i) for i in range(len(TAGS)))
+
+
+def shares_tags(a, b):
+    """Cypher for a AND b <> 0 on two tag masks."""
+    return 'ANY(bit IN %s WHERE (%s / bit) %% 2 = 1 AND (%s / bit) %% 2 = 1)' % (tag_bits(), a, b)
+
+
+def masks_sharing_tags(mask):
+    """Cypher for the list of every non-empty mask sharing a tag with mask, to
+    look nodes up by through the tag_mask index."""
+    return '[m IN range(1, %d) WHERE %s]' % (ALL_TAGS_MASK, shares_tags('m', mask))
+
+
+def union_of_masks(masks):
+    """Cypher for the bitwise OR of a list of tag masks. Nulls count as no tags."""
+    return ('reduce(found = 0, bit IN %s | found + CASE WHEN ANY(m IN %s WHERE (m / bit) %% 2 = 1) '
+            'THEN bit ELSE 0 END)' % (tag_bits(), masks))
+
+
+def shared_tag_names(a, b):
+    """Cypher for the names of the tags in both a and b, in the order of TAGS."""
+    return '[i IN range(0, %d) WHERE (%s / %s[i]) %% 2 = 1 AND (%s / %s[i]) %% 2 = 1 | %s[i]]' % (
+        len(TAGS) - 1, a, tag_bits(), b, tag_bits(), '[%s]' % ', '.join("'%s'" % tag for tag in TAGS))
+
+
+CREATE_USER = '''
+    CREATE (n:User {user})
+'''
+
+SET_USER_PIC_URL = '''
+    MERGE (n:User {username: {username}}) SET n.url = {picurl}
+'''
+
+SET_USER_BIO = '''
+    MERGE (n:User {username: {username}}) SET n.bio = {bio}
+'''
+
+SET_USER_PASSWORD = '''
+    MERGE (n:User {username: {username}}) SET n.password = {password}
+'''
+
+ADD_USER_TAGS = '''
+    MATCH (user:User)
+    WHERE user.username = {username}
+    SET user.tag_mask = %s
+    WITH user
+    UNWIND {tags} AS name
+    MERGE (tag:Tag {name: name})
+    MERGE (tag)-[:TAGGED]->(user)
+''' % union_of_masks('[coalesce(user.tag_mask, 0), {mask}]')
+
+REMOVE_USER_TAGS = '''
+    MATCH (user:User)
+    WHERE user.username = {username}
+    SET user.tag_mask = 0
+    WITH user
+    OPTIONAL MATCH (:Tag)-[r:TAGGED]-(user)
+    DELETE r
+'''
+
+CREATE_QUESTION = '''
+    MATCH (user:User)
+    WHERE user.username = {username}
+    CREATE (user)-[:PUBLISHED]->(question:Question {question})
+    WITH question
+    UNWIND {tags} AS name
+    MERGE (tag:Tag {name: name})
+    CREATE (tag)-[:TAGGED]->(question)
+'''
+
+# Besides creating the answer, keeps the question's summary up to date: how many
+# answers it has, who answered last and when anything last happened to it.
+CREATE_ANSWER = '''
+    MATCH (user:User)
+    WHERE user.username = {username}
+    MATCH (question:Question)
+    WHERE question.id = {question_id}
+    CREATE (user)-[:PUBLISHED]->(answer:Answer {answer})-[:ANSWERED]->(question)
+    SET question.answer_count = coalesce(question.answer_count, 0) + 1,
+        question.last_answerer = user.username,
+        question.last_activity = answer.timestamp,
+        question.update_timestamp = answer.timestamp,
+        question.update_date = answer.date
+'''
+
+FOLLOW_USER = '''
+    MATCH (me:User), (him:User)
+    WHERE me.username = {me} AND him.username = {him}
+    MERGE (me)-[:FOLLOW]->(him)
+'''
+
+
+BOOKMARK_QUESTION = '''
+    MATCH (user:User), (question:Question)
+    WHERE user.username = {username} AND question.id = {question_id}
+    MERGE (user)-[bookmark:BOOKMARK]->(question)
+    ON CREATE SET bookmark.timestamp = {timestamp},
+        question.bookmark_count = coalesce(question.bookmark_count, 0) + 1,
+        question.last_activity = {timestamp}
+'''
+
+UPVOTE_ANSWER = '''
+    MATCH (user:User)
+    WHERE user.username = {username}
+    MATCH (u:User)-[:PUBLISHED]->(answer:Answer)-[:ANSWERED]->(question:Question)
+    WHERE answer.id = {answer_id}
+    MERGE (user)-[vote:UPVOTE]->(answer)
+    ON CREATE SET vote.timestamp = {timestamp}, answer.upvote = coalesce(answer.upvote, 0) + 1,
+        answer.last_vote = {timestamp}
+    RETURN question.id AS question_id, u.username AS username, answer.upvote AS upvote,
+           vote.timestamp = {timestamp} AS created
+'''
+
+# The answers given to any of the questions since a time, for live updates.
+LIVE_ANSWERS = '''
+    UNWIND {question_ids} AS question_id
+    MATCH (question:Question)
+    WHERE question.id = question_id
+    MATCH (question)<-[:ANSWERED]-(answer:Answer)<-[:PUBLISHED]-(user:User)
+    WHERE answer.timestamp > {since}
+    RETURN question.id AS question_id, answer, user.username AS username
+'''
+
+# The answers to any of the questions upvoted since a time, with their totals and
+# when they were last upvoted, for live updates.
+LIVE_VOTES = '''
+    UNWIND {question_ids} AS question_id
+    MATCH (question:Question)
+    WHERE question.id = question_id
+    MATCH (question)<-[:ANSWERED]-(answer:Answer)<-[vote:UPVOTE]-(:User)
+    WHERE vote.timestamp > {since}
+    RETURN question.id AS question_id, answer.id AS answer_id, answer.upvote AS upvote,
+           MAX(vote.timestamp) AS timestamp
+'''
+
+# The upvote totals of questions and users are the sums of their answers'
+# upvotes, which UPVOTE_ANSWER keeps exact. Writing the sums rather than adding
+# deltas means a total written twice, or after a repair, is still right.
+COUNT_QUESTION_VOTES = '''
+    UNWIND {ids} AS id
+    MATCH (question:Question)
+    WHERE question.id = id
+    OPTIONAL MATCH (question)<-[:ANSWERED]-(answer:Answer)
+    WITH question, SUM(coalesce(answer.upvote, 0)) AS votes, MAX(answer.last_vote) AS last_vote,
+         coalesce(question.last_activity, question.timestamp) AS last_activity
+    SET question.upvote = votes,
+        question.last_activity = CASE WHEN last_vote > last_activity THEN last_vote ELSE last_activity END
+'''
+
+COUNT_USER_VOTES = '''
+    UNWIND {ids} AS id
+    MATCH (user:User)
+    WHERE user.username = id
+    OPTIONAL MATCH (user)-[:PUBLISHED]->(answer:Answer)
+    WITH user, SUM(coalesce(answer.upvote, 0)) AS votes
+    SET user.upvote = votes
+'''
+
+USER_RECENT_QUESTIONS = '''
+    MATCH (user:User)-[:PUBLISHED]->(question:Question)
+    WHERE user.username = {username}
+    OPTIONAL MATCH (question)<-[:TAGGED]-(tag:Tag)
+    RETURN user.username AS username, question, COLLECT(tag.name) AS tags
+    ORDER BY question.date DESC, question.timestamp DESC LIMIT 5
+'''
+
+
+TEST_FOLLOW = '''
+    MATCH (me:User)-[:FOLLOW]->(him:User)
+    WHERE me.username = {me} AND him.username = {him}
+    RETURN COUNT(*) > 0 AS follows
+'''
+
+
+COMMONALITY_OF_USERS = '''
+    MATCH (they:User {username: {they} })
+    MATCH (you:User {username: {you} })
+    OPTIONAL MATCH (they)-[:PUBLISHED]->(theirs:Question)
+    WITH they, you, COLLECT(theirs.tag_mask) AS their_masks
+    OPTIONAL MATCH (you)-[:PUBLISHED]->(yours:Question)
+    WITH they, you, their_masks, COLLECT(yours.tag_mask) AS your_masks
+    WITH they, you, %s AS theirs, %s AS yours
+    RETURN SIZE((they)-[:LIKED]->(:Question)<-[:PUBLISHED]-(you)) AS likes,
+           %s AS tags
+''' % (union_of_masks('their_masks'), union_of_masks('your_masks'), shared_tag_names('theirs', 'yours'))
+
+# Keeps the newest {feed_size} questions in the feed of every reader it touched.
+# A feed is only cut once it holds {feed_slack} more than that, so the cut is
+# paid for once every {feed_slack} pushes rather than on each one.
+PRUNE_FEEDS = '''
+    WITH DISTINCT reader
+    WHERE SIZE((reader)-[:FEED]->()) > {feed_size} + {feed_slack}
+    MATCH (reader)-[feed:FEED]->(old:Question)
+    WITH reader, feed
+    ORDER BY coalesce(old.update_timestamp, old.timestamp) DESC
+    WITH reader, COLLECT(feed)[{feed_size}..] AS stale
+    FOREACH (feed IN stale | DELETE feed)
+'''
+
+# The readers of a question's tags are found through its own few Tag nodes, so
+# the work is one step per reader, with no list of masks to look up.
+PUSH_TO_FEEDS = '''
+    MATCH (user:User)-[:PUBLISHED]->(question:Question)
+    WHERE question.id = {question_id}
+    OPTIONAL MATCH (follower:User)-[:FOLLOW]->(user)
+    WITH user, question, COLLECT(DISTINCT follower) AS followers
+    OPTIONAL MATCH (question)<-[:TAGGED]-(:Tag)-[:TAGGED]->(reader:User)
+    WITH user, question, followers + COLLECT(DISTINCT reader) AS readers
+    UNWIND readers AS reader
+    WITH DISTINCT user, question, reader
+    WHERE NOT reader = user
+    MERGE (reader)-[:FEED]->(question)
+''' + PRUNE_FEEDS
+
+ALL_PIC_URLS = '''
+    MATCH (u:User)
+    RETURN DISTINCT u.url AS url
+'''
+
+ALL_USERNAMES = '''
+    MATCH (u:User)
+    RETURN u.username AS username
+'''
+
+RECENT_QUESTIONS = '''
+    MATCH (question:Question)
+    WHERE question.created_ms >= {since}
+    WITH question
+    ORDER BY question.created_ms DESC LIMIT {limit}
+    MATCH (user:User)-[:PUBLISHED]->(question)
+    OPTIONAL MATCH (question)<-[:TAGGED]-(tag:Tag)
+    RETURN user.username AS username, question, COLLECT(tag.name) AS tags
+    ORDER BY question.created_ms DESC
+'''
+
+QUESTION = '''
+    MATCH (user:User)-[:PUBLISHED]->(question:Question)
+    WHERE question.id = {question_id}
+    OPTIONAL MATCH (question)<-[:TAGGED]-(tag:Tag)
+    RETURN user.username AS username, question, COLLECT(tag.name) AS tags
+    ORDER BY question.timestamp DESC LIMIT 5
+'''
+
+
+INDEX_FOR_SEARCH = '''
+    MATCH (question:Question)
+    WHERE question.id = {question_id}
+    UNWIND {terms} AS term
+    MERGE (t:Term {word: term.word})
+    ON CREATE SET t.df = 0
+    MERGE (t)-[r:INDEXES]->(question)
+    ON CREATE SET r.tf = 0, t.df = t.df + 1
+    SET r.tf = r.tf + term.tf
+'''
+
+SEARCH_QUESTIONS = '''
+    UNWIND {words} AS word
+    MATCH (t:Term)-[r:INDEXES]->(question:Question)
+    WHERE t.word = word
+    WITH question, COUNT(t) AS matched, SUM(r.tf / log(2.0 + t.df)) AS score
+    ORDER BY matched DESC, score DESC, question.id
+    SKIP {skip} LIMIT {limit}
+    MATCH (user:User)-[:PUBLISHED]->(question)
+    OPTIONAL MATCH (question)<-[:TAGGED]-(tag:Tag)
+    RETURN user.username AS username, question, COLLECT(tag.name) AS tags, matched, score
+    ORDER BY matched DESC, score DESC, question.id
+'''
+
+SEARCH_USERS = '''
+    MATCH (u:User)
+    WHERE u.username_lower STARTS WITH {prefix}
+    RETURN u.username AS username
+    ORDER BY u.username_lower
+    SKIP {skip} LIMIT {limit}
+'''
+
+FILL_USERNAME_LOWER = '''
+    MATCH (u:User)
+    SET u.username_lower = toLower(u.username)
+'''
+
+DELETE_SEARCH_TERMS = '''
+    MATCH (t:Term)
+    WITH t LIMIT {limit}
+    DETACH DELETE t
+    RETURN COUNT(*) AS deleted
+'''
+
+QUESTIONS_TO_INDEX = '''
+    MATCH (question:Question)
+    WHERE question.id > {after}
+    WITH question
+    ORDER BY question.id LIMIT {limit}
+    OPTIONAL MATCH (question)<-[:ANSWERED]-(answer:Answer)
+    RETURN question.id AS id, question.title AS title, question.text AS text,
+           COLLECT(answer.text) AS answers
+    ORDER BY id
+'''
+
+RECOMMENDER_USERS = '''
+    MATCH (u:User)
+    OPTIONAL MATCH (u)-[:PUBLISHED]->(question:Question)
+    RETURN u.username AS username, u.upvote AS upvote, coalesce(u.tag_mask, 0) AS tags,
+           COLLECT(question.tag_mask) AS activity
+'''
+
+RECOMMENDER_USER = '''
+    MATCH (u:User)
+    WHERE u.username = {username}
+    OPTIONAL MATCH (u)-[:PUBLISHED]->(question:Question)
+    RETURN u.username AS username, u.upvote AS upvote, coalesce(u.tag_mask, 0) AS tags,
+           COLLECT(question.tag_mask) AS activity
+'''
+
+RECOMMENDER_FOLLOWS = '''
+    MATCH (u:User)-[:FOLLOW]->(v:User)
+    RETURN u.username AS username, v.username AS follows
+'''
+
+RECOMMENDER_USER_FOLLOWS = '''
+    MATCH (u:User)-[:FOLLOW]->(v:User)
+    WHERE u.username = {username}
+    RETURN u.username AS username, v.username AS follows
+'''
+
+ALL_NODES = '''
+    MATCH (n)
+    RETURN id(n) AS id, labels(n) AS labels, properties(n) AS properties
+'''
+
+ALL_RELATIONSHIPS = '''
+    MATCH (a)-[r]->(b)
+    RETURN id(a) AS start, type(r) AS type, id(b) AS end, properties(r) AS properties
+'''
+
+# Bulk import: each statement writes a batch of rows in one transaction. Nodes are
+# merged on their unique key and relationships merged, so running a batch again
+# changes nothing. Upvote totals are counted from the UPVOTE relationships.
+IMPORT_USERS = '''
+    UNWIND {rows} AS row
+    MERGE (user:User {username: row.user.username})
+    ON CREATE SET user.upvote = 0
+    SET user += row.user, user.username_lower = toLower(row.user.username),
+        user.tag_mask = %s
+    WITH user, row
+    UNWIND row.tags AS name
+    MERGE (tag:Tag {name: name})
+    MERGE (tag)-[:TAGGED]->(user)
+''' % union_of_masks('[coalesce(user.tag_mask, 0), row.mask]')
+
+IMPORT_FOLLOWS = '''
+    UNWIND {rows} AS row
+    MATCH (me:User), (him:User)
+    WHERE me.username = row.username AND him.username = row.follows
+    MERGE (me)-[:FOLLOW]->(him)
+'''
+
+IMPORT_QUESTIONS = '''
+    UNWIND {rows} AS row
+    MATCH (user:User)
+    WHERE user.username = row.username
+    MERGE (question:Question {id: row.question.id})
+    ON CREATE SET question.upvote = 0
+    SET question += row.question, question.tag_mask = %s
+    MERGE (user)-[:PUBLISHED]->(question)
+    WITH question, row
+    UNWIND row.tags AS name
+    MERGE (tag:Tag {name: name})
+    MERGE (tag)-[:TAGGED]->(question)
+''' % union_of_masks('[coalesce(question.tag_mask, 0), row.mask]')
+
+IMPORT_ANSWERS = '''
+    UNWIND {rows} AS row
+    MATCH (user:User)
+    WHERE user.username = row.username
+    MATCH (question:Question)
+    WHERE question.id = row.question_id
+    MERGE (answer:Answer {id: row.answer.id})
+    ON CREATE SET answer.upvote = 0
+    SET answer += row.answer
+    MERGE (user)-[:PUBLISHED]->(answer)
+    MERGE (answer)-[:ANSWERED]->(question)
+'''
+
+IMPORT_UPVOTES = '''
+    UNWIND {rows} AS row
+    MATCH (user:User)
+    WHERE user.username = row.username
+    MATCH (author:User)-[:PUBLISHED]->(answer:Answer)-[:ANSWERED]->(question:Question)
+    WHERE answer.id = row.answer_id
+    MERGE (user)-[vote:UPVOTE]->(answer)
+    ON CREATE SET vote.timestamp = row.timestamp,
+        answer.upvote = coalesce(answer.upvote, 0) + 1,
+        answer.last_vote = CASE WHEN answer.last_vote > row.timestamp THEN answer.last_vote ELSE row.timestamp END,
+        question.upvote = coalesce(question.upvote, 0) + 1,
+        author.upvote = coalesce(author.upvote, 0) + 1
+'''
+
+IMPORT_BOOKMARKS = '''
+    UNWIND {rows} AS row
+    MATCH (user:User), (question:Question)
+    WHERE user.username = row.username AND question.id = row.question_id
+    MERGE (user)-[bookmark:BOOKMARK]->(question)
+    ON CREATE SET bookmark.timestamp = row.timestamp
+'''
+
+# Bulk export: each statement reads one page, keyed on a unique property so
+# every page is an index range seek however far into the graph it is.
+EXPORT_USERS = '''
+    MATCH (user:User)
+    WHERE user.username > {after}
+    WITH user
+    ORDER BY user.username LIMIT {limit}
+    OPTIONAL MATCH (user)<-[:TAGGED]-(tag:Tag)
+    WITH user, COLLECT(tag.name) AS tags
+    OPTIONAL MATCH (user)-[:FOLLOW]->(other:User)
+    WITH user, tags, COLLECT(other.username) AS follows
+    OPTIONAL MATCH (user)-[bookmark:BOOKMARK]->(question:Question)
+    RETURN user.username AS key, user, tags, follows,
+           COLLECT({question_id: question.id, timestamp: bookmark.timestamp}) AS bookmarks
+    ORDER BY key
+'''
+
+EXPORT_QUESTIONS = '''
+    MATCH (question:Question)
+    WHERE question.id > {after}
+    WITH question
+    ORDER BY question.id LIMIT {limit}
+    MATCH (user:User)-[:PUBLISHED]->(question)
+    OPTIONAL MATCH (question)<-[:TAGGED]-(tag:Tag)
+    RETURN question.id AS key, user.username AS username, question, COLLECT(tag.name) AS tags
+    ORDER BY key
+'''
+
+EXPORT_ANSWERS = '''
+    MATCH (answer:Answer)
+    WHERE answer.id > {after}
+    WITH answer
+    ORDER BY answer.id LIMIT {limit}
+    MATCH (user:User)-[:PUBLISHED]->(answer)-[:ANSWERED]->(question:Question)
+    OPTIONAL MATCH (voter:User)-[vote:UPVOTE]->(answer)
+    RETURN answer.id AS key, user.username AS username, question.id AS question_id, answer,
+           COLLECT({username: voter.username, timestamp: vote.timestamp}) AS votes
+    ORDER BY key
+'''
+
+# The tag masks of one page of nodes next to the tags they are TAGGED with, which
+# are the source of truth, and the statements that correct the masks.
+USER_TAG_MASKS = '''
+    MATCH (n:User)
+    WHERE n.username > {after}
+    WITH n
+    ORDER BY n.username LIMIT {limit}
+    OPTIONAL MATCH (n)<-[:TAGGED]-(tag:Tag)
+    RETURN n.username AS key, coalesce(n.tag_mask, 0) AS mask, COLLECT(tag.name) AS tags
+    ORDER BY key
+'''
+
+QUESTION_TAG_MASKS = '''
+    MATCH (n:Question)
+    WHERE n.id > {after}
+    WITH n
+    ORDER BY n.id LIMIT {limit}
+    OPTIONAL MATCH (n)<-[:TAGGED]-(tag:Tag)
+    RETURN n.id AS key, coalesce(n.tag_mask, 0) AS mask, COLLECT(tag.name) AS tags
+    ORDER BY key
+'''
+
+SET_USER_TAG_MASKS = '''
+    UNWIND {masks} AS row
+    MATCH (n:User)
+    WHERE n.username = row.key
+    SET n.tag_mask = row.mask
+'''
+
+SET_QUESTION_TAG_MASKS = '''
+    UNWIND {masks} AS row
+    MATCH (n:Question)
+    WHERE n.id = row.key
+    SET n.tag_mask = row.mask
+'''
+
+# Recomputes the summary of one page of questions from their answers, upvotes
+# and bookmarks: answer_count, last_answerer, bookmark_count, the upvote total
+# and last_activity, the latest of the question's own time and its answers',
+# votes' and bookmarks' times. Like COUNT_QUESTION_VOTES, the total is the sum of
+# the answers' upvotes, so votes still waiting in a vote buffer are not counted
+# twice when it is flushed. Each answer's last_vote is filled in on the way.
+REPAIR_QUESTION_SUMMARIES = '''
+    MATCH (question:Question)
+    WHERE question.id > {after}
+    WITH question
+    ORDER BY question.id LIMIT {limit}
+    OPTIONAL MATCH (question)<-[:ANSWERED]-(answer:Answer)
+    OPTIONAL MATCH (answer)<-[vote:UPVOTE]-(:User)
+    WITH question, answer, MAX(vote.timestamp) AS last_vote
+    SET answer.last_vote = last_vote
+    WITH question, COUNT(answer) AS answers, SUM(coalesce(answer.upvote, 0)) AS votes,
+         MAX(answer.timestamp) AS last_answer, MAX(last_vote) AS last_vote
+    OPTIONAL MATCH (question)<-[:ANSWERED]-(latest:Answer)<-[:PUBLISHED]-(author:User)
+    WITH question, answers, votes, last_answer, last_vote, latest, author
+    ORDER BY latest.timestamp DESC
+    WITH question, answers, votes, last_answer, last_vote, COLLECT(author.username)[0] AS last_answerer
+    OPTIONAL MATCH (question)<-[bookmark:BOOKMARK]-(:User)
+    WITH question, answers, votes, last_answer, last_vote, last_answerer,
+         COUNT(bookmark) AS bookmarks, MAX(bookmark.timestamp) AS last_bookmark
+    SET question.answer_count = answers, question.last_answerer = last_answerer,
+        question.upvote = votes, question.bookmark_count = bookmarks,
+        question.last_activity = reduce(newest = question.timestamp, time IN [last_answer, last_vote, last_bookmark] |
+            CASE WHEN time > newest THEN time ELSE newest END)
+    RETURN question.id AS id
+    ORDER BY id
+'''
+
+# Gives created_ms, in integer milliseconds, to nodes made before it existed,
+# from their timestamp in seconds, one batch at a time.
+# Cache invalidations shared by the processes serving the app, timed by the
+# database's clock in milliseconds so that every process reads the same times.
+RECORD_INVALIDATION = '''
+    CREATE (:Invalidation {id: {id}, tags: {tags}, at: timestamp()})
+'''
+
+INVALIDATIONS = '''
+    WITH timestamp() AS now
+    OPTIONAL MATCH (i:Invalidation)
+    WHERE i.at >= {since}
+    RETURN now, COLLECT(i.id) AS ids, COLLECT(i.tags) AS tags
+'''
+
+PRUNE_INVALIDATIONS = '''
+    MATCH (i:Invalidation)
+    WHERE i.at < {before}
+    WITH i LIMIT {limit}
+    DELETE i
+'''
+
+BACKFILL_QUESTION_CREATED_MS = '''
+    MATCH (n:Question)
+    WHERE n.created_ms IS NULL
+    WITH n LIMIT {limit}
+    SET n.created_ms = toInteger(coalesce(n.timestamp, 0) * 1000)
+    RETURN COUNT(n) AS updated
+'''
+
+BACKFILL_ANSWER_CREATED_MS = '''
+    MATCH (n:Answer)
+    WHERE n.created_ms IS NULL
+    WITH n LIMIT {limit}
+    SET n.created_ms = toInteger(coalesce(n.timestamp, 0) * 1000)
+    RETURN COUNT(n) AS updated
+'''
+
+# Where feed questions can come from. Each source starts at the reading user u,
+# carrying the candidates found so far, and binds the candidate question,
+# excluding the reader's own questions. The tag sources look questions up by
+# tag_mask instead of walking through Tag nodes, so a question sharing several
+# tags with the reader is found once rather than once per tag.
+FEED_SOURCES = {
+    'feed': 'OPTIONAL MATCH (u)-[:FEED]->(question:Question)',
+    'following': '''OPTIONAL MATCH (u)-[:FOLLOW]->(user:User)-[:PUBLISHED]->(question:Question)
+        WHERE NOT u = user''',
+    'tags': '''OPTIONAL MATCH (question:Question)<-[:PUBLISHED]-(user:User)
+        WHERE question.tag_mask IN %s AND NOT u = user''' % masks_sharing_tags('u.tag_mask'),
+    'following_of_following': '''OPTIONAL MATCH (u)-[:FOLLOW]->(:User)-[:FOLLOW]->(user:User)-[:PUBLISHED]->(question:Question)
+        WHERE NOT u = user''',
+    'tags_of_following': '''OPTIONAL MATCH (u)-[:FOLLOW]->(followed:User)
+    WITH u, candidates, COLLECT(followed.tag_mask) AS masks
+    WITH u, candidates, %s AS mask
+    OPTIONAL MATCH (question:Question)<-[:PUBLISHED]-(user:User)
+        WHERE question.tag_mask IN %s AND NOT u = user''' % (
+        union_of_masks('masks'), masks_sharing_tags('mask')),
+}
+
+# Question property each feed can be sorted on. Ties are broken on question.id.
+FEED_SORTS = {
+    'recent': 'update_timestamp',
+    'votes': 'upvote',
+}
+
+
+def feed_candidates(sources):
+    """Builds the part of a feed query that gathers the distinct candidate
+    questions of user u from the given sources, one source at a time, so that no
+    cross product of users, questions and tags is ever formed."""
+    clauses = ['''
+    WITH u, [] AS candidates''']
+    for source in sources:
+        clauses.append('''
+    %s
+    WITH u, candidates + COLLECT(DISTINCT question) AS candidates''' % FEED_SOURCES[source])
+    clauses.append('''
+    UNWIND candidates AS question
+    WITH DISTINCT u, question
+''')
+    return ''.join(clauses)
+
+
+def feed_query(sources, sort, after=False):
+    """Builds the query for one page of a feed. The page is cut with a keyset
+    condition on (sort key, id) when after is set, so every page costs the same."""
+    key = FEED_SORTS[sort]
+    query = '''
+    MATCH (u:User)
+    WHERE u.username = {username}
+''' + feed_candidates(sources)
+    if after:
+        query += '''
+    WITH question
+    WHERE question.%(key)s < {after_key}
+       OR (question.%(key)s = {after_key} AND question.id < {after_id})
+''' % {'key': key}
+    query += '''
+    WITH question
+    ORDER BY question.%(key)s DESC, question.id DESC LIMIT {limit}
+    MATCH (user:User)-[:PUBLISHED]->(question)
+    OPTIONAL MATCH (question)<-[:TAGGED]-(tag:Tag)
+    RETURN user.username AS username, question, COLLECT(tag.name) AS tags
+    ORDER BY question.%(key)s DESC, question.id DESC
+''' % {'key': key}
+    return query
+
+
+REBUILD_FEED = '''
+    MATCH (u:User)
+    WHERE u.username = {username}
+    OPTIONAL MATCH (u)-[f:FEED]->(:Question)
+    DELETE f
+    WITH DISTINCT u
+''' + feed_candidates(('following', 'tags')) + '''
+    WITH u, question
+    ORDER BY coalesce(question.update_timestamp, question.timestamp) DESC LIMIT {feed_size}
+    MERGE (u)-[:FEED]->(question)
+'''
+
+
+# Expression each answer page can be sorted on. Ties are broken on answer.id.
+ANSWER_SORTS = {
+    'votes': 'coalesce(answer.upvote, 0)',
+    'recent': 'answer.timestamp',
+}
+
+
+def answers_query(sort, after=False):
+    """Builds the query for one page of the answers to a question, cut with a
+    keyset condition on (sort key, id) when after is set."""
+    query = '''
+    MATCH (question:Question)<-[:ANSWERED]-(answer:Answer)<-[:PUBLISHED]-(u:User)
+    WHERE question.id = {question_id}
+    WITH u, answer, %s AS key
+''' % ANSWER_SORTS[sort]
+    if after:
+        query += '''
+    WHERE key < {after_key} OR (key = {after_key} AND answer.id < {after_id})
+'''
+    query += '''
+    RETURN u.username AS username, answer, key
+    ORDER BY key DESC, answer.id DESC LIMIT {limit}
+'''
+    return query
+
+
+def bookmarks_query(after=False):
+    """Builds the query for one page of a user's bookmarks, newest bookmark
+    first, cut with a keyset condition on (bookmark time, id) when after is set.
+    Bookmarks made before they were timed sort last."""
+    query = '''
+    MATCH (user:User)-[bookmark:BOOKMARK]->(question:Question)
+    WHERE user.username = {username}
+    WITH question, coalesce(bookmark.timestamp, 0) AS key
+'''
+    if after:
+        query += '''
+    WHERE key < {after_key} OR (key = {after_key} AND question.id < {after_id})
+'''
+    query += '''
+    WITH question, key
+    ORDER BY key DESC, question.id DESC LIMIT {limit}
+    MATCH (u:User)-[:PUBLISHED]->(question)
+    OPTIONAL MATCH (question)<-[:TAGGED]-(tag:Tag)
+    RETURN u.username AS username, question, COLLECT(tag.name) AS tags, key
+    ORDER BY key DESC, question.id DESC
+'''
+    return query
+
+
+def find_one(label, key):
+    """The statement behind Database.find_one for a label and key."""
+    return 'MATCH (n:%s) WHERE n.%s = {value} RETURN n LIMIT 1' % (label, key)
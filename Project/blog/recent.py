@@ -0,0 +1,76 @@
+from collections import deque
+import os
+import threading
+import time
+
+# How many of the newest questions are kept in memory.
+RECENT_CAPACITY = int(os.environ.get('RECENT_CAPACITY', 200))
+# How far back, in seconds, the front page looks.
+RECENT_WINDOW = float(os.environ.get('RECENT_WINDOW', 24 * 60 * 60))
+# Seconds between reloads, which pick up questions asked through other processes.
+RECENT_REFRESH = float(os.environ.get('RECENT_REFRESH', 30))
+
+
+def now_ms():
+    """The current time as integer milliseconds since the epoch."""
+    return int(time.time() * 1000)
+
+
+class RecentQuestions:
+    """A bounded ring buffer of the newest question rows ({"username", "question",
+    "tags"}), oldest on the left. Questions asked in this process are added as
+    they are written; every refresh seconds the buffer is reloaded with
+    load(since_ms, limit), which returns rows newest first, so the other
+    processes' questions show up too. Reading a page only walks the rows it
+    returns."""
+
+    def __init__(self, load, capacity=RECENT_CAPACITY, window=RECENT_WINDOW, refresh=RECENT_REFRESH):
+        self.load = load
+        self.capacity = capacity
+        self.window = window
+        self.refresh = refresh
+        self.rows = deque(maxlen=capacity)
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+
+    def add(self, row):
+        with self.lock:
+            self.rows.append(row)
+
+    def page(self, limit):
+        """The newest limit rows asked within the last window seconds, newest first."""
+        self.reload_if_stale()
+        since = now_ms() - int(self.window * 1000)
+        found = []
+        with self.lock:
+            for row in reversed(self.rows):
+                if len(found) == limit or row["question"]["created_ms"] < since:
+                    break
+                found.append(row)
+        return found
+
+    def reload_if_stale(self):
+        if self.loaded_at is not None and time.time() - self.loaded_at < self.refresh:
+            return
+        # Only one thread reloads. Once there is something to show, the others
+        # carry on with the rows they have instead of waiting for it.
+        if not self.reload_lock.acquire(self.loaded_at is None):
+            return
+        try:
+            if self.loaded_at is None or time.time() - self.loaded_at >= self.refresh:
+                self.reload()
+        finally:
+            self.reload_lock.release()
+
+    def reload(self):
+        started = now_ms()
+        rows = self.load(started - int(self.window * 1000), self.capacity)
+        loaded = set(row["question"]["id"] for row in rows)
+        with self.lock:
+            # Keep what was added while loading.
+            added = [row for row in self.rows
+                     if row["question"]["created_ms"] >= started and row["question"]["id"] not in loaded]
+            self.rows = deque(reversed(rows), maxlen=self.capacity)
+            self.rows.extend(added)
+            self.loaded_at = time.time()
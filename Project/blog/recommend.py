@@ -0,0 +1,274 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from . import queries
+from .tags import TAGS
+
+logger = logging.getLogger(__name__)
+
+# How many similar users and follow suggestions are kept per user.
+RECOMMEND_TOP_K = int(os.environ.get('RECOMMEND_TOP_K', 10))
+# Seconds between full reloads, which pick up changes made by other processes.
+RECOMMEND_REFRESH = float(os.environ.get('RECOMMEND_REFRESH', 3600))
+
+# How much publishing questions with a tag counts next to following the tag.
+ACTIVITY_WEIGHT = 0.5
+# Rows of the similarity matrix computed at once, to bound memory.
+BLOCK_SIZE = 1024
+
+BITS = np.arange(len(TAGS), dtype=np.int64)
+
+
+def tag_bits(masks):
+    """A len(masks) x TAGS matrix of the bits of tag masks (see tags.py), one row
+    per mask. Missing masks have no tags."""
+    masks = np.array([mask or 0 for mask in masks], dtype=np.int64)
+    return ((masks[:, None] >> BITS) & 1).astype(np.float32)
+
+
+def tag_counts(mask_lists):
+    """A users x TAGS matrix counting, for each list of tag masks, how many of
+    the masks have each tag."""
+    counts = np.zeros((len(mask_lists), len(TAGS)), dtype=np.float32)
+    for row, masks in enumerate(mask_lists):
+        if masks:
+            counts[row] = tag_bits(masks).sum(axis=0)
+    return counts
+
+
+def feature_vectors(tags, activity):
+    """Unit length rows combining the tags users follow with the tags of the
+    questions they published. Activity is log scaled so prolific users do not
+    drown out what they chose to follow."""
+    features = np.minimum(tags, 1) + ACTIVITY_WEIGHT * np.log1p(activity)
+    norms = np.sqrt((features * features).sum(axis=1))
+    norms[norms == 0] = 1
+    return features / norms[:, None]
+
+
+def top_k(scores, k):
+    """The columns of the k highest scores of every row, best first, and those
+    scores. Rows are padded with -1 and 0 when there are fewer than k columns."""
+    rows, columns = scores.shape
+    best = np.full((rows, k), -1, dtype=np.int64)
+    values = np.zeros((rows, k), dtype=np.float32)
+    n = min(k, columns)
+    if rows and n:
+        part = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        row = np.arange(rows)[:, None]
+        order = np.argsort(-scores[row, part], axis=1, kind='mergesort')
+        best[:, :n] = part[row, order]
+        values[:, :n] = scores[row, best[:, :n]]
+    return best, values
+
+
+class Table:
+    """The user x tag matrix, the follow adjacency and the precomputed top k
+    similar users and follow suggestions of every user, by row."""
+
+    def __init__(self, rows, follows, k):
+        self.k = k
+        self.usernames = [row['username'] for row in rows]
+        self.index = dict((name, i) for i, name in enumerate(self.usernames))
+        self.tags = tag_bits([row['tags'] for row in rows])
+        self.activity = tag_counts([row['activity'] for row in rows])
+        self.upvotes = np.array([row['upvote'] or 0 for row in rows], dtype=np.float32)
+        self.vectors = feature_vectors(self.tags, self.activity)
+        self.follows = [set() for _ in self.usernames]
+        self.followers = [set() for _ in self.usernames]
+        for row in follows:
+            self.follow(self.add(row['username']), self.add(row['follows']))
+        self.similar, self.similar_scores = top_k(np.zeros((len(self.usernames), 0)), k)
+        self.suggested = [[] for _ in self.usernames]
+        self.refresh_similar(range(len(self.usernames)))
+        self.refresh_suggestions(range(len(self.usernames)))
+
+    def add(self, username):
+        """The row of username, adding an empty one for users not seen yet."""
+        if username in self.index:
+            return self.index[username]
+        i = len(self.usernames)
+        self.usernames.append(username)
+        self.index[username] = i
+        empty = np.zeros((1, len(TAGS)), dtype=np.float32)
+        self.tags = np.vstack([self.tags, empty])
+        self.activity = np.vstack([self.activity, empty])
+        self.vectors = np.vstack([self.vectors, empty])
+        self.upvotes = np.append(self.upvotes, np.float32(0))
+        self.follows.append(set())
+        self.followers.append(set())
+        if hasattr(self, 'similar'):
+            best, values = top_k(np.zeros((1, 0)), self.k)
+            self.similar = np.vstack([self.similar, best])
+            self.similar_scores = np.vstack([self.similar_scores, values])
+            self.suggested.append([])
+        return i
+
+    def follow(self, i, j):
+        self.follows[i].add(j)
+        self.followers[j].add(i)
+
+    def set_user(self, row):
+        """Replaces the tags, activity and upvotes of one user. Returns the rows
+        whose similar users may have changed."""
+        i = self.add(row['username'])
+        self.tags[i] = tag_bits([row['tags']])[0]
+        self.activity[i] = tag_counts([row['activity']])[0]
+        self.upvotes[i] = row['upvote'] or 0
+        self.vectors[i] = feature_vectors(self.tags[i:i + 1], self.activity[i:i + 1])[0]
+        scores = self.vectors.dot(self.vectors[i])
+        scores[i] = 0
+        affected = (scores > self.similar_scores[:, -1]) | (self.similar == i).any(axis=1)
+        affected[i] = True
+        return np.nonzero(affected)[0]
+
+    def set_follows(self, username, followed):
+        """Replaces who one user follows. Returns the rows whose follow
+        suggestions may have changed: the user and their followers."""
+        i = self.add(username)
+        for j in self.follows[i]:
+            self.followers[j].discard(i)
+        self.follows[i] = set()
+        for name in followed:
+            self.follow(i, self.add(name))
+        return [i] + sorted(self.followers[i])
+
+    def refresh_similar(self, rows):
+        """Recomputes the most similar users of rows, by cosine similarity of their
+        feature vectors, a block of rows at a time."""
+        rows = np.asarray(list(rows), dtype=np.int64)
+        for start in range(0, len(rows), BLOCK_SIZE):
+            block = rows[start:start + BLOCK_SIZE]
+            scores = self.vectors[block].dot(self.vectors.T)
+            scores[np.arange(len(block)), block] = 0
+            best, values = top_k(scores, self.k)
+            best[values <= 0] = -1
+            values[values <= 0] = 0
+            self.similar[block] = best
+            self.similar_scores[block] = values
+
+    def refresh_suggestions(self, rows):
+        """Recomputes the follow suggestions of rows: users followed by those they
+        follow, ranked by how many of those follow them, then similarity, then
+        upvotes."""
+        n = len(self.usernames)
+        for i in rows:
+            followed = self.follows[i]
+            reached = [np.fromiter(self.follows[j], dtype=np.int64, count=len(self.follows[j]))
+                       for j in followed]
+            if not reached:
+                self.suggested[i] = []
+                continue
+            paths = np.bincount(np.concatenate(reached + [np.zeros(0, dtype=np.int64)]), minlength=n)
+            paths[i] = 0
+            paths[list(followed)] = 0
+            candidates = np.nonzero(paths)[0]
+            similarity = self.vectors[candidates].dot(self.vectors[i])
+            order = np.lexsort((-self.upvotes[candidates], -similarity, -paths[candidates]))
+            self.suggested[i] = candidates[order[:self.k]].tolist()
+
+    def similar_users(self, username, limit):
+        i = self.index.get(username)
+        if i is None:
+            return []
+        found = []
+        for j in self.similar[i][:limit]:
+            if j < 0:
+                break
+            shared = (self.vectors[i] > 0) & (self.vectors[j] > 0)
+            found.append({"similar_user": self.usernames[j],
+                          "tags": [TAGS[t] for t in np.nonzero(shared)[0]]})
+        return found
+
+    def suggestions(self, username, limit):
+        i = self.index.get(username)
+        if i is None:
+            return []
+        return [{"username": self.usernames[j]} for j in self.suggested[i][:limit]]
+
+
+class Recommender:
+    """Serves similar users and follow suggestions from a Table kept in memory,
+    so profile pages do not traverse the graph. The table is loaded on first use,
+    updated for the users whose tags, questions or follows change in this process,
+    and reloaded in the background every refresh seconds to pick up the rest."""
+
+    def __init__(self, graph, top_k=RECOMMEND_TOP_K, refresh=RECOMMEND_REFRESH):
+        self.graph = graph
+        self.top_k = top_k
+        self.refresh = refresh
+        self.table = None
+        self.loaded_at = 0
+        self.reloading = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Builds a new table from the whole graph and swaps it in."""
+        rows = self.graph.read(queries.RECOMMENDER_USERS).data()
+        follows = self.graph.read(queries.RECOMMENDER_FOLLOWS).data()
+        table = Table(rows, follows, self.top_k)
+        with self.lock:
+            self.table = table
+            self.loaded_at = time.time()
+            self.reloading = False
+        return len(table.usernames)
+
+    def current(self):
+        """The table, loading it the first time and starting a background reload
+        once it is older than refresh seconds."""
+        with self.lock:
+            if self.table is None:
+                self.load()
+            elif not self.reloading and time.time() - self.loaded_at > self.refresh:
+                self.reloading = True
+                threading.Thread(target=self._reload, daemon=True).start()
+            return self.table
+
+    def _reload(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception('Could not reload recommendations')
+            with self.lock:
+                self.reloading = False
+                self.loaded_at = time.time()
+
+    def similar_users(self, username, limit=3):
+        """The users whose tags are most like username's, as
+        [{"similar_user": ..., "tags": [shared tags]}]."""
+        table = self.current()
+        with self.lock:
+            return table.similar_users(username, limit)
+
+    def suggestions(self, username, limit=RECOMMEND_TOP_K):
+        """Users username may want to follow, as [{"username": ...}]."""
+        table = self.current()
+        with self.lock:
+            return table.suggestions(username, limit)
+
+    def user_changed(self, username):
+        """Updates the row of a user whose tags or questions changed. Does nothing
+        before the table is loaded, as the load will see the change."""
+        with self.lock:
+            if self.table is None:
+                return
+        rows = self.graph.read(queries.RECOMMENDER_USER, username=username).data()
+        with self.lock:
+            for row in rows:
+                affected = self.table.set_user(row)
+                self.table.refresh_similar(affected)
+                self.table.refresh_suggestions([self.table.index[username]])
+
+    def follows_changed(self, username):
+        """Updates who a user follows, and the suggestions that depend on it."""
+        with self.lock:
+            if self.table is None:
+                return
+        rows = self.graph.read(queries.RECOMMENDER_USER_FOLLOWS, username=username).data()
+        with self.lock:
+            affected = self.table.set_follows(username, [row['follows'] for row in rows])
+            self.table.refresh_suggestions(affected)
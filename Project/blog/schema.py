@@ -0,0 +1,146 @@
+import re
+
+from . import queries
+
+# (label, property) pairs that must be unique. Each also gets an index.
+CONSTRAINTS = [
+    ('User', 'username'),
+    ('Tag', 'name'),
+    ('Question', 'id'),
+    ('Answer', 'id'),
+    ('Term', 'word'),
+]
+
+# (label, property) pairs that are looked up or sorted on.
+INDEXES = [
+    ('Question', 'date'),
+    ('Question', 'timestamp'),
+    ('Question', 'update_timestamp'),
+    ('Question', 'upvote'),
+    ('User', 'username_lower'),
+    ('Answer', 'timestamp'),
+    ('Answer', 'upvote'),
+    ('Question', 'created_ms'),
+    ('Answer', 'created_ms'),
+    ('User', 'tag_mask'),
+    ('Question', 'tag_mask'),
+    ('Invalidation', 'at'),
+]
+
+# Maintenance statements that are meant to visit every node of a label.
+FULL_SCANS_ALLOWED = set([
+    'ALL_PIC_URLS',
+    'ALL_USERNAMES',
+    'FILL_USERNAME_LOWER',
+    'DELETE_SEARCH_TERMS',
+    'RECOMMENDER_USERS',
+    'RECOMMENDER_FOLLOWS',
+    'ALL_NODES',
+    'ALL_RELATIONSHIPS',
+    'BACKFILL_QUESTION_CREATED_MS',
+    'BACKFILL_ANSWER_CREATED_MS',
+])
+
+# Plan operators that read a whole label, or the whole graph.
+SCAN_OPERATORS = set(['NodeByLabelScan', 'AllNodesScan'])
+
+# Values used for parameters when asking for plans. Anything not listed is a string.
+SAMPLE_PARAMETERS = {
+    'tags': ['art'],
+    'terms': [{'word': 'word', 'tf': 1}],
+    'words': ['word'],
+    'ids': ['id'],
+    'limit': 10,
+    'skip': 0,
+    'timestamp': 0.0,
+    'after_key': 0,
+    'user': {'username': 'username'},
+    'question': {'id': 'id'},
+    'answer': {'id': 'id'},
+    'rows': [],
+    'mask': 0,
+    'masks': [],
+    'question_ids': [],
+    'feed_size': 500,
+    'feed_slack': 50,
+    'since': 0.0,
+    'before': 0,
+}
+
+PARAMETER = re.compile(r'\{(\w+)\}')
+INDEX_DESCRIPTION = re.compile(r':(\w+)\((\w+)\)')
+
+
+def existing_indexes(graph):
+    """Returns the (label, property) pairs that already have an index, and the
+    ones that already have a uniqueness constraint."""
+    indexes, constraints = set(), set()
+    for row in graph.read('CALL db.indexes()').data():
+        match = INDEX_DESCRIPTION.search(row['description'])
+        if not match:
+            continue
+        indexes.add(match.groups())
+        if row.get('type') == 'node_unique_property':
+            constraints.add(match.groups())
+    return indexes, constraints
+
+
+def ensure_schema(graph):
+    """Creates every missing constraint and index. Safe to run any number of
+    times. Returns the statements that were run."""
+    indexes, constraints = existing_indexes(graph)
+    statements = []
+    for label, key in CONSTRAINTS:
+        if (label, key) not in constraints:
+            statements.append('CREATE CONSTRAINT ON (n:%s) ASSERT n.%s IS UNIQUE' % (label, key))
+    for label, key in INDEXES:
+        if (label, key) not in indexes:
+            statements.append('CREATE INDEX ON :%s(%s)' % (label, key))
+    for statement in statements:
+        graph.run(statement)
+    return statements
+
+
+def statements():
+    """Every statement the models can run, by name, including each feed, each
+    page of answers and bookmarks, and the lookups done through Database.find_one."""
+    from .models import FEEDS
+    found = dict((name, value) for name, value in vars(queries).items()
+                 if name.isupper() and isinstance(value, str))
+    for feed, (sources, sort) in FEEDS.items():
+        found['FEED_%s' % feed.upper()] = queries.feed_query(sources, sort)
+        found['FEED_%s_AFTER' % feed.upper()] = queries.feed_query(sources, sort, after=True)
+    for sort in queries.ANSWER_SORTS:
+        found['ANSWERS_%s' % sort.upper()] = queries.answers_query(sort)
+        found['ANSWERS_%s_AFTER' % sort.upper()] = queries.answers_query(sort, after=True)
+    found['USER_BOOKMARKS'] = queries.bookmarks_query()
+    found['USER_BOOKMARKS_AFTER'] = queries.bookmarks_query(after=True)
+    found['FIND_ONE_USER'] = queries.find_one('User', 'username')
+    return found
+
+
+def scans(plan):
+    """Lists the full scan operators anywhere in a plan."""
+    found = [plan['operator']] if plan['operator'] in SCAN_OPERATORS else []
+    for child in plan['children']:
+        found.extend(scans(child))
+    return found
+
+
+def check_queries(graph):
+    """EXPLAINs every statement and returns {name: [scan operators]} for those
+    whose plan reads a whole label. Statements in FULL_SCANS_ALLOWED are skipped.
+    An empty result means every lookup is served by an index."""
+    failures = {}
+    for name, statement in sorted(statements().items()):
+        if name in FULL_SCANS_ALLOWED:
+            continue
+        parameters = dict((key, SAMPLE_PARAMETERS.get(key, key))
+                          for key in PARAMETER.findall(statement))
+        plan = graph.explain(statement, parameters)
+        if plan is None:
+            raise RuntimeError('The database did not return a plan for %s' % name)
+        found = scans(plan)
+        if found:
+            failures[name] = found
+    return failures
@@ -0,0 +1,37 @@
+from collections import Counter
+import re
+
+WORD = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = set('''
+    a an and are as at be but by do does for from has have how i if in is it its
+    me my no not of on or so that the their them there they this to was we what
+    when where which who why will with you your
+'''.split())
+
+# How much a word counts towards a question's score, by where it was found.
+TITLE_WEIGHT = 3
+TEXT_WEIGHT = 1
+
+SEARCH_PAGE_SIZE = 10
+
+
+def words(text):
+    """Splits text into the lower case words that are indexed."""
+    return [word for word in WORD.findall((text or '').lower())
+            if word not in STOP_WORDS and len(word) > 1]
+
+
+def term_weights(*weighted_texts):
+    """Counts the weighted occurrences of every word in (text, weight) pairs and
+    returns them as [{"word": ..., "tf": ...}], ready to be sent as a parameter."""
+    counts = Counter()
+    for text, weight in weighted_texts:
+        for word in words(text):
+            counts[word] += weight
+    return [{"word": word, "tf": tf} for word, tf in sorted(counts.items())]
+
+
+def query_words(text):
+    """The distinct indexed words of a search query."""
+    return sorted(set(words(text)))
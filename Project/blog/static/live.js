@@ -0,0 +1,73 @@
+// Keeps the answers on show_question up to date from the question's live update
+// stream: new answers are added and upvote totals replaced as they happen.
+(function () {
+  var script = document.currentScript;
+  var list = document.getElementById('answers');
+  if (!script || !list || !window.EventSource) {
+    return;
+  }
+  var source = new EventSource(script.getAttribute('data-url'));
+
+  function card(answerId) {
+    return list.querySelector('[data-answer="' + answerId + '"]');
+  }
+
+  function link(href, text) {
+    var a = document.createElement('a');
+    a.className = 'link';
+    a.href = href;
+    a.textContent = text;
+    return a;
+  }
+
+  source.addEventListener('answer', function (message) {
+    var answer = JSON.parse(message.data);
+    if (card(answer.id)) {
+      return;
+    }
+    var empty = list.querySelector('.empty');
+    if (empty) {
+      list.removeChild(empty);
+    }
+    var item = document.createElement('li');
+    item.setAttribute('data-answer', answer.id);
+    var body = document.createElement('div');
+    body.className = 'question';
+    var title = document.createElement('a');
+    title.textContent = 'Answer';
+    var votes = document.createElement('span');
+    votes.className = 'votes';
+    votes.textContent = '0';
+    body.appendChild(title);
+    body.appendChild(document.createTextNode(' by '));
+    body.appendChild(link(script.getAttribute('data-profile').replace('USERNAME', encodeURIComponent(answer.username)),
+                          answer.username));
+    body.appendChild(document.createTextNode(' on ' + answer.date + ' '));
+    body.appendChild(link(script.getAttribute('data-upvote').replace('ANSWER', answer.id), 'Upvote'));
+    body.appendChild(document.createTextNode(' '));
+    body.appendChild(votes);
+    body.appendChild(document.createTextNode(' upvotes'));
+    body.appendChild(document.createElement('br'));
+    body.appendChild(document.createTextNode(answer.text));
+    item.appendChild(body);
+    if (script.getAttribute('data-sort') === 'recent') {
+      list.insertBefore(item, list.firstChild);
+    } else {
+      list.appendChild(item);
+    }
+  });
+
+  source.addEventListener('votes', function (message) {
+    var votes = JSON.parse(message.data);
+    var answer = card(votes.id);
+    if (answer) {
+      answer.querySelector('.votes').textContent = votes.upvote;
+    }
+  });
+
+  // Sent when this page fell too far behind to catch up event by event.
+  source.addEventListener('reload', function () {
+    source.close();
+    window.location.reload();
+  });
+})();
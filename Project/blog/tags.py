@@ -0,0 +1,35 @@
+# The tags a question or user can have, in the order of the checkboxes in
+# index.html and change_user_tags.html.
+TAGS = [
+    'art',
+    'exercise',
+    'food',
+    'hobbies',
+    'lifestyle',
+    'music',
+    'nature',
+    'psychology',
+    'relationships',
+    'technology',
+]
+
+# Every tag has a bit, by its position in TAGS, so the tags of a user or question
+# fit in one integer, kept as tag_mask on the node. New tags must go at the end,
+# as existing masks depend on the positions.
+TAG_BITS = dict((tag, 1 << i) for i, tag in enumerate(TAGS))
+ALL_TAGS_MASK = (1 << len(TAGS)) - 1
+
+
+def mask_of(names):
+    """The tag mask of a list of tag names. Names that are not in TAGS are left
+    out; they still get Tag relationships."""
+    mask = 0
+    for name in names:
+        mask |= TAG_BITS.get(name, 0)
+    return mask
+
+
+def names_of(mask):
+    """The tag names in a tag mask, in the order of TAGS."""
+    return [tag for tag in TAGS if mask & TAG_BITS[tag]]
+
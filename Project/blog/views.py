@@ -1,19 +1,89 @@
-from .models import User, get_todays_recent_questions, get_question, get_answers, do_search
-from flask import Flask, request, session, redirect, url_for, render_template, flash, send_from_directory
-
-import os, logging
+from .models import User, graph, get_latest_questions, get_question, get_answers, search_questions, search_users, \
+    live_updates, timestamp
+from .queries import ANSWER_SORTS
+from .search import SEARCH_PAGE_SIZE
+from .executor import run_concurrently
+from .passwords import PasswordServiceBusy
+from . import images
+from . import metrics
+from .fragments import fragment, bytecode_cache
+from .cache import cache
+from .live import server_sent_events
+from . import assets
+from flask import Flask, request, session, redirect, url_for, render_template, flash, send_from_directory, g, Response
+
+import os, logging, time
+from datetime import datetime
 from werkzeug.utils import secure_filename
 
 
 app = Flask(__name__)
+app.jinja_options = dict(Flask.jinja_options, bytecode_cache=bytecode_cache())
+app.add_template_global(fragment)
+# Every worker process must sign sessions with the same key.
+app.secret_key = os.environ.get('SECRET_KEY')
 file_handler = logging.FileHandler('server.log')
 app.logger.addHandler(file_handler)
 app.logger.setLevel(logging.INFO)
+# Statements slower than metrics.SLOW_QUERY_MS, one JSON object per line.
+slow_query_handler = logging.FileHandler('slow_queries.log')
+metrics.slow_log.addHandler(slow_query_handler)
+metrics.slow_log.setLevel(logging.INFO)
+
+# Shown when the password hashing queue is full.
+BUSY_MESSAGE = 'The server is busy, please try again in a moment.'
 
 PROJECT_HOME = os.path.dirname(os.path.realpath(__file__))
 UPLOAD_FOLDER = 'static/uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
+# Leaves a little room for the rest of the form around the image itself.
+app.config['MAX_CONTENT_LENGTH'] = images.MAX_IMAGE_BYTES + 64 * 1024
+# Uploaded images are named after their content, so they never change.
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@app.before_request
+def start_timing():
+    """Starts counting the time and statements spent on this request."""
+    g.request_started = time.time()
+    metrics.start_request()
+
+@app.before_request
+def sync_cache():
+    """Drops the cache entries other processes invalidated since the last request."""
+    cache.sync()
+
+@app.after_request
+def record_timing(response):
+    """Records the request's latency, database time and statement count by route."""
+    stats = metrics.end_request()
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.time() - started, stats)
+    return response
+
+@app.route('/ready')
+def ready():
+    """Answers 200 once this process can reach the database, and 503 until then,
+    so a load balancer only sends it traffic it can serve."""
+    if graph.ping():
+        return Response('ready\n', mimetype='text/plain')
+    return Response('database unavailable\n', status=503, mimetype='text/plain')
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Query and request metrics of this process in the Prometheus text format."""
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def log_identity_map(response):
+    """Logs how many node lookups the request's identity map saved."""
+    identity_map = getattr(g, 'identity_map', None)
+    if identity_map is not None:
+        app.logger.debug('%s: %d node lookups, %d avoided',
+            request.path, identity_map.loads, identity_map.avoided)
+    return response
 
 def create_new_folder(local_dir):
     """Creates a folder if it does not exist already."""
@@ -25,24 +95,69 @@ def create_new_folder(local_dir):
 @app.route('/upload_file/<username>', methods=['GET', 'POST'])
 def upload_file(username):
     """Handles image uploads for profile pics. Modified from example given by FLASK.
-    Files are saved as <username>.<original type>, eg user.jpg. This ensures there is
-    always only one image per user."""
+    Files are streamed to disk and saved as <sha256 of content>.<original type>, so a
+    new picture always gets a new URL. Old pictures are removed by clean-images."""
     if request.method == 'POST' and request.files['file']:
-    	img = request.files['file']
-    	create_new_folder(app.config['UPLOAD_FOLDER'])
-    	saved_path =PROJECT_HOME + "/" + os.path.join(app.config['UPLOAD_FOLDER'], username + "." + img.filename.split(".")[-1])
-    	img.save(saved_path)
-    	User(username).change_pic_url(username + "." + img.filename.split(".")[-1])
-    	return redirect(url_for('index'))
+        img = request.files['file']
+        if not allowed_file(img.filename):
+            flash('Profile pictures must be one of: ' + ', '.join(sorted(images.ALLOWED_EXTENSIONS)) + '.')
+            return render_template('upload_file.html')
+        folder = create_new_folder(os.path.join(PROJECT_HOME, app.config['UPLOAD_FOLDER']))
+        try:
+            name = images.store_upload(img.stream, img.filename.rsplit('.', 1)[1].lower(), folder)
+        except images.ImageTooLarge:
+            flash('Profile pictures must be smaller than %d MB.' % (images.MAX_IMAGE_BYTES // (1024 * 1024)))
+            return render_template('upload_file.html')
+        User(username).change_pic_url(name)
+        return redirect(url_for('index'))
     else:
         return render_template('upload_file.html')
 
+def asset_url(endpoint, **values):
+    """url_for, except that static files point at their fingerprinted build when
+    the assets have been built."""
+    if endpoint == 'static':
+        hashed = assets.fingerprint_of(values.get('filename'))
+        if hashed is not None:
+            values['filename'] = hashed
+            endpoint = 'asset'
+    return url_for(endpoint, **values)
+
+app.add_template_global(asset_url)
+
+@app.template_filter('activity')
+def activity(seconds):
+    """Formats a time from models.timestamp(), which counts local time as if it
+    were UTC."""
+    if seconds is None:
+        return ''
+    return datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%d %H:%M')
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """Serves a fingerprinted static file, precompressed when the client accepts
+    it. The name changes with the content, so it can be cached forever."""
+    name, encoding = assets.variant(filename, lambda coding: request.accept_encodings[coding])
+    response = send_from_directory(assets.BUILD_FOLDER, name, mimetype=assets.mimetype(filename))
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+    return response
+
+@app.route('/uploads/<filename>')
+def uploaded_image(filename):
+    """Serves uploaded images. Content-addressed ones are cached for a year."""
+    max_age = IMMUTABLE_MAX_AGE if images.is_content_addressed(filename) else None
+    return send_from_directory(os.path.join(PROJECT_HOME, app.config['UPLOAD_FOLDER']),
+        filename, cache_timeout=max_age)
+
 
 
 @app.route('/')
 def index():
-    """Gets all the recent questions, returns with index template."""
-    questions = get_todays_recent_questions()
+    """Gets the questions asked in the last 24 hours, returns with index template."""
+    questions = get_latest_questions()
     return render_template('index.html', questions=questions)
 
 @app.route('/register', methods=['GET','POST'])
@@ -56,12 +171,18 @@ def register():
             flash('Your username must be at least one character.')
         elif len(password) < 5:
             flash('Your password must be at least 5 characters.')
-        elif not User(username).register(password):
-            flash('A user with that username already exists.')
         else:
-            session['username'] = username
-            flash('Logged in.')
-            return redirect(url_for('index'))
+            try:
+                registered = User(username).register(password)
+            except PasswordServiceBusy:
+                flash(BUSY_MESSAGE)
+                return render_template('register.html'), 503
+            if not registered:
+                flash('A user with that username already exists.')
+            else:
+                session['username'] = username
+                flash('Logged in.')
+                return redirect(url_for('index'))
     return render_template('register.html')
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -70,7 +191,12 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        if not User(username).verify_password(password):
+        try:
+            verified = User(username).verify_password(password)
+        except PasswordServiceBusy:
+            flash(BUSY_MESSAGE)
+            return render_template('login.html'), 503
+        if not verified:
             flash('Invalid login.')
         else:
             session['username'] = username
@@ -162,17 +288,25 @@ def profile(username):
     logged_in_username = session.get('username')
     user_being_viewed_username = username
     user_being_viewed = User(user_being_viewed_username)
-    questions = user_being_viewed.get_recent_questions()
-    userbio = user_being_viewed.get_bio()
-    recommend_users = []
-    common = []
-    profile_pic_url = "/static/uploads/" + user_being_viewed.get_pic_url()
+    # These queries don't depend on each other, so they run at the same time.
+    queries = {
+        'questions': (lambda: user_being_viewed.get_recent_questions().data(), []),
+        'userbio': (user_being_viewed.get_bio, ''),
+        'pic_url': (user_being_viewed.get_pic_url, 'default0.jpg'),
+    }
     if logged_in_username:
         logged_in_user = User(logged_in_username)
         if logged_in_user.username == user_being_viewed.username:
-            recommend_users = logged_in_user.suggest_follow()
+            queries['recommend_users'] = (logged_in_user.suggest_follow, [])
         else:
-            common = logged_in_user.get_commonality_of_user(user_being_viewed)
+            queries['common'] = (lambda: logged_in_user.get_commonality_of_user(user_being_viewed), [])
+    results = run_concurrently(queries)
+    questions = results['questions']
+    userbio = results['userbio']
+    recommend_users = results.get('recommend_users', [])
+    common = results.get('common', [])
+    profile_pic_url = url_for('uploaded_image', filename=images.display_name(
+        os.path.join(PROJECT_HOME, app.config['UPLOAD_FOLDER']), results['pic_url'], 'profile'))
     return render_template(
         'profile.html',
         username=username,
@@ -243,14 +377,18 @@ def change_password(username):
         print("OLD: " + old_password)
         print("NEW: " + new_password)
         print("CONFIRM: " + confirm_password)
-        if not User(username).verify_password(old_password):
-            flash('Invalid old password.')
-        elif (new_password != confirm_password):
-            flash('New passwords do not match.')
-        else:
-            user = User(username)
-            user.change_password(new_password)
-            return redirect(url_for('index'))
+        try:
+            if not User(username).verify_password(old_password):
+                flash('Invalid old password.')
+            elif (new_password != confirm_password):
+                flash('New passwords do not match.')
+            else:
+                user = User(username)
+                user.change_password(new_password)
+                return redirect(url_for('index'))
+        except PasswordServiceBusy:
+            flash(BUSY_MESSAGE)
+            return render_template('change_password.html'), 503
     return render_template(
         'change_password.html'
         )
@@ -269,11 +407,38 @@ def change_bio(username):
 
 @app.route('/show_question/<question_id>', methods=['GET','POST'])
 def show_question(question_id):
-    """Gets a question and all related answers and displays them."""
+    """Gets a question and a page of its answers and displays them. Answers are
+    sorted by ?sort=votes (the default) or ?sort=recent, and the next page is
+    requested with ?after=<cursor>."""
     session['question_id'] = question_id
+    sort = request.args.get('sort', 'votes')
+    if sort not in ANSWER_SORTS:
+        sort = 'votes'
+    rendered = timestamp()
     questions = get_question(question_id)
-    answers = get_answers(question_id)
-    return render_template('show_question.html', questions=questions, answers=answers)
+    answers, after = get_answers(question_id, sort, request.args.get('after'))
+    return render_template('show_question.html', question_id=question_id, questions=questions,
+                           answers=answers, sort=sort, after=after, rendered=rendered)
+
+
+@app.route('/show_question/<question_id>/live')
+def live_answers(question_id):
+    """Streams the new answers to a question and the new upvote totals of its
+    answers as server-sent events, starting after the Last-Event-ID the browser
+    sends when it reconnects, or else after ?since=, when the page was rendered."""
+    if not session.get('username'):
+        return Response(status=403)
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        since = float(since) if since else None
+    except ValueError:
+        since = None
+    subscription = live_updates.subscribe(question_id, since)
+    if subscription is None:
+        # Browsers do not reconnect after a 204; the page still works, just not live.
+        return Response(status=204)
+    return Response(server_sent_events(live_updates, subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/add_answer', methods=['POST'])
@@ -289,40 +454,53 @@ def add_answer():
 
 @app.route('/show_bookmarked/<username>', methods=['GET','POST'])
 def show_bookmarked(username):
-    """Gets all the user's bookmarked questions."""
-    questions = User(username).get_bookmarks()
-    return render_template('show_bookmarked.html', questions=questions)
+    """Gets a page of the user's bookmarked questions, most recently bookmarked
+    first. The next page is requested with ?after=<cursor>."""
+    questions, after = User(username).get_bookmarks(request.args.get('after'))
+    return render_template('show_bookmarked.html', username=username, questions=questions, after=after)
 
 @app.route('/timeline/<username>', methods=['GET','POST'])
 def timeline(username):
-    """Gets all the users followed questions, arranged according to most
-    recently modified."""
-    questions = User(username).get_timeline()
-    return render_template('timeline.html', questions=questions)
+    """Gets a page of the users followed questions, arranged according to most
+    recently modified. The next page is requested with ?after=<cursor>."""
+    questions, after = User(username).get_timeline(request.args.get('after'))
+    return render_template('timeline.html', username=username, questions=questions, after=after)
 
 @app.route('/voteline/<username>', methods=['GET','POST'])
 def voteline(username):
-    """Gets all the user's followed questions, arranged according to
-    most upvotes."""
-    questions = User(username).get_voteline()
-    return render_template('voteline.html', questions=questions)
+    """Gets a page of the user's followed questions, arranged according to
+    most upvotes. The next page is requested with ?after=<cursor>."""
+    questions, after = User(username).get_voteline(request.args.get('after'))
+    return render_template('voteline.html', username=username, questions=questions, after=after)
 
 
 @app.route('/feedline/<username>', methods=['GET','POST'])
 def feedline(username):
-    """Gets all the user's followed questions, arranged according to
-    most upvotes."""
-    questions = User(username).get_following_feed()
-    return render_template('voteline.html', questions=questions)
+    """Gets a page of the questions seen by those the user follows, arranged
+    according to most upvotes. The next page is requested with ?after=<cursor>."""
+    questions, after = User(username).get_following_feed(request.args.get('after'))
+    return render_template('feedline.html', username=username, questions=questions, after=after)
 
 
 
 @app.route('/user_search/<username>', methods=['GET','POST'])
 def user_search(username):
-    """Displays the search results of a search for a user."""
-    usernm = request.form['user']
-    user = do_search(usernm)
-    return render_template('user_search.html', username=username, user=user)
+    """Displays the users whose names start with what was searched for, one page
+    at a time."""
+    usernm = request.form['user'] if request.method == 'POST' else request.args.get('user', '')
+    page = max(request.args.get('page', 0, type=int), 0)
+    users = search_users(usernm, page)
+    return render_template('user_search.html', username=username, user=usernm, users=users, page=page,
+                           page_size=SEARCH_PAGE_SIZE)
+
+@app.route('/search')
+def search():
+    """Displays the questions matching a search, best first, one page at a time.
+    Answers are searched too, and find the question they answer."""
+    text = request.args.get('q', '')
+    page = max(request.args.get('page', 0, type=int), 0)
+    questions = search_questions(text, page)
+    return render_template('search.html', q=text, questions=questions, page=page, page_size=SEARCH_PAGE_SIZE)
 
 @app.route('/follow_user/<username>')
 def follow_user(username):
@@ -349,12 +527,12 @@ def open_follow(username):
         return redirect(url_for('login'))
     if(user.test_follow(username_him) == True):
         User(username_me).follow_user(username_him)
-        questions = User(username).get_timeline()
+        questions, after = User(username).get_timeline()
         return render_template('open_follow.html', questions=questions)
     flash('You must follow this user to see this data.')
     return redirect(request.referrer)
 
 def allowed_file(filename):
-    """Note used anymore."""
+    """Checks that an uploaded file has an image extension."""
     return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+           filename.rsplit('.', 1)[1].lower() in images.ALLOWED_EXTENSIONS
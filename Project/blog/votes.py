@@ -0,0 +1,58 @@
+from collections import Counter
+import atexit
+import threading
+
+
+class VoteBuffer:
+    """Collects upvote counter increments in memory and hands them to a writer
+    as aggregated deltas, at most once every interval seconds. A burst of votes
+    on one answer then costs one counter update per flush instead of one write
+    per vote on the same question and user nodes."""
+
+    def __init__(self, writer, interval=2.0, max_pending=500):
+        self.writer = writer
+        self.interval = interval
+        self.max_pending = max_pending
+        self.questions = Counter()
+        self.users = Counter()
+        self.lock = threading.Lock()
+        self.timer = None
+        atexit.register(self.flush)
+
+    def record(self, question_id, username, delta=1):
+        """Adds delta to the pending counts of a question and its author. Flushes
+        right away if too many distinct nodes are waiting."""
+        with self.lock:
+            self.questions[question_id] += delta
+            self.users[username] += delta
+            pending = len(self.questions) + len(self.users)
+            self._schedule()
+        if pending >= self.max_pending:
+            self.flush()
+
+    def flush(self):
+        """Writes all pending deltas through the writer in one call. On failure the
+        deltas are put back so the next flush retries them."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            questions, self.questions = self.questions, Counter()
+            users, self.users = self.users, Counter()
+        if not questions and not users:
+            return
+        try:
+            self.writer(dict(questions), dict(users))
+        except Exception:
+            with self.lock:
+                self.questions.update(questions)
+                self.users.update(users)
+                self._schedule()
+            raise
+
+    def _schedule(self):
+        """Starts the flush timer if it is not running. Call with the lock held."""
+        if self.timer is None:
+            self.timer = threading.Timer(self.interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
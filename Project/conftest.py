@@ -0,0 +1,43 @@
+import os
+
+# The tests run against a graph in this process, so they need no Neo4j server.
+os.environ['GRAPH_BACKEND'] = 'memory'
+os.environ.pop('GRAPH_MEMORY_FILE', None)
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+os.environ.setdefault('SECRET_KEY', 'test')
+
+import pytest
+
+from blog import app, models
+from blog.cache import cache
+from blog.memory import MemoryBackend
+
+
+@pytest.fixture(autouse=True)
+def graph():
+    """Gives every test an empty graph, and empty caches and buffers to match."""
+    models.vote_buffer.flush()
+    models.graph.backend = MemoryBackend()
+    cache.clear()
+    models.warm_up()
+    yield models.graph
+    models.vote_buffer.flush()
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    return app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    """Registers username, or logs in as it if it exists, on the test client."""
+    def login(username, password='secret1'):
+        client.get('/logout')
+        response = client.post('/register', data={'username': username, 'password': password})
+        if response.status_code != 302:
+            response = client.post('/login', data={'username': username, 'password': password})
+        assert response.status_code == 302
+        return models.User(username)
+    return login
@@ -0,0 +1,59 @@
+import os
+
+# Run with: gunicorn -c gunicorn.conf.py wsgi:app
+# Sending the master SIGHUP starts new workers and lets the old ones finish the
+# requests they have before stopping, so nothing is dropped.
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '5000')
+# One worker per core by default. Each keeps its own caches, and they share what
+# they invalidate through the database (see cache.InvalidationLog), so a write made
+# through one worker is not read back stale through another.
+if os.environ.get('GRAPH_BACKEND') == 'memory':
+    workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+else:
+    workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+if workers > 1 and os.environ.get('GRAPH_BACKEND') == 'memory':
+    # Every worker would have its own graph, and all of them would save to the
+    # same GRAPH_MEMORY_FILE.
+    raise RuntimeError('GRAPH_BACKEND=memory needs WEB_CONCURRENCY=1, not %d.' % workers)
+# gevent workers hold the live update streams of show_question as greenlets, so
+# thousands of open pages cost no threads. WEB_WORKER_CLASS=gthread runs WEB_THREADS
+# threads per worker instead, without live updates unless LIVE_MAX_STREAMS is set.
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gevent')
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_connections = int(os.environ.get('WEB_CONNECTIONS', 5000))
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# Restart workers now and then, at different times, to bound slow memory growth.
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+# Every worker imports the app itself, so SIGHUP starts workers on the code as it
+# is now.
+preload_app = False
+accesslog = '-'
+
+if worker_class == 'gevent':
+    # Patched before any worker imports the app, so the locks, queues and thread
+    # pools it creates on import are gevent's too.
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def post_worker_init(worker):
+    """Warms the new worker's caches once it has loaded the app, before it takes
+    requests."""
+    from blog.models import warm_up
+    try:
+        warm_up()
+    except Exception:
+        worker.log.exception('Worker %s could not warm up', worker.pid)
+
+
+def worker_exit(server, worker):
+    """Writes the votes the worker is still holding before it goes."""
+    from blog.models import vote_buffer, graph
+    try:
+        vote_buffer.flush()
+    finally:
+        graph.close()
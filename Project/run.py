@@ -1,6 +1,7 @@
 from blog import app
 import os
 
-app.secret_key = os.urandom(24)
+# For development only; production runs wsgi:app under gunicorn (see gunicorn.conf.py).
+app.secret_key = app.secret_key or os.urandom(24)
 port = int(os.environ.get('PORT', 5000))
-app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+app.run(host='0.0.0.0', port=port)
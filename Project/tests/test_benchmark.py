@@ -0,0 +1,20 @@
+from blog import app, benchmark
+
+
+def test_routes_without_timed_requests_report_no_latency():
+    data = benchmark.generate(users=10, seed=2)
+    report = benchmark.drive(app, data, requests=2, concurrency=1, seed=2)
+
+    untimed = [timing for timing in report['routes'].values() if not timing['requests']]
+    assert untimed
+    assert all(timing['p95_ms'] is None for timing in untimed)
+    assert benchmark.compare(report, report) == []
+
+
+def test_compare_finds_slower_routes():
+    before = {"routes": {"index": {"p95_ms": 10.0, "round_trips": 2.0},
+                         "profile": {"p95_ms": None, "round_trips": 2.0}}}
+    now = {"routes": {"index": {"p95_ms": 20.0, "round_trips": 3.0},
+                      "profile": {"p95_ms": 5.0, "round_trips": 2.0}}}
+    assert benchmark.compare(before, now) == ['index: p95 20.0 ms, was 10.0 ms',
+                                              'index: 3.0 round trips, was 2.0']
@@ -0,0 +1,71 @@
+import json
+import os
+
+import pytest
+
+from blog import benchmark, bulk, models
+from blog.memory import MemoryBackend
+
+
+def exported():
+    return sorted(json.dumps(record, sort_keys=True) for record in bulk.export_records(page_size=7))
+
+
+def export_to(folder, form):
+    if form == 'csv':
+        bulk.write_csv(bulk.export_records(page_size=7), str(folder))
+        return [str(folder / name) for name in sorted(os.listdir(str(folder)))]
+    path = str(folder / 'graph.jsonl')
+    with open(path, 'w') as out:
+        bulk.write_jsonl(bulk.export_records(page_size=7), out)
+    return [path]
+
+
+def setup_graph():
+    data = benchmark.generate(users=20, seed=3)
+    models.User(data['users'][0]).bookmark_question(data['questions'][0])
+    models.vote_buffer.flush()
+    return exported()
+
+
+@pytest.mark.parametrize('form', ['jsonl', 'csv'])
+def test_an_export_imports_back_to_the_same_graph(tmp_path, form):
+    before = setup_graph()
+    files = export_to(tmp_path, form)
+    models.graph.backend = MemoryBackend()
+
+    bulk.import_files(files, batch_size=5)
+
+    assert exported() == before
+
+
+def test_a_stopped_import_resumes_from_its_checkpoint(tmp_path, monkeypatch):
+    before = setup_graph()
+    files = export_to(tmp_path, 'jsonl')
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    models.graph.backend = MemoryBackend()
+    write_batch, written = bulk.write_batch, []
+
+    def failing(kind, rows):
+        if kind == 'answer' and len(written) == 2:
+            raise RuntimeError('connection lost')
+        if kind == 'answer':
+            written.append(len(rows))
+        return write_batch(kind, rows)
+
+    monkeypatch.setattr(bulk, 'write_batch', failing)
+    with pytest.raises(RuntimeError):
+        bulk.import_files(files, batch_size=5, checkpoint=checkpoint)
+    with open(checkpoint) as handle:
+        saved = json.load(handle)
+    assert saved['stage'] == bulk.STAGES.index(('answer', 'bookmark'))
+    assert saved['done']['answer'] == sum(written) == 10
+
+    monkeypatch.setattr(bulk, 'write_batch', write_batch)
+    totals = bulk.import_files(files, batch_size=5, checkpoint=checkpoint)
+
+    answers = sum(1 for record in before if '"type": "answer"' in record)
+    assert totals['answer'] == answers - 10
+    assert 'user' not in totals
+    assert not os.path.exists(checkpoint)
+    assert exported() == before
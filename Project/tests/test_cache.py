@@ -0,0 +1,123 @@
+import threading
+import time
+
+from blog import models, queries
+from blog.cache import Cache, InvalidationLog
+
+
+def test_memoize_shares_entries_between_positional_keyword_and_default_arguments():
+    cache = Cache(maxsize=10, ttl=60)
+    calls = []
+
+    @cache.memoize(lambda value, name, page=0: ['name:' + name])
+    def lookup(name, page=0):
+        calls.append((name, page))
+        return name * (page + 1)
+
+    assert lookup('a') == 'a'
+    assert lookup('a', 0) == 'a'
+    assert lookup('a', page=0) == 'a'
+    assert lookup(name='a', page=0) == 'a'
+    assert lookup('a', page=1) == 'aa'
+    assert calls == [('a', 0), ('a', 1)]
+
+
+def test_memoize_passes_keyword_arguments_to_tags():
+    cache = Cache(maxsize=10, ttl=60)
+    calls = []
+
+    @cache.memoize(lambda value, name, page=0: ['name:' + name])
+    def lookup(name, page=0):
+        calls.append(name)
+        return name
+
+    lookup(name='a', page=1)
+    cache.invalidate('name:a')
+    lookup(name='a', page=1)
+    assert calls == ['a', 'a']
+
+
+def test_invalidate_drops_only_tagged_entries():
+    cache = Cache(maxsize=10, ttl=60)
+    cache.set('one', 1, tags=['a'])
+    cache.set('two', 2, tags=['b'])
+    cache.invalidate('a')
+    assert cache.get('one') == (False, None)
+    assert cache.get('two') == (True, 2)
+
+
+def shared_cache(graph, keep=3600.0):
+    """A cache as another worker process would have it, sharing the graph's log."""
+    shared = Cache(maxsize=10, ttl=60)
+    shared.share(InvalidationLog(
+        write=lambda id, tags: graph.run(queries.RECORD_INVALIDATION, id=id, tags=tags),
+        read=models.read_invalidations,
+        prune=lambda before: graph.run(queries.PRUNE_INVALIDATIONS, before=before, limit=100),
+        keep=keep))
+    shared.sync()
+    return shared
+
+
+def test_invalidations_reach_other_processes(graph):
+    first, second = shared_cache(graph), shared_cache(graph)
+    first.set('question', 1, tags=['question:1'])
+    first.set('other', 2, tags=['question:2'])
+
+    second.invalidate('question:1')
+    first.sync()
+
+    assert first.get('question') == (False, None)
+    assert first.get('other') == (True, 2)
+
+
+def test_a_process_that_missed_pruned_invalidations_empties_its_cache(graph):
+    first = shared_cache(graph, keep=0.05)
+    first.set('question', 1, tags=['question:1'])
+    time.sleep(0.1)
+
+    first.sync()
+
+    assert first.get('question') == (False, None)
+
+
+def test_a_load_racing_an_invalidation_is_not_cached():
+    cache = Cache(maxsize=10, ttl=60)
+    started, written = threading.Event(), threading.Event()
+    data = {"answers": 1}
+    calls = []
+
+    @cache.memoize(lambda value, question_id: ['answers:' + question_id])
+    def count_answers(question_id):
+        calls.append(question_id)
+        value = data["answers"]
+        if len(calls) == 1:
+            started.set()
+            written.wait(5)
+        return value
+
+    reader = threading.Thread(target=count_answers, args=('1',))
+    reader.start()
+    started.wait(5)
+    data["answers"] = 2
+    cache.invalidate('answers:1')
+    written.set()
+    reader.join(5)
+
+    assert count_answers('1') == 2
+    assert len(calls) == 2
+    assert cache.invalidated == {}
+
+
+def test_invalidating_other_tags_does_not_stop_a_load_being_cached():
+    cache = Cache(maxsize=10, ttl=60)
+    calls = []
+
+    @cache.memoize(lambda value, name: ['name:' + name])
+    def lookup(name):
+        calls.append(name)
+        cache.invalidate('name:other')
+        return name
+
+    lookup('a')
+    lookup('a')
+    assert calls == ['a']
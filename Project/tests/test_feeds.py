@@ -0,0 +1,81 @@
+import pytest
+
+from blog import models
+from blog.models import User
+
+
+@pytest.fixture
+def small_feeds(monkeypatch):
+    monkeypatch.setattr(models, 'FEED_SIZE', 4)
+    monkeypatch.setattr(models, 'FEED_SLACK', 0)
+
+
+def baseline(graph, username, key, limit=None):
+    """What the feed queries replaced by FEED relationships found: the questions
+    published by users username follows or sharing a tag with them, not their
+    own, ordered on key and then id."""
+    memory = graph.backend.graph
+    reader = memory.find('User', 'username', username)
+    tags = set(tag.id for tag in memory.into(reader, 'TAGGED', 'Tag'))
+    found = {}
+    for question in memory.label('Question'):
+        publisher = memory.into(question, 'PUBLISHED', 'User')[0]
+        followed = publisher in memory.out(reader, 'FOLLOW', 'User')
+        shared = tags & set(tag.id for tag in memory.into(question, 'TAGGED', 'Tag'))
+        if publisher is not reader and (followed or shared):
+            found[question['id']] = (question[key] or 0, question['id'])
+    ordered = [id for id, _ in sorted(found.items(), key=lambda item: item[1], reverse=True)]
+    return ordered[:limit]
+
+
+def read_all(page):
+    ids, after = [], None
+    while True:
+        rows, after = page(after)
+        ids.extend(row['question']['id'] for row in rows)
+        if after is None:
+            return ids
+
+
+def setup_readers():
+    for name in ('alice', 'bob', 'carol'):
+        User(name).register('secret1')
+    alice = User('alice')
+    alice.addTags('art')
+    alice.follow_user('bob')
+    questions = []
+    for i in range(4):
+        questions.append(User('bob').add_question('Bob %d' % i, '', 'Untagged.'))
+        questions.append(User('carol').add_question('Carol %d' % i, 'art', 'Tagged.'))
+    User('carol').add_question('Carol food', 'food', 'Not for alice.')
+    alice.add_question('Alice', 'art', 'Her own.')
+    return questions
+
+
+def test_timeline_matches_the_baseline_newest_first(graph, small_feeds):
+    setup_readers()
+    assert read_all(User('alice').get_timeline) == baseline(graph, 'alice', 'update_timestamp', models.FEED_SIZE)
+
+
+def test_an_answered_question_comes_back_to_the_timeline(graph, small_feeds):
+    questions = setup_readers()
+    oldest = questions[0]
+    assert oldest not in read_all(User('alice').get_timeline)
+
+    User('carol').add_answer(oldest, 'An answer brings it back.')
+
+    timeline = read_all(User('alice').get_timeline)
+    assert timeline[0] == oldest
+    assert timeline == baseline(graph, 'alice', 'update_timestamp', models.FEED_SIZE)
+
+
+def test_voteline_ranks_every_candidate(graph, small_feeds):
+    questions = setup_readers()
+    answer = User('carol').add_answer(questions[0], 'Old but good.')
+    User('bob').upvote_answer(answer)
+    models.vote_buffer.flush()
+
+    voteline = read_all(User('alice').get_voteline)
+    assert voteline[0] == questions[0]
+    assert voteline == baseline(graph, 'alice', 'upvote')
+    assert len(voteline) == len(questions)
@@ -0,0 +1,56 @@
+from blog import app, models
+from blog.executor import run_concurrently
+from blog.models import User
+
+
+def setup_question():
+    alice, bob = User('alice'), User('bob')
+    alice.register('secret1')
+    bob.register('secret1')
+    question_id = alice.add_question('Brushes', 'art', 'Which brushes?')
+    return question_id, bob.add_answer(question_id, 'Soft ones.')
+
+
+def loads(question_id):
+    with app.test_request_context():
+        models.get_question(question_id)
+        models.get_question(question_id)
+        models.get_answers(question_id, 'votes')
+        models.get_answers(question_id, 'recent')
+        return models.current_identity_map()
+
+
+def test_questions_and_answers_are_loaded_once_per_request():
+    question_id, answer_id = setup_question()
+    identity_map = loads(question_id)
+    assert ('Question', 'id', question_id) in identity_map.nodes
+    assert ('Answer', 'id', answer_id) in identity_map.nodes
+    assert identity_map.avoided == 2
+
+
+def test_writes_in_a_request_are_read_back():
+    question_id, answer_id = setup_question()
+    with app.test_request_context():
+        assert models.get_question(question_id)[0]['question']['answer_count'] == 1
+        assert models.get_answers(question_id)[0][0]['answer']['upvote'] == 0
+        User('alice').upvote_answer(answer_id)
+        User('alice').bookmark_question(question_id)
+        assert models.get_answers(question_id)[0][0]['answer']['upvote'] == 1
+        assert models.get_question(question_id)[0]['question']['bookmark_count'] == 1
+        User('bob').add_answer(question_id, 'Or hard ones.')
+        assert models.get_question(question_id)[0]['question']['answer_count'] == 2
+
+
+def test_concurrent_queries_share_the_request_map():
+    question_id, answer_id = setup_question()
+    with app.test_request_context():
+        identity_map = models.current_identity_map()
+        models.get_question(question_id)
+        results = run_concurrently({
+            'question': (lambda: models.get_question(question_id), None),
+            'answers': (lambda: models.get_answers(question_id), None),
+        })
+        assert results['question'] is not None
+        assert results['answers'] is not None
+        assert identity_map.avoided == 1
+        assert ('Answer', 'id', answer_id) in identity_map.nodes
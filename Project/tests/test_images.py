@@ -0,0 +1,35 @@
+import hashlib
+import os
+import time
+
+from blog import images
+
+
+def upload_name(content):
+    return hashlib.sha256(content).hexdigest() + '.jpg'
+
+
+def write(folder, names, age):
+    for name in names:
+        path = os.path.join(folder, name)
+        open(path, 'wb').close()
+        os.utime(path, (time.time() - age, time.time() - age))
+
+
+def test_clean_orphans_removes_only_unreferenced_uploads(tmpdir):
+    folder = str(tmpdir)
+    used, unused = upload_name(b'used'), upload_name(b'unused')
+    resized = images.derivative_name(unused, images.DISPLAY_SIZES['profile'])
+    shipped = ['Test1.jpg', 'Victor.jpg', 'default0.jpg']
+    write(folder, shipped + [used, unused, resized, 'tmp1234.upload'], age=7200)
+
+    removed = images.clean_orphans(folder, [used])
+
+    assert sorted(removed) == sorted([unused, resized, 'tmp1234.upload'])
+    assert sorted(os.listdir(folder)) == sorted(shipped + [used])
+
+
+def test_clean_orphans_keeps_recent_files(tmpdir):
+    folder = str(tmpdir)
+    write(folder, [upload_name(b'new')], age=0)
+    assert images.clean_orphans(folder, []) == []
@@ -0,0 +1,81 @@
+from blog import models
+from blog.live import LiveHub, server_sent_events
+
+
+def make_hub(changes=(), queue_size=10):
+    # The poller would only run once an hour, so the tests see what they publish.
+    return LiveHub(lambda topics, since: [change for change in changes
+                                          if change[0] in topics and change[4] > since],
+                   max_streams=2, queue_size=queue_size, poll_interval=3600)
+
+
+def test_published_changes_reach_the_topic_subscribers():
+    hub = make_hub()
+    subscription = hub.subscribe('q1')
+    other = hub.subscribe('q2')
+
+    hub.publish('q1', 'answer', 'a1', {"id": 'a1'}, at=1.0)
+    hub.publish('q1', 'votes', 'a1', {"id": 'a1', "upvote": 1}, at=2.0)
+    hub.publish('q1', 'votes', 'a1', {"id": 'a1', "upvote": 1}, at=3.0)
+
+    assert subscription.take(0) == [('answer', {"id": 'a1'}, 1.0),
+                                    ('votes', {"id": 'a1', "upvote": 1}, 2.0)]
+    assert other.take(0) == []
+    assert hub.subscribe('q3') is None
+
+
+def test_subscribing_since_replays_later_changes():
+    hub = make_hub([('q1', 'answer', 'a1', {"id": 'a1'}, 1.0),
+                    ('q1', 'answer', 'a2', {"id": 'a2'}, 2.0),
+                    ('q2', 'answer', 'a3', {"id": 'a3'}, 3.0)])
+
+    subscription = hub.subscribe('q1', since=1.0)
+    hub.publish('q1', 'answer', 'a2', {"id": 'a2'}, at=2.0)
+
+    assert subscription.take(0) == [('answer', {"id": 'a2'}, 2.0)]
+
+
+def test_a_stream_resumes_after_the_last_event_id(client, login, monkeypatch):
+    monkeypatch.setattr(models.live_updates, 'max_streams', 1)
+    bob = login('bob')
+    question_id = bob.add_question('Brushes', 'art', 'Which brushes?')
+    first = bob.add_answer(question_id, 'Soft ones.')
+    second = bob.add_answer(question_id, 'Hard ones.')
+    rows = dict((row['answer']['id'], row['answer']) for row in models.get_answers(question_id)[0])
+
+    response = client.get('/show_question/%s/live' % question_id,
+                          headers={'Last-Event-ID': repr(rows[first]['timestamp'])})
+    chunks = iter(response.response)
+    assert next(chunks) == b'retry: 2000\n\n'
+    event = next(chunks).decode()
+    response.close()
+
+    assert event.startswith('id: %r\nevent: answer\n' % rows[second]['timestamp'])
+    assert second in event
+    assert models.live_updates.streams == 0
+
+
+def test_a_client_that_falls_behind_is_told_to_reload():
+    hub = make_hub(queue_size=2)
+    subscription = hub.subscribe('q1')
+    for number in range(3):
+        hub.publish('q1', 'answer', number, {"id": number}, at=float(number))
+
+    assert list(server_sent_events(hub, subscription, heartbeat=0, seconds=60)) == [
+        'retry: 2000\n\n', 'event: reload\ndata: {}\n\n']
+    assert hub.streams == 0
+
+
+def test_closing_a_stream_unsubscribes_it():
+    hub = make_hub()
+    subscription = hub.subscribe('q1')
+    stream = server_sent_events(hub, subscription, heartbeat=0, seconds=60)
+    assert next(stream) == 'retry: 2000\n\n'
+    assert next(stream) == ': keep-alive\n\n'
+
+    stream.close()
+
+    assert hub.streams == 0
+    assert hub.topics == {}
+    hub.publish('q1', 'answer', 'a1', {"id": 'a1'})
+    assert subscription.take(0) == []
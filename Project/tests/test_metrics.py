@@ -0,0 +1,18 @@
+from blog.metrics import loggable, MAX_LOGGED_VALUE
+
+
+def test_loggable_redacts_passwords_at_any_depth():
+    parameters = {"user": {"username": "alice", "password": "hash"},
+                  "users": [{"username": "bob", "password": "hash"}],
+                  "pairs": ({"password": "hash"},)}
+    assert loggable(parameters) == {"user": {"username": "alice", "password": "[redacted]"},
+                                    "users": [{"username": "bob", "password": "[redacted]"}],
+                                    "pairs": [{"password": "[redacted]"}]}
+
+
+def test_loggable_cuts_long_values_short_after_redacting():
+    users = [{"username": "user%d" % i, "password": "secret hash"} for i in range(1000)]
+    logged = loggable({"users": users})["users"]
+    assert logged.endswith('...')
+    assert len(logged) == MAX_LOGGED_VALUE + 3
+    assert 'secret hash' not in logged
@@ -0,0 +1,84 @@
+from blog import models
+from blog.models import User
+
+
+def test_new_user_has_a_matching_tag_mask():
+    assert User('alice').register('secret1')
+    assert models.check_tag_masks() == {'User': 0, 'Question': 0}
+
+
+def test_tag_masks_follow_tag_changes():
+    user = User('alice')
+    user.register('secret1')
+    user.addTags('art food')
+    user.add_question('Brushes', 'art', 'Which brushes?')
+    assert models.check_tag_masks() == {'User': 0, 'Question': 0}
+    user.removeTags('art food')
+    assert models.check_tag_masks() == {'User': 0, 'Question': 0}
+
+
+def test_answers_are_read_after_they_are_written():
+    alice, bob = User('alice'), User('bob')
+    alice.register('secret1')
+    bob.register('secret1')
+    question_id = alice.add_question('Brushes', 'art', 'Which brushes?')
+    assert models.get_answers(question_id) == ([], None)
+
+    answer_id = bob.add_answer(question_id, 'Soft ones.')
+
+    rows, after = models.get_answers(question_id)
+    assert [row['answer']['id'] for row in rows] == [answer_id]
+    question = models.get_question(question_id)[0]['question']
+    assert question['answer_count'] == 1
+    assert question['last_answerer'] == 'bob'
+
+
+def test_upvotes_are_read_after_they_are_written():
+    alice, bob = User('alice'), User('bob')
+    alice.register('secret1')
+    bob.register('secret1')
+    question_id = alice.add_question('Brushes', 'art', 'Which brushes?')
+    answer_id = bob.add_answer(question_id, 'Soft ones.')
+    models.get_answers(question_id)
+
+    alice.upvote_answer(answer_id)
+    alice.upvote_answer(answer_id)
+
+    rows, after = models.get_answers(question_id)
+    assert rows[0]['answer']['upvote'] == 1
+    models.vote_buffer.flush()
+    assert models.get_question(question_id)[0]['question']['upvote'] == 1
+
+
+def test_front_page_counters_follow_writes():
+    alice, bob = User('alice'), User('bob')
+    alice.register('secret1')
+    bob.register('secret1')
+    question_id = alice.add_question('Brushes', 'art', 'Which brushes?')
+    assert models.get_latest_questions()[0]['question']['answer_count'] == 0
+
+    answer_id = bob.add_answer(question_id, 'Soft ones.')
+    alice.upvote_answer(answer_id)
+    bob.bookmark_question(question_id)
+    models.vote_buffer.flush()
+
+    question = models.get_latest_questions()[0]['question']
+    assert question['answer_count'] == 1
+    assert question['last_answerer'] == 'bob'
+    assert question['upvote'] == 1
+    assert question['bookmark_count'] == 1
+
+def test_questions_without_tags_are_listed(client, login):
+    login('bob')
+    alice = login('alice')
+    User('bob').follow_user('alice')
+    question_id = alice.add_question('Untagged painting', '', 'No boxes ticked.')
+    client.get('/')
+
+    assert models.get_question(question_id)[0]['tags'] == []
+    assert question_id in [row['question']['id'] for row in models.get_latest_questions()]
+    assert question_id in [row['question']['id'] for row in alice.get_recent_questions()]
+    assert question_id in [row['question']['id'] for row in User('bob').get_timeline()[0]]
+    assert question_id in [row['question']['id'] for row in models.search_questions('painting')]
+    for path in ('/', '/profile/alice', '/search?q=painting', '/show_question/' + question_id):
+        assert b'Untagged painting' in client.get(path).data
@@ -0,0 +1,81 @@
+import pytest
+
+from blog import models
+from blog.models import User
+
+
+def setup_answers():
+    for name in ('alice', 'bob', 'carol', 'dave'):
+        User(name).register('secret1')
+    question_id = User('alice').add_question('Brushes', 'art', 'Which brushes?')
+    answers = [User(name).add_answer(question_id, 'Answer %d' % number)
+               for number, name in enumerate(('bob', 'carol', 'dave', 'bob', 'carol'))]
+    # Three answers tie on one vote, so a page is cut inside the tie.
+    for voter, answer in (('alice', answers[1]), ('dave', answers[1]), ('alice', answers[3]),
+                          ('bob', answers[2]), ('dave', answers[4])):
+        User(voter).upvote_answer(answer)
+    return question_id
+
+
+def walk(page, limit):
+    """Reads every page of limit rows. Returns the rows of each page and the
+    cursor that came with the last one."""
+    pages, after = [], None
+    while True:
+        rows, after = page(after, limit)
+        pages.append(rows)
+        if after is None:
+            return pages, after
+
+
+@pytest.mark.parametrize('sort', ['recent', 'votes'])
+def test_answer_pages_follow_the_sort_across_cursors(sort):
+    question_id = setup_answers()
+    everything, after = models.get_answers(question_id, sort, limit=100)
+    assert after is None
+
+    pages, after = walk(lambda after, limit: models.get_answers(question_id, sort, after, limit), 2)
+
+    assert [len(rows) for rows in pages] == [2, 2, 1]
+    assert [row['answer']['id'] for rows in pages for row in rows] == \
+        [row['answer']['id'] for row in everything]
+    keys = [row['key'] for row in everything]
+    assert keys == sorted(keys, reverse=True)
+
+
+@pytest.mark.parametrize('feed', ['timeline', 'voteline'])
+def test_feed_pages_follow_the_sort_across_cursors(feed):
+    question_id = setup_answers()
+    User('bob').follow_user('alice')
+    User('bob').follow_user('carol')
+    for number in range(4):
+        User('carol').add_question('Carol %d' % number, 'art', 'Tagged.')
+    models.vote_buffer.flush()
+    read = lambda after, limit: models.feed_page('bob', models.FEEDS[feed], after, limit)
+    everything, after = read(None, 100)
+    assert len(everything) == 5 and after is None
+
+    pages, after = walk(read, 2)
+
+    assert [len(rows) for rows in pages] == [2, 2, 1]
+    assert [row['question']['id'] for rows in pages for row in rows] == \
+        [row['question']['id'] for row in everything]
+    if feed == 'voteline':
+        assert everything[0]['question']['id'] == question_id
+
+
+def test_a_full_last_page_is_followed_by_an_empty_one():
+    question_id = setup_answers()
+    rows, after = models.get_answers(question_id, 'recent', limit=5)
+    assert len(rows) == 5 and after is not None
+
+    assert models.get_answers(question_id, 'recent', after, 5) == ([], None)
+
+
+@pytest.mark.parametrize('cursor', ['not a cursor', '%%%', models.encode_cursor(1, 2, 3),
+                                    models.encode_cursor()[:-2], 'bnVsbA=='])
+def test_malformed_cursors_start_at_the_first_page(cursor):
+    question_id = setup_answers()
+    assert models.decode_cursor(cursor) is None
+
+    assert models.get_answers(question_id, 'votes', cursor, 2) == models.get_answers(question_id, 'votes', None, 2)
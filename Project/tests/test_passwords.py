@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from blog import executor, passwords
+from blog.passwords import PasswordService, PasswordServiceBusy
+
+
+@pytest.fixture
+def service():
+    service = PasswordService(rounds=4, workers=2, max_pending=2, timeout=10)
+    yield service
+    service.shutdown()
+
+
+def test_hashes_and_verifies(service):
+    hashed = service.hash('secret1')
+    assert service.verify('secret1', hashed) == (True, None)
+    assert service.verify('secret2', hashed) == (False, None)
+
+
+def test_rehashes_at_the_configured_cost(service):
+    matches, new_hash = service.verify('secret1', PasswordService(5, 1, 1, 10).hash('secret1'))
+    assert matches
+    assert passwords.rounds_of(new_hash) == 4
+
+
+def test_refuses_instead_of_queueing_when_full(service):
+    for _ in range(2):
+        service.slots.acquire()
+    with pytest.raises(PasswordServiceBusy):
+        service.hash('secret1')
+
+
+def test_hashes_on_real_threads_under_gevent(service, monkeypatch):
+    threadpool = pytest.importorskip('gevent.threadpool')
+    monkeypatch.setattr(passwords, 'cooperative', lambda: True)
+    monkeypatch.setattr(executor, 'cooperative', lambda: True)
+    hashed = service.hash('secret1')
+    assert isinstance(service.pool, threadpool.ThreadPoolExecutor)
+    assert service.verify('secret1', hashed) == (True, None)
+
+
+def test_slow_hashes_are_busy_and_keep_their_slot_until_done():
+    service = PasswordService(rounds=4, workers=1, max_pending=1, timeout=0.1)
+    try:
+        with pytest.raises(PasswordServiceBusy):
+            service.call(time.sleep, 1)
+        with pytest.raises(PasswordServiceBusy):
+            service.hash('secret1')
+        time.sleep(1.5)
+        assert service.verify('secret1', service.hash('secret1')) == (True, None)
+    finally:
+        service.shutdown()
@@ -0,0 +1,62 @@
+from blog import app, models
+from blog.models import User
+
+SUMMARY = ('answer_count', 'last_answerer', 'last_activity', 'upvote', 'bookmark_count')
+
+
+def setup_questions():
+    for name in ('alice', 'bob', 'carol'):
+        User(name).register('secret1')
+    asked = User('alice').add_question('Brushes', 'art', 'Which brushes?')
+    User('alice').add_question('Unanswered', 'art', 'Anyone?')
+    first = User('bob').add_answer(asked, 'Soft ones.')
+    User('carol').add_answer(asked, 'Hard ones.')
+    User('alice').upvote_answer(first)
+    User('carol').upvote_answer(first)
+    User('bob').bookmark_question(asked)
+    models.vote_buffer.flush()
+    return asked
+
+
+def summaries(graph):
+    memory = graph.backend.graph
+    questions = dict((question['id'], tuple(question[key] for key in SUMMARY))
+                     for question in memory.label('Question'))
+    users = dict((user['username'], user['upvote']) for user in memory.label('User'))
+    return questions, users
+
+
+def corrupt(graph):
+    memory = graph.backend.graph
+    for question in memory.label('Question'):
+        for key, value in zip(SUMMARY, (7, 'nobody', 0, 99, 5)):
+            memory.set(question, key, value)
+    for user in memory.label('User'):
+        memory.set(user, 'upvote', 42)
+
+
+def test_repair_rebuilds_question_summaries(graph):
+    asked = setup_questions()
+    questions, users = summaries(graph)
+    assert questions[asked][:2] == (2, 'carol')
+    assert questions[asked][3:] == (2, 1)
+    corrupt(graph)
+
+    result = app.test_cli_runner().invoke(args=['repair-question-summaries', '--batch-size', '1'])
+
+    assert result.output == 'Repaired 2 questions.\n'
+    assert summaries(graph)[0] == questions
+
+
+def test_vote_counts_rebuild_question_and_user_upvotes(graph):
+    setup_questions()
+    questions, users = summaries(graph)
+    assert users['bob'] == 2
+    corrupt(graph)
+
+    models.write_votes(list(questions), list(users))
+
+    repaired_questions, repaired_users = summaries(graph)
+    assert repaired_users == users
+    assert dict((id, summary[3]) for id, summary in repaired_questions.items()) == \
+        dict((id, summary[3]) for id, summary in questions.items())
@@ -0,0 +1,34 @@
+from blog import models
+from blog.search import SEARCH_PAGE_SIZE
+
+
+def test_negative_pages_show_the_first_page(client, login):
+    alice = login('alice')
+    alice.add_question('Painting', 'art', 'Which brushes?')
+    client.get('/')  # Shows the flashed login message.
+
+    for path in ('/search?q=painting', '/user_search/alice?user=al'):
+        response = client.get(path + '&page=-1')
+        assert response.status_code == 200
+        assert response.data == client.get(path).data
+
+
+def test_next_link_follows_the_page_size(client, login):
+    alice = login('alice')
+    for i in range(SEARCH_PAGE_SIZE + 1):
+        alice.add_question('Painting %d' % i, 'art', 'Which brushes?')
+
+    assert b'Next' in client.get('/search?q=painting').data
+    second = client.get('/search?q=painting&page=1').data
+    assert b'Next' not in second
+    assert b'Previous' in second
+
+
+def test_pages_are_full_when_some_hits_have_no_tags(client, login):
+    alice = login('alice')
+    for i in range(SEARCH_PAGE_SIZE + 1):
+        alice.add_question('Painting %d' % i, 'art' if i % 2 else '', 'Which brushes?')
+
+    assert len(models.search_questions('painting')) == SEARCH_PAGE_SIZE
+    assert len(models.search_questions('painting', 1)) == 1
+    assert b'Next' in client.get('/search?q=painting').data
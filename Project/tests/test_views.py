@@ -0,0 +1,22 @@
+from blog import models
+
+
+def test_posted_answer_shows_on_the_question_page(client, login):
+    alice = login('alice')
+    question_id = alice.add_question('Brushes', 'art', 'Which brushes?')
+    login('bob')
+    assert b'Soft ones.' not in client.get('/show_question/' + question_id).data
+
+    response = client.post('/add_answer', data={'text': 'Soft ones.'},
+                           headers={'Referer': '/show_question/' + question_id})
+
+    assert response.status_code == 302
+    page = client.get('/show_question/' + question_id)
+    assert page.status_code == 200
+    assert b'Soft ones.' in page.data
+
+
+def test_registering_through_the_site_keeps_tag_masks_consistent(client, login):
+    login('alice')
+    client.post('/change_user_tags/alice', data={'art': 'on'})
+    assert models.check_tag_masks() == {'User': 0, 'Question': 0}
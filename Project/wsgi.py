@@ -0,0 +1,6 @@
+from blog import app
+
+# Sessions signed by one worker must be readable by every other, so the key has
+# to come from the environment rather than be made up at start.
+if not app.secret_key:
+    raise RuntimeError('Set SECRET_KEY to a long random string shared by all workers.')